@@ -2,6 +2,11 @@ SET FOREIGN_KEY_CHECKS = 0;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS users_follow_list;
 DROP TABLE IF EXISTS tweets;
+DROP TABLE IF EXISTS users_counters;
+DROP TABLE IF EXISTS users_archived_tweets;
+DROP TABLE IF EXISTS users_recommendations;
+DROP TABLE IF EXISTS outbox_events;
+DROP TABLE IF EXISTS outbox_checkpoints;
 SET FOREIGN_KEY_CHECKS = 1;
 
 CREATE TABLE users(
@@ -14,7 +19,8 @@ CREATE TABLE users(
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP NULL DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
-    UNIQUE KEY email (email)
+    UNIQUE KEY email (email),
+    KEY users_profile_picture (profile_picture)
 );
 
 CREATE TABLE users_follow_list(
@@ -22,15 +28,58 @@ CREATE TABLE users_follow_list(
     follow_user_id INT NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (user_id, follow_user_id),
+    KEY users_follow_list_follow_user_id (follow_user_id, user_id),
     CONSTRAINT users_follow_list_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id),
     CONSTRAINT users_follow_list_follow_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id)
 );
 
 CREATE TABLE tweets(
-    id INT NOT NULL AUTO_INCREMENT,
+    id BIGINT NOT NULL,
     user_id INT NOT NULL,
     tweet VARCHAR(300) NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
+    KEY tweets_created_at (created_at),
+    KEY tweets_user_id_id (user_id, id),
+    FULLTEXT KEY tweet_fulltext (tweet) WITH PARSER ngram,
     CONSTRAINT tweets_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE TABLE users_counters(
+    user_id INT NOT NULL,
+    slot TINYINT NOT NULL,
+    followers INT NOT NULL DEFAULT 0,
+    following INT NOT NULL DEFAULT 0,
+    tweets INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, slot)
+);
+
+CREATE TABLE users_archived_tweets(
+    user_id INT NOT NULL,
+    tweets INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id)
+);
+
+CREATE TABLE users_recommendations(
+    user_id INT NOT NULL,
+    position TINYINT NOT NULL,
+    recommended_user_id INT NOT NULL,
+    score INT NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+
+CREATE TABLE outbox_events(
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    event_type VARCHAR(50) NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    KEY outbox_events_created_at (created_at)
+);
+
+CREATE TABLE outbox_checkpoints(
+    consumer VARCHAR(100) NOT NULL,
+    event_id BIGINT NOT NULL,
+    updated_at TIMESTAMP NULL DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (consumer)
 );
\ No newline at end of file
@@ -5,9 +5,23 @@ import boto3
 import botocore
 
 import config
-from model import UserDAO, TweetDAO
-from service import UserService, TweetService
+from model import UserDAO, TweetDAO, CounterDAO, RecommendationDAO, OutboxDAO
+from service import (
+    UserService,
+    TweetService,
+    TrendService,
+    ArchiveService,
+    ExportService,
+    IdGenerator,
+    CounterService,
+    RecommendationService,
+    TimelineBroker,
+    OutboxRelay,
+    UploadService,
+    CacheWarmer
+)
 from view import create_endpoints
+from view.capture import TrafficCapture
 
 class Services:
     pass
@@ -20,12 +34,32 @@ def create_app(test_config = None):
         app.config.from_pyfile("config.py")
     else:
         app.config.update(test_config)
+
+    # oversized requests are refused from Content-Length, before their body is read
+    app.config['MAX_CONTENT_LENGTH'] = app.config.get('MAX_CONTENT_LENGTH') or 8 * 1024 * 1024
         
-    database = create_engine(app.config['DB_URL'], encoding='utf-8', max_overflow=0, echo=True)
+    # threads serving requests: the WSGI pool, and the pool of non-blocking timeline reads
+    app.config.setdefault('THREAD_POOL_SIZE', 50)
+    app.config.setdefault('TIMELINE_THREAD_POOL_SIZE', 10)
+    # one connection per thread, so no thread ever waits for a connection
+    app.config.setdefault('DB_POOL_SIZE', app.config['THREAD_POOL_SIZE'] + app.config['TIMELINE_THREAD_POOL_SIZE'])
+
+    database = create_engine(
+        app.config['DB_URL'],
+        encoding='utf-8',
+        pool_size=app.config['DB_POOL_SIZE'],
+        max_overflow=0,
+        # waiting for a connection counts against a request's time as much as the query
+        pool_timeout=app.config.get('DB_POOL_TIMEOUT', 30),
+        echo=app.config.get('DB_ECHO', True)
+    )
 
     # persistence layer
     user_dao = UserDAO(database)
     tweet_dao = TweetDAO(database)
+    counter_dao = CounterDAO(database)
+    recommendation_dao = RecommendationDAO(database)
+    outbox_dao = OutboxDAO(database)
 
     # business layer
     s3_client = boto3.client(
@@ -36,8 +70,34 @@ def create_app(test_config = None):
 
     services = Services
     services.user_service = UserService(user_dao, app.config, s3_client)
-    services.tweet_service = TweetService(tweet_dao)
+    services.id_generator = IdGenerator(app.config.get('WORKER_ID', 0))
+    services.tweet_service = TweetService(tweet_dao, app.config, services.id_generator)
+    services.trend_service = TrendService(tweet_dao, app.config)
+    services.trend_service.rebuild()
+    services.archive_service = ArchiveService(tweet_dao, app.config)
+    services.export_service = ExportService(user_dao, tweet_dao, app.config, services.archive_service)
+    services.counter_service = CounterService(counter_dao, app.config)
+    services.recommendation_service = RecommendationService(user_dao, recommendation_dao, app.config)
+    services.timeline_broker = TimelineBroker()
+    services.upload_service = UploadService(app.config)
+    services.cache_warmer = CacheWarmer(services.user_service, services.tweet_service, app.config)
+
+    # side effects of tweets and follows run off the request, fed by the outbox
+    services.outbox_relay = OutboxRelay(outbox_dao, app.config)
+    services.outbox_relay.register('trends', services.trend_service.consume, ['tweet_created'])
+    services.outbox_relay.register('email_filter', services.user_service.consume, ['user_created'])
+    services.outbox_relay.register('timeline_stream', services.timeline_broker.consume, ['tweet_created', 'follow', 'unfollow'])
+    services.outbox_relay.register('warm_timelines', services.tweet_service.consume, ['tweet_created', 'follow', 'unfollow'])
+    services.outbox_relay.load_checkpoints()
 
     create_endpoints(app, services)
 
+    # production traffic can be recorded, to be replayed against a test instance
+    app.traffic_capture = None
+    if app.config.get('CAPTURE_PATH'):
+        app.wsgi_app = app.traffic_capture = TrafficCapture(app.wsgi_app, app.config)
+
+    app.database = database
+    app.services = services
+
     return app
\ No newline at end of file
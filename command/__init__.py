@@ -0,0 +1,34 @@
+from .prefork import PreforkServer
+from .archive import ArchiveTweets, QueryArchive
+from .generate import GenerateData
+from .export import ExportUser
+from .counters import ReconcileCounters
+from .recommend import BuildRecommendations
+from .bcrypt_cost import CalibrateBcrypt
+from .outbox import PruneOutbox
+from .uploads import CleanUploads
+from .pictures import DeleteUnusedPictures
+from .replay import ReplayTraffic
+from .benchmark import BenchmarkTimeline, BenchmarkSearch, BenchmarkHydration, BenchmarkStatements, BenchmarkProfiles, BenchmarkWorkers, BenchmarkRecommendations, BenchmarkCoalescing
+
+def create_commands(manager, app):
+    manager.add_command('runworkers', PreforkServer(app))
+    manager.add_command('archive_tweets', ArchiveTweets(app))
+    manager.add_command('query_archive', QueryArchive(app))
+    manager.add_command('generate_data', GenerateData(app))
+    manager.add_command('export_user', ExportUser(app))
+    manager.add_command('reconcile_counters', ReconcileCounters(app))
+    manager.add_command('build_recommendations', BuildRecommendations(app))
+    manager.add_command('calibrate_bcrypt', CalibrateBcrypt(app))
+    manager.add_command('prune_outbox', PruneOutbox(app))
+    manager.add_command('clean_uploads', CleanUploads(app))
+    manager.add_command('delete_unused_pictures', DeleteUnusedPictures(app))
+    manager.add_command('replay_traffic', ReplayTraffic(app))
+    manager.add_command('benchmark_timeline', BenchmarkTimeline(app))
+    manager.add_command('benchmark_search', BenchmarkSearch(app))
+    manager.add_command('benchmark_hydration', BenchmarkHydration(app))
+    manager.add_command('benchmark_statements', BenchmarkStatements(app))
+    manager.add_command('benchmark_profiles', BenchmarkProfiles(app))
+    manager.add_command('benchmark_workers', BenchmarkWorkers(app))
+    manager.add_command('benchmark_recommendations', BenchmarkRecommendations(app))
+    manager.add_command('benchmark_coalescing', BenchmarkCoalescing(app))
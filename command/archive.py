@@ -0,0 +1,36 @@
+import json
+
+from flask_script import Command, Option
+
+class ArchiveTweets(Command):
+    '''
+    Move tweets older than N days from the tweets table to the archive files.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-d', '--days', dest='days', type=int, default=None)
+        ]
+
+    def run(self, days):
+        count = self.app.services.archive_service.archive(days)
+        print(f'{count} tweets archived')
+
+class QueryArchive(Command):
+    '''
+    Print archived tweets of a month (YYYY-MM) as NDJSON.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-m', '--month', dest='month', required=True),
+            Option('-u', '--user-id', dest='user_id', type=int, default=None)
+        ]
+
+    def run(self, month, user_id):
+        for tweet in self.app.services.archive_service.get_tweets(month, user_id):
+            print(json.dumps(tweet, ensure_ascii=False))
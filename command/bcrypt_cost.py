@@ -0,0 +1,33 @@
+import time
+import bcrypt
+
+from flask_script import Command, Option
+
+class CalibrateBcrypt(Command):
+    '''
+    Find the highest bcrypt cost whose hashing time stays within a target on this machine.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-t', '--target', dest='target_ms', type=int, default=250),
+            Option('-r', '--repeat', dest='repeat', type=int, default=3)
+        ]
+
+    def run(self, target_ms, repeat):
+        chosen_rounds = 4
+        for rounds in range(4, 32):
+            salt = bcrypt.gensalt(rounds)
+            started_at = time.perf_counter()
+            for _ in range(repeat):
+                bcrypt.hashpw(b'calibration password', salt)
+            elapsed_ms = (time.perf_counter() - started_at) * 1000 / repeat
+
+            print(f'rounds {rounds}: {elapsed_ms:.1f}ms')
+            if elapsed_ms > target_ms:
+                break
+            chosen_rounds = rounds
+
+        print(f'BCRYPT_ROUNDS = {chosen_rounds}')
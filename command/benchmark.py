@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import time
+import resource
+import random
+import subprocess
+import urllib3
+
+from concurrent.futures import ThreadPoolExecutor
+from flask_script import Command, Option
+from sqlalchemy import event, text
+
+from model import UserDAO, TweetDAO, BulkLoadDAO
+from model.tables import with_compiled_cache
+from model.user_dao import USER_COLUMNS, SELECT_USER_BY_ID
+from .generate import WORDS
+from .replay import percentile, is_error
+
+def run_load(requests, concurrency, timeout=30):
+    '''
+    Sends [(method, url, body, headers)] keeping up to concurrency of them in flight.
+    Returns [(status, seconds)] in request order, status None for failed connections,
+    and the elapsed time.
+    '''
+    http = urllib3.PoolManager(maxsize=concurrency, timeout=timeout, retries=False)
+
+    def send(request):
+        method, url, body, headers = request
+        started_at = time.perf_counter()
+        try:
+            status = http.request(method, url, body=body, headers=headers).status
+        except Exception:
+            status = None
+        return status, time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, requests))
+    return results, time.perf_counter() - started_at
+
+def time_calls(call, repeat):
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+def count_statements(database):
+    # [number of statements sent by database so far]
+    count = [0]
+
+    def on_execute(*args):
+        count[0] += 1
+    event.listen(database, 'before_cursor_execute', on_execute)
+    return count
+
+def describe(durations):
+    return (f'p50 {percentile(durations, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(durations, 0.99) * 1000:.2f}ms, '
+            f'max {max(durations) * 1000:.2f}ms')
+
+def summarize(results, elapsed):
+    durations = [duration for _, duration in results]
+    errors = sum(is_error(status) for status, _ in results)
+    return (f'{len(results)} requests in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s), '
+            f'p50 {percentile(durations, 0.5) * 1000:.1f}ms, '
+            f'p90 {percentile(durations, 0.9) * 1000:.1f}ms, '
+            f'p99 {percentile(durations, 0.99) * 1000:.1f}ms, '
+            f'{errors} errors')
+
+class BenchmarkTimeline(Command):
+    '''
+    Load /timeline/<user_id> of random generated users with many requests in flight, on a
+    server and optionally on a baseline, e.g. the non-blocking timeline resource against
+    a server started with TIMELINE_NONBLOCKING = False, which serves it from the WSGI pool.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-t', '--target', dest='target', default='http://localhost:5000'),
+            Option('-b', '--baseline', dest='baseline', default=None),
+            Option('-u', '--users', dest='num_users', type=int, default=100000),
+            Option('-c', '--concurrency', dest='concurrency', type=int, default=1000),
+            Option('-n', '--requests', dest='num_requests', type=int, default=20000),
+            Option('--since-id', dest='since_id', type=int, default=None),
+            Option('--seed', dest='seed', type=int, default=1)
+        ]
+
+    def run(self, target, baseline, num_users, concurrency, num_requests, since_id, seed):
+        rng = random.Random(seed)
+        # polls with a recent since_id are mostly answered 204
+        query = f'?since_id={since_id}' if since_id is not None else ''
+        paths = [f'/timeline/{rng.randint(1, num_users)}{query}' for _ in range(num_requests)]
+
+        for name, url in [('target', target), ('baseline', baseline)]:
+            if url is None:
+                continue
+            requests = [('GET', url.rstrip('/') + path, None, {}) for path in paths]
+            results, elapsed = run_load(requests, concurrency)
+            print(f'{name} {url}: {summarize(results, elapsed)}')
+
+class BenchmarkSearch(Command):
+    '''
+    Time /search queries in process against generated tweets, e.g. after
+    generate_data -t 10000000, for common and rare words, phrases, hashtags and misses.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-n', '--repeat', dest='repeat', type=int, default=20),
+            Option('-l', '--limit', dest='limit', type=int, default=20)
+        ]
+
+    def run(self, repeat, limit):
+        with self.app.database.connect() as connection:
+            print(f'{BulkLoadDAO(connection).count_tweets()} tweets')
+
+        tweet_service = self.app.services.tweet_service
+        queries = [
+            ('english word', WORDS[0]),
+            ('korean word', WORDS[10]),
+            ('phrase', f'{WORDS[1]} {WORDS[2]}'),
+            ('hashtag', '#' + WORDS[3]),
+            ('miss', 'zzzz')
+        ]
+        for name, query in queries:
+            # the first run loads index pages, later ones show the steady state
+            found = len(tweet_service.search(query, limit))
+            durations = time_calls(lambda: tweet_service.search(query, limit), repeat)
+            print(f'{name:<13} {query!r:<20} {found:>3} found, {describe(durations)}')
+
+class BenchmarkHydration(Command):
+    '''
+    Load the authors of full timeline pages of random generated users with one batched
+    query, as ?embed=authors does, and with one query per entry (N+1).
+    DAOs are called directly, so the user cache doesn't hide the round trips.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-u', '--users', dest='num_users', type=int, default=1000),
+            Option('-n', '--timelines', dest='num_timelines', type=int, default=100),
+            Option('--seed', dest='seed', type=int, default=1)
+        ]
+
+    def run(self, num_users, num_timelines, seed):
+        rng = random.Random(seed)
+        user_dao = UserDAO(self.app.database)
+        tweet_dao = TweetDAO(self.app.database)
+        timeline_size = self.app.config.get('TIMELINE_SIZE', 100)
+
+        timelines = []
+        for _ in range(num_timelines):
+            rows = tweet_dao.get_timeline(rng.randint(1, num_users), timeline_size).fetchall()
+            if rows:
+                timelines.append([row['user_id'] for row in rows])
+        if not timelines:
+            print('no timelines, load users with generate_data first')
+            return
+        entries = sum(len(author_ids) for author_ids in timelines) / len(timelines)
+        authors = sum(len(set(author_ids)) for author_ids in timelines) / len(timelines)
+        print(f'{len(timelines)} timelines of {entries:.1f} entries by {authors:.1f} authors on average')
+
+        statements = count_statements(self.app.database)
+        for name, load in [
+            ('batched', lambda author_ids: user_dao.get_users_by_ids(set(author_ids))),
+            ('per entry', lambda author_ids: [user_dao.get_user_by_id(author_id) for author_id in author_ids])
+        ]:
+            sent = statements[0]
+            iterator = iter(timelines)
+            durations = time_calls(lambda: load(next(iterator)), len(timelines))
+            print(f'{name:<10} {(statements[0] - sent) / len(timelines):.1f} queries per timeline, {describe(durations)}')
+
+class BenchmarkStatements(Command):
+    '''
+    Time one user lookup by id, a query DB answers in microseconds, issued as a text()
+    parsed on every call, as a Core statement compiled on every call, and as the DAOs
+    issue it, a Core statement compiled once into the compiled cache.
+    The differences are the per-call cost of building statements.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-n', '--repeat', dest='repeat', type=int, default=10000),
+            Option('-u', '--user-id', dest='user_id', type=int, default=1)
+        ]
+
+    def run(self, repeat, user_id):
+        database = self.app.database
+        sql = f'SELECT {", ".join(column.name for column in USER_COLUMNS)} FROM users WHERE id = :user_id'
+        cached_database = with_compiled_cache(database)
+        params = {'user_id': user_id}
+
+        variants = [
+            ('text', lambda: database.execute(text(sql), params).fetchone()),
+            ('core', lambda: database.execute(SELECT_USER_BY_ID, params).fetchone()),
+            ('core cached', lambda: cached_database.execute(SELECT_USER_BY_ID, params).fetchone())
+        ]
+        # one round first, so connections are open and the cache is filled
+        for _, call in variants:
+            call()
+
+        means = {}
+        for name, call in variants:
+            durations = time_calls(call, repeat)
+            means[name] = sum(durations) / len(durations)
+            print(f'{name:<12} mean {means[name] * 1e6:.1f}us, {describe(durations)}')
+        for name in ['text', 'core']:
+            print(f'{name} costs {(means[name] - means["core cached"]) * 1e6:.1f}us more per call than core cached')
+
+class BenchmarkProfiles(Command):
+    '''
+    Time reading the profiles of lists of random generated users from a server, one
+    /users?ids= request per list against one /users/<user_id> request per user with
+    concurrency of them in flight, as a client rendering the list would send them.
+    Each way reads its own lists, so one doesn't warm the user cache for the other.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-t', '--target', dest='target', default='http://localhost:5000'),
+            Option('-u', '--users', dest='num_users', type=int, default=100000),
+            Option('-i', '--ids', dest='num_ids', type=int, default=50),
+            Option('-n', '--lists', dest='num_lists', type=int, default=100),
+            Option('-c', '--concurrency', dest='concurrency', type=int, default=6),
+            Option('--seed', dest='seed', type=int, default=1)
+        ]
+
+    def run(self, target, num_users, num_ids, num_lists, concurrency, seed):
+        rng = random.Random(seed)
+        url = target.rstrip('/')
+        http = urllib3.PoolManager(maxsize=concurrency, timeout=30, retries=False)
+
+        def get(path):
+            try:
+                return http.request('GET', url + path).status
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            for name, get_paths in [
+                ('batched', lambda user_ids: [f'/users?ids={",".join(map(str, user_ids))}']),
+                ('per user', lambda user_ids: [f'/users/{user_id}' for user_id in user_ids])
+            ]:
+                lists = iter([rng.sample(range(1, num_users + 1), num_ids) for _ in range(num_lists)])
+                statuses = []
+                durations = time_calls(lambda: statuses.extend(executor.map(get, get_paths(next(lists)))), num_lists)
+                errors = sum(is_error(status) for status in statuses)
+                print(f'{name:<9} {len(statuses) / num_lists:.0f} requests per list of {num_ids}, '
+                      f'{describe(durations)}, {errors} errors')
+
+class BenchmarkWorkers(Command):
+    '''
+    Throughput of runworkers with 1 to N workers. For each count a server is started on
+    a spare port, loaded once /ping answers 200, and stopped. Timeline reads of random
+    generated users and /users?ids= lookups spend most of their time on JWT, JSON and
+    rows to dicts in Python, which one process runs on one core.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-w', '--workers', dest='max_workers', type=int, default=os.cpu_count()),
+            Option('-p', '--port', dest='port', type=int, default=5100),
+            Option('-u', '--users', dest='num_users', type=int, default=100000),
+            Option('-c', '--concurrency', dest='concurrency', type=int, default=200),
+            Option('-n', '--requests', dest='num_requests', type=int, default=20000),
+            Option('--startup-timeout', dest='startup_timeout', type=int, default=300),
+            Option('--seed', dest='seed', type=int, default=1)
+        ]
+
+    def run(self, max_workers, port, num_users, concurrency, num_requests, startup_timeout, seed):
+        rng = random.Random(seed)
+        url = f'http://127.0.0.1:{port}'
+        paths = [
+            f'/timeline/{rng.randint(1, num_users)}' if rng.random() < 0.5
+            else f'/users?ids={",".join(str(rng.randint(1, num_users)) for _ in range(20))}'
+            for _ in range(num_requests)
+        ]
+        requests = [('GET', url + path, None, {}) for path in paths]
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        single = None
+        for num_workers in range(1, max_workers + 1):
+            server = subprocess.Popen(
+                [sys.executable, 'setup.py', 'runworkers', '-w', str(num_workers), '-p', str(port)],
+                cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                if not self.wait_ready(server, url, startup_timeout):
+                    print(f'{num_workers} workers: not ready after {startup_timeout}s')
+                    return 1
+                results, elapsed = run_load(requests, concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+
+            throughput = len(results) / elapsed
+            single = single or throughput
+            print(f'{num_workers} workers: {summarize(results, elapsed)}, {throughput / single:.2f}x of 1 worker')
+
+    def wait_ready(self, server, url, timeout):
+        # workers answer 503 until their caches are warm
+        http = urllib3.PoolManager(timeout=5, retries=False)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and server.poll() is None:
+            try:
+                if http.request('GET', url + '/ping').status == 200:
+                    return True
+            except Exception:
+                pass
+            time.sleep(0.5)
+        return False
+
+class BenchmarkRecommendations(Command):
+    '''
+    Time build_recommendations on generated users and follows, e.g. after generate_data:
+    the candidate query of chunks of random users, and one full build with the number
+    of statements it sent and the memory it took.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-u', '--users', dest='num_users', type=int, default=100000),
+            Option('-n', '--chunks', dest='num_chunks', type=int, default=20),
+            Option('--seed', dest='seed', type=int, default=1)
+        ]
+
+    def run(self, num_users, num_chunks, seed):
+        rng = random.Random(seed)
+        user_dao = UserDAO(self.app.database)
+        recommendation_service = self.app.services.recommendation_service
+        chunk_size = recommendation_service.chunk_size
+
+        chunks = [user_dao.get_user_ids(rng.randint(0, num_users), chunk_size) for _ in range(num_chunks)]
+        chunks = [user_ids for user_ids in chunks if user_ids]
+        if not chunks:
+            print('no users, load them with generate_data first')
+            return
+        iterator = iter(chunks)
+        durations = time_calls(lambda: recommendation_service.recommend(next(iterator)), len(chunks))
+        print(f'candidates of {chunk_size} users: {describe(durations)}')
+
+        statements = count_statements(self.app.database)
+        started_at = time.perf_counter()
+        count = recommendation_service.build()
+        elapsed = time.perf_counter() - started_at
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        print(f'build: {count} users in {elapsed:.1f}s ({count / elapsed:.0f}/s), '
+              f'{statements[0]} statements, max RSS {max_rss} MB')
+
+class BenchmarkCoalescing(Command):
+    '''
+    Fire concurrent reads of one hot /timeline/<user_id> at a server and report how many
+    of them shared another request's DB read, from the timeline single_flight counters of
+    /metrics before and after. Workers of runworkers count on their own, so the target
+    should be a single process, with the micro cache off (the default) so every read is counted.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-t', '--target', dest='target', default='http://localhost:5000'),
+            Option('-u', '--user-id', dest='user_id', type=int, default=1),
+            Option('-c', '--concurrency', dest='concurrency', type=int, default=200),
+            Option('-n', '--requests', dest='num_requests', type=int, default=5000)
+        ]
+
+    def run(self, target, user_id, concurrency, num_requests):
+        url = target.rstrip('/')
+        http = urllib3.PoolManager(timeout=30, retries=False)
+
+        def get_single_flight():
+            response = http.request('GET', url + '/metrics')
+            return json.loads(response.data.decode('utf-8'))['timeline']['single_flight']
+
+        before = get_single_flight()
+        requests = [('GET', f'{url}/timeline/{user_id}', None, {})] * num_requests
+        results, elapsed = run_load(requests, concurrency)
+        after = get_single_flight()
+
+        reads = after['requests'] - before['requests']
+        executions = after['executions'] - before['executions']
+        print(f'/timeline/{user_id}: {summarize(results, elapsed)}')
+        print(f'{reads} timeline reads, {executions} DB reads, '
+              f'coalescing_ratio {(reads - executions) / reads if reads else 0.0:.3f} '
+              f'({after["coalescing_ratio"]:.3f} since the server started)')
@@ -0,0 +1,12 @@
+from flask_script import Command
+
+class ReconcileCounters(Command):
+    '''
+    Recount followers, followings and tweets of every user and repair drifted counters.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def run(self):
+        repaired = self.app.services.counter_service.reconcile()
+        print(f'{repaired} users repaired')
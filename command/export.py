@@ -0,0 +1,41 @@
+import sys
+
+from flask_script import Command, Option
+
+class ExportUser(Command):
+    '''
+    Export a user's tweets, followings and followers as NDJSON or CSV.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-u', '--user-id', dest='user_id', type=int, required=True),
+            Option('-f', '--format', dest='export_format', choices=['ndjson', 'csv'], default='ndjson'),
+            Option('-a', '--after', dest='after', default=None),
+            Option('-o', '--output', dest='output', default=None),
+            Option('--gzip', dest='use_gzip', action='store_true', default=False)
+        ]
+
+    def run(self, user_id, export_format, after, output, use_gzip):
+        export_service = self.app.services.export_service
+
+        records = export_service.export_records(user_id, after)
+        if export_format == 'csv':
+            chunks = export_service.to_csv(records)
+        else:
+            chunks = export_service.to_ndjson(records)
+
+        if use_gzip:
+            chunks = export_service.gzip(chunks)
+        else:
+            chunks = (chunk.encode('utf-8') for chunk in chunks)
+
+        out = open(output, 'wb') if output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if output:
+                out.close()
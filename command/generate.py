@@ -0,0 +1,145 @@
+import math
+import time
+import random
+
+from bisect import bisect
+from itertools import accumulate, islice
+from datetime import datetime
+
+from flask_script import Command, Option
+
+from model import UserDAO, TweetDAO, BulkLoadDAO
+from service.id_generator import IdGenerator, MAX_WORKER_ID
+
+WORDS = [
+    'hello', 'world', 'flask', 'python', 'coffee', 'today', 'weather', 'music', 'movie', 'game',
+    '오늘', '날씨', '커피', '점심', '주말', '영화', '음악', '여행', '공부', '운동'
+]
+
+class DataGenerator:
+    '''
+    Seedable users, follow edges and tweets.
+    Lower user ids are more popular: they get more followers and tweet more (Zipf-like),
+    out-degrees follow a Pareto distribution and the tweet rate follows a daily cycle.
+    '''
+    def __init__(self, seed, num_users, first_user_id=1):
+        self.random = random.Random(seed)
+        self.num_users = num_users
+        self.first_user_id = first_user_id
+        self.popularity = list(accumulate(1 / rank ** 0.8 for rank in range(1, num_users + 1)))
+        self.hour_weights = list(accumulate(1 + 0.8 * math.cos(2 * math.pi * (hour - 21) / 24) for hour in range(24)))
+
+    def pick_user(self):
+        index = bisect(self.popularity, self.random.random() * self.popularity[-1])
+        return self.first_user_id + min(index, self.num_users - 1)
+
+    def users(self, hashed_password):
+        for user_id in range(self.first_user_id, self.first_user_id + self.num_users):
+            yield {
+                'id': user_id,
+                'name': f'user{user_id}',
+                'email': f'user{user_id}@example.com',
+                'profile': f'profile of user {user_id}',
+                'hashed_password': hashed_password
+            }
+
+    def follows(self, mean_follows):
+        # Pareto(1.5) has mean 3
+        for user_id in range(self.first_user_id, self.first_user_id + self.num_users):
+            num_follows = min(int(self.random.paretovariate(1.5) * mean_follows / 3), self.num_users - 1)
+            follow_ids = set()
+            while len(follow_ids) < num_follows:
+                follow_id = self.pick_user()
+                if follow_id != user_id:
+                    follow_ids.add(follow_id)
+            for follow_id in follow_ids:
+                yield {'user_id': user_id, 'follow': follow_id}
+
+    def tweets(self, num_tweets, days, id_generator):
+        # walk forward in time with exponential gaps scaled by the hour's weight,
+        # so tweets come out in time order and get increasing ids
+        end = time.time()
+        tweeted_at = end - days * 24 * 60 * 60
+        mean_gap = days * 24 * 60 * 60 / max(num_tweets, 1)
+        mean_weight = self.hour_weights[-1] / 24
+
+        for _ in range(num_tweets):
+            hour = datetime.fromtimestamp(tweeted_at).hour
+            hour_weight = self.hour_weights[hour] - (self.hour_weights[hour - 1] if hour else 0)
+            tweeted_at = min(tweeted_at + self.random.expovariate(1) * mean_gap * mean_weight / hour_weight, end)
+
+            words = self.random.choices(WORDS, k=self.random.randint(3, 12))
+            if self.random.random() < 0.2:
+                words.append('#' + self.random.choice(WORDS))
+            yield {
+                'id': id_generator.next_id(int(tweeted_at * 1000)),
+                'user_id': self.pick_user(),
+                'tweet': ' '.join(words),
+                'created_at': datetime.fromtimestamp(int(tweeted_at))
+            }
+
+class GenerateData(Command):
+    '''
+    Generate synthetic users, follows and tweets and bulk load them.
+    Rows are inserted in multi-row batches with unique and foreign key checks off,
+    and the secondary tweets indexes, the tweets foreign key and the counters are rebuilt
+    once after the load.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-u', '--users', dest='num_users', type=int, default=1000),
+            Option('-f', '--follows', dest='mean_follows', type=int, default=20),
+            Option('-t', '--tweets', dest='num_tweets', type=int, default=10000),
+            Option('-d', '--days', dest='days', type=int, default=30),
+            Option('-s', '--seed', dest='seed', type=int, default=0),
+            Option('-b', '--batch-size', dest='batch_size', type=int, default=5000),
+            Option('--keep-indexes', dest='keep_indexes', action='store_true', default=False)
+        ]
+
+    def run(self, num_users, mean_follows, num_tweets, days, seed, batch_size, keep_indexes):
+        # every generated user has the password 'password', hashed once
+        hashed_password = self.app.services.user_service.encrypt_password('password')
+
+        with self.app.database.connect() as connection:
+            bulk_load_dao = BulkLoadDAO(connection)
+            user_dao = UserDAO(connection)
+            tweet_dao = TweetDAO(connection)
+
+            generator = DataGenerator(seed, num_users, bulk_load_dao.get_max_user_id() + 1)
+
+            bulk_load_dao.set_checks(False)
+            if not keep_indexes:
+                bulk_load_dao.drop_tweets_indexes()
+            try:
+                self.load('users', generator.users(hashed_password), user_dao.insert_users, batch_size)
+                self.load('follows', generator.follows(mean_follows), user_dao.insert_follows, batch_size)
+                # the last worker id is kept for bulk loads, so ids never collide with live tweets
+                id_generator = IdGenerator(MAX_WORKER_ID)
+                self.load('tweets', generator.tweets(num_tweets, days, id_generator), tweet_dao.insert_tweets, batch_size)
+            finally:
+                if not keep_indexes:
+                    started_at = time.time()
+                    bulk_load_dao.add_tweets_indexes()
+                    print(f'tweets indexes rebuilt in {time.time() - started_at:.1f}s')
+                bulk_load_dao.set_checks(True)
+
+        # bulk inserts skip the counters
+        started_at = time.time()
+        repaired = self.app.services.counter_service.reconcile()
+        print(f'counters of {repaired} users rebuilt in {time.time() - started_at:.1f}s')
+
+    def load(self, name, rows, insert, batch_size):
+        started_at = time.time()
+        count = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            insert(batch)
+            count += len(batch)
+
+        elapsed = time.time() - started_at
+        print(f'{name}: {count} rows in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)')
@@ -0,0 +1,12 @@
+from flask_script import Command
+
+class PruneOutbox(Command):
+    '''
+    Delete outbox events older than OUTBOX_RETENTION_HOURS that every consumer has read.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def run(self):
+        deleted = self.app.services.outbox_relay.prune()
+        print(f'{deleted} events deleted')
@@ -0,0 +1,13 @@
+from flask_script import Command
+
+class DeleteUnusedPictures(Command):
+    '''
+    Delete stored profile pictures no user points to anymore.
+    Pictures newer than PROFILE_PICTURE_GC_GRACE_HOURS are kept, as their upload may still be completing.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def run(self):
+        deleted = self.app.services.user_service.delete_unused_profile_pictures()
+        print(f'{deleted} pictures deleted')
@@ -0,0 +1,110 @@
+import os
+import signal
+import socket
+import sys
+
+from flask_script import Command, Option
+
+from service.id_generator import MAX_WORKER_ID
+
+class PreforkServer(Command):
+    '''
+    Serve the app from N forked worker processes sharing one listening socket.
+    The app is created once in the master, so workers share it copy-on-write.
+    Workers that exit are restarted until the master gets SIGINT/SIGTERM.
+    '''
+    def __init__(self, app):
+        self.app = app
+        self.workers = {}
+        self.stopping = False
+
+    def get_options(self):
+        return [
+            Option('-h', '--host', dest='host', default='0.0.0.0'),
+            Option('-p', '--port', dest='port', type=int, default=5000),
+            Option('-w', '--workers', dest='num_workers', type=int, default=os.cpu_count())
+        ]
+
+    def run(self, host, port, num_workers):
+        # a worker id out of range would fail in the child, and be restarted forever
+        first_worker_id = self.app.config.get('WORKER_ID', 0)
+        if num_workers < 1:
+            self.app.logger.error('At least 1 worker is needed')
+            return 1
+        if not 0 <= first_worker_id <= MAX_WORKER_ID - num_workers + 1:
+            self.app.logger.error(
+                f'{num_workers} workers from WORKER_ID {first_worker_id} need worker ids '
+                f'{first_worker_id} to {first_worker_id + num_workers - 1}, ids go from 0 to {MAX_WORKER_ID}'
+            )
+            return 1
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(self.app.config.get('LISTEN_BACKLOG', 1024))
+        listener.setblocking(False)
+
+        # connections opened during app initialization must not be shared
+        self.app.database.dispose()
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker_id in range(num_workers):
+            self.spawn(listener, worker_id)
+        self.app.logger.info(f'Running {num_workers} workers on {host}:{port}')
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is not None and not self.stopping:
+                self.app.logger.warning(f'Worker {worker_id} (pid {pid}) exited with status {status}, restarting')
+                self.spawn(listener, worker_id)
+
+    def spawn(self, listener, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # every worker needs its own tweet id space: WORKER_ID, WORKER_ID + 1, ...
+            self.app.services.id_generator.set_worker_id(self.app.config.get('WORKER_ID', 0) + worker_id)
+            try:
+                self.serve(listener)
+            finally:
+                os._exit(1)
+        self.workers[pid] = worker_id
+
+    def serve(self, listener):
+        # the master's reactor (and its epoll fd) is shared with every child,
+        # so each worker installs its own before listening
+        sys.modules.pop('twisted.internet.reactor', None)
+        from twisted.internet import default
+        default.install()
+        from twisted.internet import reactor
+        from twisted.web.server import Site
+        from twisted.web.wsgi import WSGIResource
+        from flask_twisted.resource import WSGIRootResource
+        from view.stream import create_stream_resource
+        from view.timeline import create_timeline_resource
+
+        reactor.suggestThreadPoolSize(self.app.config['THREAD_POOL_SIZE'])
+        children = {b'stream': create_stream_resource(self.app)}
+        if self.app.config.get('TIMELINE_NONBLOCKING', True):
+            children[b'timeline'] = create_timeline_resource(self.app)
+        resource = WSGIRootResource(WSGIResource(reactor, reactor.getThreadPool(), self.app), children)
+        self.app.services.outbox_relay.start()
+        self.app.services.cache_warmer.start()
+        reactor.adoptStreamPort(listener.fileno(), socket.AF_INET, Site(resource))
+        reactor.run()
+        os._exit(0)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,17 @@
+import time
+import resource
+
+from flask_script import Command
+
+class BuildRecommendations(Command):
+    '''
+    Recompute "who to follow" for every user, clearing it for users without candidates.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def run(self):
+        started_at = time.time()
+        count = self.app.services.recommendation_service.build()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        print(f'recommendations for {count} users built in {time.time() - started_at:.1f}s, max RSS {max_rss} MB')
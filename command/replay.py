@@ -0,0 +1,154 @@
+import re
+import json
+import time
+import random
+import threading
+import urllib3
+
+from concurrent.futures import ThreadPoolExecutor
+from flask_script import Command, Option
+
+ID_SEGMENT = re.compile(r'/(\d+|[0-9a-f]{32})(?=/|$)')
+
+def get_endpoint(method, path):
+    return method + ' ' + ID_SEGMENT.sub('/<id>', path.split('?', 1)[0])
+
+def fill_body(shape):
+    if isinstance(shape, dict):
+        if set(shape) == {'$str'}:
+            return 'x' * shape['$str']
+        return {key: fill_body(value) for key, value in shape.items()}
+    if isinstance(shape, list):
+        return [fill_body(item) for item in shape]
+    return shape
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def is_error(status):
+    return status is None or status >= 500
+
+class ReplayTraffic(Command):
+    '''
+    Re-issue a captured traffic log against a test instance, on the captured schedule
+    sped up by --speed (0 for as fast as possible), and compare latencies and errors
+    per endpoint with the capture.
+    The test instance is expected to be filled by generate_data and to share JWT_SECRET_KEY.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get_options(self):
+        return [
+            Option('-i', '--input', dest='input_path', required=True),
+            Option('-t', '--target', dest='target', default='http://localhost:5000'),
+            Option('-s', '--speed', dest='speed', type=float, default=1.0),
+            Option('-c', '--concurrency', dest='concurrency', type=int, default=32),
+            Option('-n', '--limit', dest='limit', type=int, default=None),
+            Option('--seed', dest='seed', type=int, default=1),
+            Option('--timeout', dest='timeout', type=float, default=30)
+        ]
+
+    def run(self, input_path, target, speed, concurrency, limit, seed, timeout):
+        with open(input_path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        # event streams are open for as long as their client stayed, they aren't replayed
+        records = [record for record in records if not record['p'].startswith('/stream/timeline')]
+        # workers append to the log concurrently, so it's only roughly in order
+        records.sort(key=lambda record: record['t'])
+        records = records[:limit]
+        if not records:
+            print('nothing to replay')
+            return
+
+        requests = self.prepare(records, target.rstrip('/'), random.Random(seed))
+        http = urllib3.PoolManager(maxsize=concurrency, timeout=timeout, retries=False)
+        results = [None] * len(requests)
+        lag = [0.0]
+        lock = threading.Lock()
+
+        def send(index, scheduled_at):
+            method, url, body, headers = requests[index]
+            started_at = time.monotonic()
+            with lock:
+                lag[0] = max(lag[0], started_at - scheduled_at)
+            try:
+                status = http.request(method, url, body=body, headers=headers).status
+            except Exception:
+                # refused connections and timeouts count as errors
+                status = None
+            results[index] = (status, time.monotonic() - started_at)
+
+        first_t = records[0]['t']
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for index, record in enumerate(records):
+                scheduled_at = started_at + ((record['t'] - first_t) / speed if speed else 0)
+                delay = scheduled_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, index, scheduled_at)
+        elapsed = time.monotonic() - started_at
+
+        self.report(records, results)
+        print(f'{len(records)} requests in {elapsed:.1f}s ({len(records) / elapsed:.1f}/s), '
+              f'captured over {records[-1]["t"] - first_t:.1f}s, '
+              f'at most {lag[0] * 1000:.0f}ms behind schedule')
+
+    def prepare(self, records, target, rng):
+        # generated users all have the password 'password', logins go to users seen in the log
+        user_ids = sorted({record['u'] for record in records if record.get('u')}) or [1]
+        run_id = int(time.time())
+        tokens = {}
+
+        requests = []
+        for index, record in enumerate(records):
+            headers = {}
+            if 'u' in record:
+                user_id = record['u']
+                if user_id is not None and user_id not in tokens:
+                    tokens[user_id] = self.app.services.user_service.generate_access_token(user_id)
+                headers['Authorization'] = tokens.get(user_id, 'invalid')
+
+            body = None
+            if 'b' in record:
+                payload = fill_body(record['b'])
+                path = record['p'].split('?', 1)[0]
+                if path == '/login' and isinstance(payload, dict):
+                    # failed logins stay failed, with an unknown email
+                    if record.get('s') == 200:
+                        payload['email'] = f'user{rng.choice(user_ids)}@example.com'
+                        payload['password'] = 'password'
+                    else:
+                        payload['email'] = f'unknown{index}@example.com'
+                elif path == '/sign-up' and isinstance(payload, dict):
+                    payload['email'] = f'replay{run_id}-{index}@example.com'
+                body = json.dumps(payload).encode('utf-8')
+                headers['Content-Type'] = 'application/json'
+
+            requests.append((record['m'], target + record['p'], body, headers))
+        return requests
+
+    def report(self, records, results):
+        endpoints = {}
+        for record, (status, duration) in zip(records, results):
+            endpoint = endpoints.setdefault(get_endpoint(record['m'], record['p']), {
+                'captured': [], 'replayed': [], 'captured_errors': 0, 'replayed_errors': 0, 'mismatched': 0
+            })
+            endpoint['captured'].append(record['d'])
+            endpoint['replayed'].append(duration)
+            endpoint['captured_errors'] += is_error(record.get('s'))
+            endpoint['replayed_errors'] += is_error(status)
+            endpoint['mismatched'] += status != record.get('s')
+
+        print('latencies and error rates as captured>replayed')
+        print(f'{"endpoint":<40} {"count":>7} {"p50 ms":>15} {"p99 ms":>15} {"errors %":>13} {"status diff":>11}')
+        for name, endpoint in sorted(endpoints.items(), key=lambda item: -len(item[1]['captured'])):
+            count = len(endpoint['captured'])
+            p50 = f'{percentile(endpoint["captured"], 0.5) * 1000:.1f}>{percentile(endpoint["replayed"], 0.5) * 1000:.1f}'
+            p99 = f'{percentile(endpoint["captured"], 0.99) * 1000:.1f}>{percentile(endpoint["replayed"], 0.99) * 1000:.1f}'
+            errors = f'{endpoint["captured_errors"] * 100 / count:.1f}>{endpoint["replayed_errors"] * 100 / count:.1f}'
+            print(f'{name:<40} {count:>7} {p50:>15} {p99:>15} {errors:>13} {endpoint["mismatched"]:>11}')
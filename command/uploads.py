@@ -0,0 +1,12 @@
+from flask_script import Command
+
+class CleanUploads(Command):
+    '''
+    Delete staged profile picture uploads older than UPLOAD_TTL that were never completed.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def run(self):
+        deleted = self.app.services.upload_service.delete_expired_uploads()
+        print(f'{deleted} uploads deleted')
@@ -1,7 +1,15 @@
 from .user_dao import UserDAO
 from .tweet_dao import TweetDAO
+from .bulk_load_dao import BulkLoadDAO
+from .counter_dao import CounterDAO
+from .recommendation_dao import RecommendationDAO
+from .outbox_dao import OutboxDAO
 
 __all__ = [
     'UserDAO',
-    'TweetDAO'
+    'TweetDAO',
+    'BulkLoadDAO',
+    'CounterDAO',
+    'RecommendationDAO',
+    'OutboxDAO'
 ]
\ No newline at end of file
@@ -0,0 +1,64 @@
+from sqlalchemy import text
+
+class BulkLoadDAO:
+    '''
+    Session settings and index maintenance around bulk loads.
+    It should be created with a Connection, so the settings apply to the inserts that follow.
+    '''
+    def __init__(self, database):
+        self.database = database
+
+    def set_checks(self, enabled):
+        return self.database.execute(text("""
+            SET unique_checks = :enabled, foreign_key_checks = :enabled
+        """), {'enabled': 1 if enabled else 0})
+
+    def get_max_user_id(self):
+        row = self.database.execute(text("""
+            SELECT
+                MAX(id) AS max_id
+            FROM
+                users
+        """)).fetchone()
+
+        return row['max_id'] or 0
+
+    def count_tweets(self):
+        row = self.database.execute(text("""
+            SELECT
+                COUNT(*) AS count
+            FROM
+                tweets
+        """)).fetchone()
+
+        return row['count']
+
+    def drop_tweets_indexes(self):
+        # tweets_user_id_id is the index of the foreign key, which has to go first
+        self.database.execute(text("""
+            ALTER TABLE tweets
+                DROP FOREIGN KEY tweets_user_id_fkey
+        """))
+        return self.database.execute(text("""
+            ALTER TABLE tweets
+                DROP INDEX tweets_created_at,
+                DROP INDEX tweets_user_id_id,
+                DROP INDEX tweet_fulltext
+        """))
+
+    def add_tweets_indexes(self):
+        self.database.execute(text("""
+            ALTER TABLE tweets
+                ADD KEY tweets_created_at (created_at),
+                ADD KEY tweets_user_id_id (user_id, id)
+        """))
+        # added while foreign_key_checks is off, so the loaded rows aren't checked again
+        self.database.execute(text("""
+            ALTER TABLE tweets
+                ADD CONSTRAINT tweets_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id)
+        """))
+        # InnoDB builds one FULLTEXT index per statement
+        return self.database.execute(text("""
+            ALTER TABLE tweets
+                ADD FULLTEXT KEY tweet_fulltext (tweet) WITH PARSER ngram
+        """))
@@ -0,0 +1,151 @@
+import random
+
+from contextlib import contextmanager
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.dialects.mysql import insert
+
+from .tables import users_counters
+
+# each user's counters are spread over slots, so writes to a popular user don't wait on one row lock
+COUNTER_SLOTS = 8
+
+insert_counters = insert(users_counters).values(
+    user_id=bindparam('user_id'),
+    slot=bindparam('slot'),
+    followers=bindparam('followers'),
+    following=bindparam('following'),
+    tweets=bindparam('tweets')
+)
+UPDATE_COUNTERS = insert_counters.on_duplicate_key_update(
+    followers=users_counters.c.followers + insert_counters.inserted.followers,
+    following=users_counters.c.following + insert_counters.inserted.following,
+    tweets=users_counters.c.tweets + insert_counters.inserted.tweets
+)
+
+def update_counters(connection, deltas):
+    '''
+    Add deltas [{'user_id', 'followers', 'following', 'tweets'}] to random slots.
+    Call it with the connection of the transaction that changed the counted rows.
+    '''
+    # always lock rows in the same order to avoid deadlocks
+    deltas = sorted(deltas, key=lambda delta: delta['user_id'])
+    return connection.execute(UPDATE_COUNTERS, [dict({
+        'slot': random.randrange(COUNTER_SLOTS),
+        'followers': 0,
+        'following': 0,
+        'tweets': 0
+    }, **delta) for delta in deltas])
+
+class CounterDAO:
+    def __init__(self, database):
+        self.database = database
+
+    def get_counts(self, user_id):
+        return self.database.execute(text("""
+            SELECT
+                COALESCE(SUM(followers), 0) AS followers,
+                COALESCE(SUM(following), 0) AS following,
+                COALESCE(SUM(tweets), 0) AS tweets
+            FROM
+                users_counters
+            WHERE
+                user_id = :user_id
+        """), {'user_id': user_id}).fetchone()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        A CounterDAO whose statements run in one transaction, committed when the block ends.
+        '''
+        with self.database.begin() as connection:
+            yield CounterDAO(connection)
+
+    def get_user_ids(self, after_id, limit):
+        rows = self.database.execute(text("""
+            SELECT
+                id
+            FROM
+                users
+            WHERE
+                id > :after_id
+            ORDER BY
+                id
+            LIMIT :limit
+        """), {
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+        return [row['id'] for row in rows]
+
+    def lock_counts(self, user_ids):
+        # locks the users' counter rows, and the gaps where missing slots would be inserted
+        return self.database.execute(text("""
+            SELECT
+                user_id
+            FROM
+                users_counters
+            WHERE
+                user_id IN :user_ids
+            FOR UPDATE
+        """).bindparams(bindparam('user_ids', expanding=True)), {'user_ids': list(user_ids)}).fetchall()
+
+    def get_stored_counts(self, user_ids):
+        return self.database.execute(text("""
+            SELECT
+                user_id AS id,
+                SUM(followers) AS followers,
+                SUM(following) AS following,
+                SUM(tweets) AS tweets
+            FROM
+                users_counters
+            WHERE
+                user_id IN :user_ids
+            GROUP BY
+                user_id
+        """).bindparams(bindparam('user_ids', expanding=True)), {'user_ids': list(user_ids)}).fetchall()
+
+    def get_actual_counts(self, after_id, limit):
+        return self.database.execute(text("""
+            SELECT
+                u.id,
+                (SELECT COUNT(*) FROM users_follow_list WHERE follow_user_id = u.id) AS followers,
+                (SELECT COUNT(*) FROM users_follow_list WHERE user_id = u.id) AS following,
+                (SELECT COUNT(*) FROM tweets WHERE user_id = u.id)
+                    + COALESCE((SELECT tweets FROM users_archived_tweets WHERE user_id = u.id), 0) AS tweets
+            FROM
+                users AS u
+            WHERE
+                u.id > :after_id
+            ORDER BY
+                u.id
+            LIMIT :limit
+        """), {
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def reset_counts(self, counts):
+        # in its own transaction, or in the one of transaction()
+        with self.database.connect() as connection, connection.begin():
+            connection.execute(text("""
+                DELETE FROM users_counters
+                WHERE user_id = :user_id
+            """), {'user_id': counts['user_id']})
+
+            return connection.execute(text("""
+                INSERT INTO users_counters (
+                    user_id,
+                    slot,
+                    followers,
+                    following,
+                    tweets
+                ) VALUES (
+                    :user_id,
+                    0,
+                    :followers,
+                    :following,
+                    :tweets
+                )
+            """), counts)
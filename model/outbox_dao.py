@@ -0,0 +1,86 @@
+import json
+
+from sqlalchemy import select, func, text, bindparam
+from sqlalchemy.dialects.mysql import insert
+
+from .tables import outbox_events, outbox_checkpoints, with_compiled_cache
+
+INSERT_EVENTS = outbox_events.insert().values(
+    event_type=bindparam('event_type'),
+    payload=bindparam('payload')
+)
+
+SELECT_LAST_EVENT_ID = select([func.coalesce(func.max(outbox_events.c.id), 0)])
+
+SELECT_EVENTS_AFTER = select([
+    outbox_events.c.id,
+    outbox_events.c.event_type,
+    outbox_events.c.payload,
+    outbox_events.c.created_at
+]).where(
+    outbox_events.c.id > bindparam('after_id')
+).order_by(outbox_events.c.id).limit(bindparam('limit'))
+
+SELECT_CHECKPOINTS = select([
+    outbox_checkpoints.c.consumer,
+    outbox_checkpoints.c.event_id
+]).where(outbox_checkpoints.c.consumer.in_(bindparam('consumers', expanding=True)))
+
+insert_checkpoint = insert(outbox_checkpoints).values(
+    consumer=bindparam('consumer'),
+    event_id=bindparam('event_id')
+)
+SAVE_CHECKPOINT = insert_checkpoint.on_duplicate_key_update(event_id=insert_checkpoint.inserted.event_id)
+
+# Core has no DELETE ... LIMIT for MySQL
+DELETE_EVENTS = text("""
+    DELETE FROM outbox_events
+    WHERE id <= :max_id AND created_at < :before
+    LIMIT :limit
+""")
+
+def add_events(connection, events):
+    '''
+    Append events [(event_type, payload)] to the outbox.
+    Call it with the connection of the transaction that made the change, so an event
+    is recorded exactly when its change commits.
+    '''
+    return connection.execute(INSERT_EVENTS, [{
+        'event_type': event_type,
+        'payload': json.dumps(payload)
+    } for event_type, payload in events])
+
+class OutboxDAO:
+    def __init__(self, database):
+        self.database = with_compiled_cache(database)
+
+    def get_last_event_id(self):
+        return self.database.execute(SELECT_LAST_EVENT_ID).scalar()
+
+    def get_events_after(self, after_id, limit):
+        return [{
+            'id': row['id'],
+            'type': row['event_type'],
+            'payload': json.loads(row['payload']),
+            'created_at': row['created_at']
+        } for row in self.database.execute(SELECT_EVENTS_AFTER, {
+            'after_id': after_id,
+            'limit': limit
+        })]
+
+    def get_checkpoints(self, consumers):
+        rows = self.database.execute(SELECT_CHECKPOINTS, {'consumers': list(consumers)})
+        return {row['consumer']: row['event_id'] for row in rows}
+
+    def save_checkpoint(self, consumer, event_id):
+        return self.database.execute(SAVE_CHECKPOINT, {
+            'consumer': consumer,
+            'event_id': event_id
+        })
+
+    def delete_events(self, max_id, before, limit):
+        return self.database.execute(DELETE_EVENTS, {
+            'max_id': max_id,
+            'before': before,
+            'limit': limit
+        })
@@ -0,0 +1,65 @@
+from sqlalchemy import text, bindparam
+
+class RecommendationDAO:
+    def __init__(self, database):
+        self.database = database
+
+    def replace_recommendations(self, user_ids, recommendations):
+        with self.database.begin() as connection:
+            connection.execute(text("""
+                DELETE FROM users_recommendations
+                WHERE user_id IN :user_ids
+            """).bindparams(bindparam('user_ids', expanding=True)), {'user_ids': list(user_ids)})
+
+            if recommendations:
+                connection.execute(text("""
+                    INSERT INTO users_recommendations (
+                        user_id,
+                        position,
+                        recommended_user_id,
+                        score
+                    ) VALUES (
+                        :user_id,
+                        :position,
+                        :recommended_user_id,
+                        :score
+                    )
+                """), recommendations)
+
+    def get_candidates(self, first_user_id, last_user_id):
+        # users followed by followings of users in the id range, not followed yet, scored by how many link to them
+        return self.database.execute(text("""
+            SELECT
+                f1.user_id,
+                f2.follow_user_id AS recommended_user_id,
+                COUNT(*) AS score
+            FROM
+                users_follow_list AS f1
+                JOIN users_follow_list AS f2 ON f2.user_id = f1.follow_user_id
+                LEFT JOIN users_follow_list AS f3 ON f3.user_id = f1.user_id AND f3.follow_user_id = f2.follow_user_id
+            WHERE
+                f1.user_id BETWEEN :first_user_id AND :last_user_id
+                AND f2.follow_user_id != f1.user_id
+                AND f3.user_id IS NULL
+            GROUP BY
+                f1.user_id,
+                f2.follow_user_id
+            ORDER BY
+                f1.user_id
+        """), {
+            'first_user_id': first_user_id,
+            'last_user_id': last_user_id
+        }).fetchall()
+
+    def get_recommendations(self, user_id):
+        return self.database.execute(text("""
+            SELECT
+                recommended_user_id,
+                score
+            FROM
+                users_recommendations
+            WHERE
+                user_id = :user_id
+            ORDER BY
+                position
+        """), {'user_id': user_id}).fetchall()
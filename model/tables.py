@@ -0,0 +1,78 @@
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, SmallInteger, String, Text, TIMESTAMP
+
+# mirrors DDL.sql
+metadata = MetaData()
+
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('email', String(255), nullable=False),
+    Column('hashed_password', String(255), nullable=False),
+    Column('profile', String(200)),
+    Column('profile_picture', String(200)),
+    Column('created_at', TIMESTAMP, nullable=False),
+    Column('updated_at', TIMESTAMP)
+)
+
+users_follow_list = Table(
+    'users_follow_list', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('follow_user_id', Integer, primary_key=True),
+    Column('created_at', TIMESTAMP, nullable=False)
+)
+
+tweets = Table(
+    'tweets', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('user_id', Integer, nullable=False),
+    Column('tweet', String(300), nullable=False),
+    Column('created_at', TIMESTAMP, nullable=False)
+)
+
+users_counters = Table(
+    'users_counters', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('slot', SmallInteger, primary_key=True),
+    Column('followers', Integer, nullable=False),
+    Column('following', Integer, nullable=False),
+    Column('tweets', Integer, nullable=False)
+)
+
+# tweets moved to the archive per user, so they are still counted
+users_archived_tweets = Table(
+    'users_archived_tweets', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('tweets', Integer, nullable=False)
+)
+
+outbox_events = Table(
+    'outbox_events', metadata,
+    Column('id', BigInteger, primary_key=True),
+    Column('event_type', String(50), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', TIMESTAMP, nullable=False)
+)
+
+outbox_checkpoints = Table(
+    'outbox_checkpoints', metadata,
+    Column('consumer', String(100), primary_key=True),
+    Column('event_id', BigInteger, nullable=False),
+    Column('updated_at', TIMESTAMP)
+)
+
+# statements are module level constants, so compiling each of them once per dialect is enough
+compiled_cache = {}
+
+def with_compiled_cache(database):
+    return database.execution_options(compiled_cache=compiled_cache)
+
+# MySQL interrupts a SELECT running longer than its MAX_EXECUTION_TIME hint,
+# one variant per timeout is kept so each of them is compiled once too
+timed_statements = {}
+
+def with_max_execution_time(statement, timeout):
+    key = (statement, timeout)
+    if key not in timed_statements:
+        timed_statements[key] = statement.prefix_with(f'/*+ MAX_EXECUTION_TIME({int(timeout * 1000)}) */')
+    return timed_statements[key]
@@ -1,36 +1,202 @@
-from sqlalchemy import text
+from collections import Counter
+
+from sqlalchemy import select, and_, or_, func, text, bindparam
+from sqlalchemy.dialects.mysql import insert
+
+from .tables import tweets, users_follow_list, users_archived_tweets, with_compiled_cache, with_max_execution_time
+from .counter_dao import update_counters
+from .outbox_dao import add_events
+
+MAX_TWEET_ID = (1 << 63) - 1
+
+TWEET_COLUMNS = [
+    tweets.c.id,
+    tweets.c.user_id,
+    tweets.c.tweet,
+    tweets.c.created_at
+]
+
+INSERT_TWEET = tweets.insert().values(
+    id=bindparam('id'),
+    user_id=bindparam('user_id'),
+    tweet=bindparam('tweet')
+)
+
+INSERT_TWEETS = tweets.insert().values(
+    id=bindparam('id'),
+    user_id=bindparam('user_id'),
+    tweet=bindparam('tweet'),
+    created_at=bindparam('created_at')
+)
+
+# own tweets and tweets of followed users, each once however many followers their author has
+timeline_user_id = bindparam('user_id')
+TIMELINE_TWEETS = and_(
+    or_(
+        tweets.c.user_id == timeline_user_id,
+        tweets.c.user_id.in_(select([users_follow_list.c.follow_user_id]).where(
+            users_follow_list.c.user_id == timeline_user_id
+        ))
+    ),
+    tweets.c.id >= bindparam('since_id'),
+    tweets.c.id < bindparam('before_id')
+)
+SELECT_TIMELINE = select(TWEET_COLUMNS).where(TIMELINE_TWEETS).order_by(tweets.c.id.desc()).limit(bindparam('limit'))
+
+# the oldest first, for clients catching up from since_id
+SELECT_TIMELINE_OLDEST_FIRST = select(TWEET_COLUMNS).where(TIMELINE_TWEETS).order_by(tweets.c.id).limit(bindparam('limit'))
+
+# users whose tweets are the newest
+SELECT_ACTIVE_USER_IDS = select([tweets.c.user_id]).where(
+    tweets.c.id >= bindparam('since_id')
+).group_by(tweets.c.user_id).order_by(func.max(tweets.c.id).desc()).limit(bindparam('limit'))
+
+# newest first, in keyset batches below the last id read
+SELECT_TWEETS_OF_USERS_SINCE = select(TWEET_COLUMNS).where(and_(
+    tweets.c.user_id.in_(bindparam('user_ids', expanding=True)),
+    tweets.c.id >= bindparam('since_id'),
+    tweets.c.id < bindparam('before_id')
+)).order_by(tweets.c.id.desc()).limit(bindparam('limit'))
+
+SELECT_USER_TWEETS = select([
+    tweets.c.id,
+    tweets.c.tweet,
+    tweets.c.created_at
+]).where(and_(
+    tweets.c.user_id == bindparam('user_id'),
+    tweets.c.id > bindparam('after_id')
+)).order_by(tweets.c.id).limit(bindparam('limit'))
+
+SEARCH_TWEETS = select(TWEET_COLUMNS).where(
+    text("MATCH (tweets.tweet) AGAINST (:query IN BOOLEAN MODE)")
+).order_by(tweets.c.id.desc()).limit(bindparam('limit'))
+
+# keyset on (created_at, id), the order of tweets_created_at
+hashtag_since = bindparam('since')
+SELECT_HASHTAG_TWEETS_SINCE = select(TWEET_COLUMNS).where(and_(
+    or_(
+        tweets.c.created_at > hashtag_since,
+        and_(tweets.c.created_at == hashtag_since, tweets.c.id > bindparam('after_id'))
+    ),
+    tweets.c.tweet.like('%#%')
+)).order_by(tweets.c.created_at, tweets.c.id).limit(bindparam('limit'))
+
+# keyset on (created_at, id), the order of tweets_created_at
+archive_after = bindparam('after_created_at')
+SELECT_TWEETS_BEFORE = select(TWEET_COLUMNS).where(and_(
+    tweets.c.created_at < bindparam('before'),
+    or_(
+        tweets.c.created_at > archive_after,
+        and_(tweets.c.created_at == archive_after, tweets.c.id > bindparam('after_id'))
+    )
+)).order_by(tweets.c.created_at, tweets.c.id).limit(bindparam('limit'))
+
+# the deleted rows are read first so their users' archived counts can be added
+SELECT_TWEETS_TO_DELETE = select([tweets.c.id, tweets.c.user_id]).where(and_(
+    tweets.c.created_at < bindparam('before'),
+    tweets.c.id <= bindparam('max_id')
+)).order_by(tweets.c.id).limit(bindparam('limit')).with_for_update()
+
+DELETE_TWEETS = tweets.delete().where(tweets.c.id.in_(bindparam('ids', expanding=True)))
+
+insert_archived_tweets = insert(users_archived_tweets).values(
+    user_id=bindparam('user_id'),
+    tweets=bindparam('tweets')
+)
+ADD_ARCHIVED_TWEETS = insert_archived_tweets.on_duplicate_key_update(
+    tweets=users_archived_tweets.c.tweets + insert_archived_tweets.inserted.tweets
+)
 
 class TweetDAO:
     def __init__(self, database):
-        self.database = database
-
-    def insert_tweet(self, user_id, tweet):
-        return self.database.execute(text("""
-            INSERT INTO tweets (
-                user_id,
-                tweet
-            ) VALUES (
-                :user_id,
-                :tweet
-            )
-        """), {
+        self.database = with_compiled_cache(database)
+
+    def insert_tweet(self, tweet_id, user_id, tweet):
+        with self.database.begin() as connection:
+            result = connection.execute(INSERT_TWEET, {
+                'id': tweet_id,
+                'user_id': user_id,
+                'tweet': tweet
+            })
+            update_counters(connection, [{'user_id': user_id, 'tweets': 1}])
+            add_events(connection, [('tweet_created', {
+                'id': tweet_id,
+                'user_id': user_id,
+                'tweet': tweet
+            })])
+            return result
+
+    def insert_tweets(self, new_tweets):
+        return self.database.execute(INSERT_TWEETS, new_tweets)
+
+    def get_timeline(self, user_id, limit, since_id=0, before_id=None, timeout=None, oldest_first=False):
+        statement = SELECT_TIMELINE_OLDEST_FIRST if oldest_first else SELECT_TIMELINE
+        if timeout is not None:
+            statement = with_max_execution_time(statement, timeout)
+        return self.database.execute(statement, {
             'user_id': user_id,
-            'tweet': tweet
+            'limit': limit,
+            'since_id': since_id,
+            'before_id': before_id or MAX_TWEET_ID
+        })
+
+    def get_active_user_ids(self, since_id, limit):
+        rows = self.database.execute(SELECT_ACTIVE_USER_IDS, {
+            'since_id': since_id,
+            'limit': limit
         })
+        return [row['user_id'] for row in rows]
+
+    def get_tweets_of_users_since(self, user_ids, since_id, before_id, limit):
+        return self.database.execute(SELECT_TWEETS_OF_USERS_SINCE, {
+            'user_ids': list(user_ids),
+            'since_id': since_id,
+            'before_id': before_id or MAX_TWEET_ID,
+            'limit': limit
+        }).fetchall()
+
+    def get_user_tweets(self, user_id, after_id, limit):
+        return self.database.execute(SELECT_USER_TWEETS, {
+            'user_id': user_id,
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def search_tweets(self, query, limit):
+        return self.database.execute(SEARCH_TWEETS, {
+            'query': query,
+            'limit': limit
+        })
+
+    def get_hashtag_tweets_since(self, since, after_id, limit):
+        return self.database.execute(SELECT_HASHTAG_TWEETS_SINCE, {
+            'since': since,
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def get_tweets_before(self, before, after_created_at, after_id, limit):
+        return self.database.execute(SELECT_TWEETS_BEFORE, {
+            'before': before,
+            'after_created_at': after_created_at,
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def delete_tweets_before(self, before, max_id, limit):
+        # archived tweets still count for their users, so they are added in the same transaction
+        with self.database.begin() as connection:
+            rows = connection.execute(SELECT_TWEETS_TO_DELETE, {
+                'before': before,
+                'max_id': max_id,
+                'limit': limit
+            }).fetchall()
+            if not rows:
+                return 0
 
-    def get_timeline(self, user_id):
-        return self.database.execute(text("""
-            SELECT
-                t.user_id,
-                t.tweet,
-                t.created_at
-            FROM 
-                tweets AS t
-                LEFT OUTER JOIN users_follow_list AS ufl 
-                ON t.user_id = ufl.follow_user_id
-            WHERE
-                ufl.user_id = :user_id
-                OR t.user_id = :user_id
-            ORDER BY
-                t.created_at DESC
-        """), {'user_id': user_id})
\ No newline at end of file
+            connection.execute(DELETE_TWEETS, {'ids': [row['id'] for row in rows]})
+            archived = Counter(row['user_id'] for row in rows)
+            connection.execute(ADD_ARCHIVED_TWEETS, [
+                {'user_id': user_id, 'tweets': count} for user_id, count in sorted(archived.items())
+            ])
+            return len(rows)
@@ -1,85 +1,200 @@
-from sqlalchemy import text
+from sqlalchemy import select, and_, bindparam
+
+from .tables import users, users_follow_list, with_compiled_cache
+from .counter_dao import update_counters
+from .outbox_dao import add_events
+
+# created_at and updated_at are never read
+USER_COLUMNS = [
+    users.c.id,
+    users.c.name,
+    users.c.email,
+    users.c.profile,
+    users.c.profile_picture,
+    users.c.hashed_password
+]
+
+INSERT_USER = users.insert().values(
+    name=bindparam('name'),
+    email=bindparam('email'),
+    profile=bindparam('profile'),
+    hashed_password=bindparam('password')
+)
+
+INSERT_USERS = users.insert().values(
+    id=bindparam('id'),
+    name=bindparam('name'),
+    email=bindparam('email'),
+    profile=bindparam('profile'),
+    hashed_password=bindparam('hashed_password')
+)
+
+SELECT_USER_BY_ID = select(USER_COLUMNS).where(users.c.id == bindparam('user_id'))
+
+SELECT_USER_BY_EMAIL = select(USER_COLUMNS).where(users.c.email == bindparam('email'))
+
+SELECT_USERS_BY_IDS = select(USER_COLUMNS).where(users.c.id.in_(bindparam('user_ids', expanding=True)))
+
+SELECT_EMAILS = select([
+    users.c.id,
+    users.c.email
+]).where(users.c.id > bindparam('after_id')).order_by(users.c.id).limit(bindparam('limit'))
+
+INSERT_FOLLOW = users_follow_list.insert().values(
+    user_id=bindparam('user_id'),
+    follow_user_id=bindparam('follow')
+)
+
+DELETE_FOLLOW = users_follow_list.delete().where(and_(
+    users_follow_list.c.user_id == bindparam('user_id'),
+    users_follow_list.c.follow_user_id == bindparam('unfollow')
+))
+
+SELECT_FOLLOWING = select([
+    users_follow_list.c.follow_user_id.label('id'),
+    users_follow_list.c.created_at
+]).where(and_(
+    users_follow_list.c.user_id == bindparam('user_id'),
+    users_follow_list.c.follow_user_id > bindparam('after_id')
+)).order_by(users_follow_list.c.follow_user_id).limit(bindparam('limit'))
+
+SELECT_FOLLOWERS = select([
+    users_follow_list.c.user_id.label('id'),
+    users_follow_list.c.created_at
+]).where(and_(
+    users_follow_list.c.follow_user_id == bindparam('user_id'),
+    users_follow_list.c.user_id > bindparam('after_id')
+)).order_by(users_follow_list.c.user_id).limit(bindparam('limit'))
+
+SELECT_FOLLOWING_OF_USERS = select([
+    users_follow_list.c.user_id,
+    users_follow_list.c.follow_user_id
+]).where(users_follow_list.c.user_id.in_(bindparam('user_ids', expanding=True)))
+
+SELECT_USER_IDS = select([
+    users.c.id
+]).where(users.c.id > bindparam('after_id')).order_by(users.c.id).limit(bindparam('limit'))
+
+# the old hash guards against overwriting a password changed in the meantime
+UPDATE_PASSWORD = users.update().where(and_(
+    users.c.id == bindparam('user_id'),
+    users.c.hashed_password == bindparam('old_hashed_password')
+)).values(hashed_password=bindparam('new_hashed_password'))
+
+UPDATE_PROFILE_PICTURE = users.update().where(
+    users.c.id == bindparam('user_id')
+).values(profile_picture=bindparam('image_url'))
+
+SELECT_PROFILE_PICTURE = select([users.c.profile_picture]).where(users.c.id == bindparam('user_id'))
+
+SELECT_USED_PROFILE_PICTURES = select([users.c.profile_picture]).where(
+    users.c.profile_picture.in_(bindparam('image_urls', expanding=True))
+).distinct()
 
 class UserDAO:
     def __init__(self, database):
-        self.database = database
+        self.database = with_compiled_cache(database)
 
     def insert_user(self, new_user):
-        return self.database.execute(text("""
-            INSERT INTO users (
-                name,
-                email,
-                profile,
-                hashed_password
-            ) VALUES (
-                :name,
-                :email,
-                :profile,
-                :password
-            )
-        """), new_user)
+        with self.database.begin() as connection:
+            result = connection.execute(INSERT_USER, {
+                'name': new_user['name'],
+                'email': new_user['email'],
+                'profile': new_user['profile'],
+                'password': new_user['password']
+            })
+            add_events(connection, [('user_created', {'id': result.lastrowid, 'email': new_user['email']})])
+            return result
+
+    def insert_users(self, new_users):
+        return self.database.execute(INSERT_USERS, new_users)
 
     def get_user_by_id(self, created_user_id):
-        return self.database.execute(text("""
-            SELECT
-                *
-            FROM
-                users
-            WHERE
-                id = :user_id
-            """), {'user_id': created_user_id}).fetchone()
+        return self.database.execute(SELECT_USER_BY_ID, {'user_id': created_user_id}).fetchone()
 
     def get_user_by_email(self, email):
-        return self.database.execute(text("""
-            SELECT
-                *
-            FROM
-                users
-            WHERE
-                email = :email
-        """), {'email': email}).fetchone()
+        return self.database.execute(SELECT_USER_BY_EMAIL, {'email': email}).fetchone()
+
+    def get_users_by_ids(self, user_ids):
+        return self.database.execute(SELECT_USERS_BY_IDS, {'user_ids': list(user_ids)}).fetchall()
+
+    def get_emails(self, after_id, limit):
+        return self.database.execute(SELECT_EMAILS, {
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
 
     def insert_follow(self, user_id, follow_id):
-        return self.database.execute(text("""
-            INSERT INTO users_follow_list (
-                user_id,
-                follow_user_id
-            ) VALUES (
-                :user_id,
-                :follow
-            )
-        """), {
-            'user_id': user_id,
-            'follow': follow_id
-        })
+        with self.database.begin() as connection:
+            result = connection.execute(INSERT_FOLLOW, {
+                'user_id': user_id,
+                'follow': follow_id
+            })
+            update_counters(connection, [
+                {'user_id': user_id, 'following': 1},
+                {'user_id': follow_id, 'followers': 1}
+            ])
+            add_events(connection, [('follow', {'user_id': user_id, 'follow_id': follow_id})])
+            return result
+
+    def insert_follows(self, follows):
+        return self.database.execute(INSERT_FOLLOW, follows)
 
     def delete_follow(self, user_id, unfollow_id):
-        return self.database.execute(text("""
-            DELETE FROM users_follow_list
-            WHERE user_id=:user_id AND follow_user_id=:unfollow
-        """), {
+        with self.database.begin() as connection:
+            result = connection.execute(DELETE_FOLLOW, {
+                'user_id': user_id,
+                'unfollow': unfollow_id
+            })
+            if result.rowcount:
+                update_counters(connection, [
+                    {'user_id': user_id, 'following': -1},
+                    {'user_id': unfollow_id, 'followers': -1}
+                ])
+                add_events(connection, [('unfollow', {'user_id': user_id, 'unfollow_id': unfollow_id})])
+            return result
+
+    def get_following(self, user_id, after_id, limit):
+        return self.database.execute(SELECT_FOLLOWING, {
             'user_id': user_id,
-            'unfollow': unfollow_id
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def get_followers(self, user_id, after_id, limit):
+        return self.database.execute(SELECT_FOLLOWERS, {
+            'user_id': user_id,
+            'after_id': after_id,
+            'limit': limit
+        }).fetchall()
+
+    def get_following_of_users(self, user_ids):
+        return self.database.execute(SELECT_FOLLOWING_OF_USERS, {'user_ids': list(user_ids)}).fetchall()
+
+    def get_user_ids(self, after_id, limit):
+        return [row['id'] for row in self.database.execute(SELECT_USER_IDS, {
+            'after_id': after_id,
+            'limit': limit
+        })]
+
+    def update_password(self, user_id, old_hashed_password, new_hashed_password):
+        return self.database.execute(UPDATE_PASSWORD, {
+            'user_id': user_id,
+            'old_hashed_password': old_hashed_password,
+            'new_hashed_password': new_hashed_password
         })
 
     def update_profile_picture(self, image_url, user_id):
-        return self.database.execute(text("""
-            UPDATE users
-            SET profile_picture = :image_url
-            WHERE id = :user_id
-        """), {
+        return self.database.execute(UPDATE_PROFILE_PICTURE, {
             'user_id': user_id,
             'image_url': image_url
         })
 
     def get_profile_picture(self, user_id):
-        row = self.database.execute(text("""
-            SELECT
-                profile_picture
-            FROM
-                users
-            WHERE
-                id = :user_id
-        """), {'user_id': user_id}).fetchone()
-
-        return row['profile_picture'] if row else None
\ No newline at end of file
+        row = self.database.execute(SELECT_PROFILE_PICTURE, {'user_id': user_id}).fetchone()
+
+        return row['profile_picture'] if row else None
+
+    def get_used_profile_pictures(self, image_urls):
+        rows = self.database.execute(SELECT_USED_PROFILE_PICTURES, {'image_urls': list(image_urls)})
+        return {row['profile_picture'] for row in rows}
\ No newline at end of file
@@ -1,7 +1,30 @@
 from .user_service import UserService
-from .tweet_service import TweetService
+from .tweet_service import TweetService, TimelineUnavailable, StaleTimeline, PartialTimeline
+from .trend_service import TrendService
+from .archive_service import ArchiveService
+from .export_service import ExportService
+from .id_generator import IdGenerator
+from .counter_service import CounterService
+from .recommendation_service import RecommendationService
+from .timeline_broker import TimelineBroker
+from .outbox_relay import OutboxRelay
+from .upload_service import UploadService
+from .cache_warmer import CacheWarmer
 
 __all__ = [
     'UserService',
-    'TweetService'
+    'TweetService',
+    'TimelineUnavailable',
+    'StaleTimeline',
+    'PartialTimeline',
+    'TrendService',
+    'ArchiveService',
+    'ExportService',
+    'IdGenerator',
+    'CounterService',
+    'RecommendationService',
+    'TimelineBroker',
+    'OutboxRelay',
+    'UploadService',
+    'CacheWarmer'
 ]
\ No newline at end of file
@@ -0,0 +1,203 @@
+import os
+import re
+import gzip
+import json
+import heapq
+import shutil
+
+from datetime import datetime, timedelta
+
+# earlier than any tweet, where reading tweets in (created_at, id) order starts
+FIRST_CREATED_AT = datetime(1970, 1, 1)
+
+MONTH_PATTERN = re.compile(r'tweets-(\d{4}-\d{2})(?:\.ndjson\.gz)?')
+# <run>.<bucket>-<buckets>.ndjson.gz holds the users with user_id % buckets == bucket
+BUCKET_FILE_PATTERN = re.compile(r'\d+\.(\d+)-(\d+)\.ndjson\.gz')
+
+def sync_file(path):
+    # on disk before the file is renamed, so a crash can't leave a complete name on partial data
+    with open(path, 'rb') as written:
+        os.fsync(written.fileno())
+
+def read_user_tweets(archive_file, user_id):
+    # rows are sorted by (user_id, id), so reading stops past the user
+    with gzip.open(archive_file, 'rt', encoding='utf-8') as lines:
+        for line in lines:
+            tweet = json.loads(line)
+            if tweet['user_id'] > user_id:
+                return
+            if tweet['user_id'] == user_id:
+                yield tweet
+
+def read_unsorted_user_tweets(archive_file, user_id):
+    # files from before runs were split by user hold all users in archive order
+    with gzip.open(archive_file, 'rt', encoding='utf-8') as lines:
+        tweets = [tweet for tweet in map(json.loads, lines) if tweet['user_id'] == user_id]
+    yield from sorted(tweets, key=lambda tweet: tweet['id'])
+
+class ArchiveService:
+    '''
+    Cold tier of the tweets table.
+    Tweets older than TWEETS_HOT_DAYS are moved to gzipped NDJSON files, one per month,
+    archive run and bucket of ARCHIVE_USER_BUCKETS users, each sorted by (user_id, id),
+    written under a temporary name and renamed once complete.
+    A user's archived tweets are read from their bucket only, and streamed in id order.
+    '''
+    def __init__(self, tweet_dao, config):
+        self.tweet_dao = tweet_dao
+        self.archive_path = config.get('ARCHIVE_PATH', 'archive')
+        self.hot_days = config.get('TWEETS_HOT_DAYS', 180)
+        self.batch_size = config.get('ARCHIVE_BATCH_SIZE', 10000)
+        self.user_buckets = config.get('ARCHIVE_USER_BUCKETS', 64)
+
+    def get_month_path(self, month):
+        return os.path.join(self.archive_path, f'tweets-{month}')
+
+    def get_archive_files(self, month):
+        # tweets-<month>.ndjson.gz is the single file of a month from before runs had their own
+        legacy_file = os.path.join(self.archive_path, f'tweets-{month}.ndjson.gz')
+        archive_files = [legacy_file] if os.path.exists(legacy_file) else []
+        month_path = self.get_month_path(month)
+        if os.path.isdir(month_path):
+            archive_files += [
+                os.path.join(month_path, name) for name in sorted(os.listdir(month_path))
+                if name.endswith('.ndjson.gz')
+            ]
+        return archive_files
+
+    def get_months(self):
+        if not os.path.isdir(self.archive_path):
+            return []
+        return sorted({
+            MONTH_PATTERN.fullmatch(name).group(1) for name in os.listdir(self.archive_path)
+            if MONTH_PATTERN.fullmatch(name)
+        })
+
+    def archive(self, days=None):
+        before = datetime.now() - timedelta(days=self.hot_days if days is None else days)
+        run = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        self.remove_partial_files()
+        run_path = os.path.join(self.archive_path, f'.run-{run}')
+        os.makedirs(run_path)
+
+        archive_files = []
+        count = 0
+        max_id = None
+        try:
+            # rows are spilled to a file per month and user bucket, then each is sorted on its own,
+            # so memory holds a batch or one month of a bucket at most
+            spills = {}
+            for row in self.get_tweets_before(before):
+                key = (row['created_at'].strftime('%Y-%m'), row['user_id'] % self.user_buckets)
+                spills.setdefault(key, []).append(json.dumps({
+                    'id': row['id'],
+                    'user_id': row['user_id'],
+                    'tweet': row['tweet'],
+                    'created_at': row['created_at'].isoformat()
+                }, ensure_ascii=False) + '\n')
+                count += 1
+                max_id = row['id'] if max_id is None else max(max_id, row['id'])
+                if count % self.batch_size == 0:
+                    self.spill(run_path, spills)
+                    spills = {}
+            self.spill(run_path, spills)
+
+            for name in sorted(os.listdir(run_path)):
+                month, bucket, _ = name.split('.')
+                with open(os.path.join(run_path, name), encoding='utf-8') as lines:
+                    tweets = sorted(map(json.loads, lines), key=lambda tweet: (tweet['user_id'], tweet['id']))
+
+                os.makedirs(self.get_month_path(month), exist_ok=True)
+                archive_file = os.path.join(self.get_month_path(month), f'{run}.{bucket}-{self.user_buckets}.ndjson.gz')
+                archive_files.append(archive_file)
+                with gzip.open(archive_file + '.tmp', 'wt', encoding='utf-8') as gzip_file:
+                    for tweet in tweets:
+                        gzip_file.write(json.dumps(tweet, ensure_ascii=False) + '\n')
+                sync_file(archive_file + '.tmp')
+        except BaseException:
+            # a failed run leaves no file behind, and its rows stay in the tweets table
+            for archive_file in archive_files:
+                if os.path.exists(archive_file + '.tmp'):
+                    os.remove(archive_file + '.tmp')
+            raise
+        finally:
+            shutil.rmtree(run_path, ignore_errors=True)
+
+        for archive_file in archive_files:
+            os.replace(archive_file + '.tmp', archive_file)
+
+        # delete only the rows written above, once their files are in place
+        if max_id is not None:
+            while self.tweet_dao.delete_tweets_before(before, max_id, self.batch_size):
+                pass
+
+        return count
+
+    def spill(self, run_path, spills):
+        for (month, bucket), lines in spills.items():
+            with open(os.path.join(run_path, f'{month}.{bucket}.ndjson'), 'a', encoding='utf-8') as spill_file:
+                spill_file.writelines(lines)
+
+    def remove_partial_files(self):
+        # left by runs that were killed before they could clean up
+        if not os.path.isdir(self.archive_path):
+            return
+        for name in os.listdir(self.archive_path):
+            if name.startswith('.run-'):
+                shutil.rmtree(os.path.join(self.archive_path, name), ignore_errors=True)
+        for month in self.get_months():
+            month_path = self.get_month_path(month)
+            if os.path.isdir(month_path):
+                for name in os.listdir(month_path):
+                    if name.endswith('.tmp'):
+                        os.remove(os.path.join(month_path, name))
+
+    def get_tweets_before(self, before):
+        # in keyset batches, since mysql-connector buffers whole results
+        after_created_at, after_id = FIRST_CREATED_AT, 0
+        while True:
+            rows = self.tweet_dao.get_tweets_before(before, after_created_at, after_id, self.batch_size)
+            yield from rows
+            if len(rows) < self.batch_size:
+                return
+            after_created_at, after_id = rows[-1]['created_at'], rows[-1]['id']
+
+    def get_tweets(self, month, user_id=None):
+        if user_id is not None:
+            yield from self.get_month_user_tweets(month, user_id)
+            return
+
+        # a run interrupted before deleting rows archives them again on the next run
+        seen_ids = set()
+        for archive_file in self.get_archive_files(month):
+            with gzip.open(archive_file, 'rt', encoding='utf-8') as lines:
+                for line in lines:
+                    tweet = json.loads(line)
+                    if tweet['id'] not in seen_ids:
+                        seen_ids.add(tweet['id'])
+                        yield tweet
+
+    def get_month_user_tweets(self, month, user_id):
+        streams = []
+        for archive_file in self.get_archive_files(month):
+            match = BUCKET_FILE_PATTERN.fullmatch(os.path.basename(archive_file))
+            if match is None:
+                streams.append(read_unsorted_user_tweets(archive_file, user_id))
+            elif user_id % int(match.group(2)) == int(match.group(1)):
+                streams.append(read_user_tweets(archive_file, user_id))
+
+        # each file is in id order, runs of the month are merged, and repeats of
+        # rows archived again after an interrupted run are next to each other
+        last_id = None
+        for tweet in heapq.merge(*streams, key=lambda tweet: tweet['id']):
+            if tweet['id'] != last_id:
+                last_id = tweet['id']
+                yield tweet
+
+    def get_user_tweets(self, user_id, after_id=0):
+        # ids are time-sortable, so months come in id order, and archived tweets are older
+        # than hot ones, so their ids continue in the tweets table
+        for month in self.get_months():
+            for tweet in self.get_month_user_tweets(month, user_id):
+                if tweet['id'] > after_id:
+                    yield tweet
@@ -0,0 +1,56 @@
+import math
+import hashlib
+import threading
+
+class BloomFilter:
+    '''
+    Set membership in a fixed bit array: "no" is certain, "yes" is wrong at about
+    error_rate once capacity items are in, and more often past it.
+    Items can't be removed.
+    '''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # optimal sizes for capacity items at error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.negatives = 0
+
+    def positions(self, item):
+        # k positions from two halves of one digest (double hashing)
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self.positions(item)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        found = all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+        with self.lock:
+            self.lookups += 1
+            if not found:
+                self.negatives += 1
+        return found
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'count': self.count,
+            'hashes': self.hashes,
+            'memory_bytes': len(self.bits),
+            'error_rate': self.error_rate,
+            # expected false positive rate with the items added so far
+            'estimated_error_rate': (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes,
+            'lookups': self.lookups,
+            'negatives': self.negatives
+        }
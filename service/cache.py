@@ -0,0 +1,212 @@
+import time
+import mmap
+import pickle
+import struct
+import hashlib
+import threading
+import multiprocessing
+
+from collections import OrderedDict
+
+MISSING = object()
+
+# key hash, expires at, last used at, key length (0 for an empty slot), value length
+SLOT_HEADER = struct.Struct('<QddHI')
+
+def create_cache(config, max_size, ttl):
+    '''
+    A SharedCache when SHARED_CACHE is set, e.g. for runworkers, otherwise an LRUCache per process.
+    '''
+    if config.get('SHARED_CACHE', False):
+        return SharedCache(max_size, ttl, config.get('SHARED_CACHE_SLOT_SIZE', 1024))
+    return LRUCache(max_size, ttl)
+
+class LRUCache:
+    '''
+    Thread-safe LRU cache whose entries also expire after a TTL.
+    get returns MISSING for absent or expired keys, so None can be cached.
+    '''
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+class SharedCache:
+    '''
+    LRUCache's interface over anonymous shared memory, so processes forked after it is
+    created, e.g. the workers of runworkers, share entries and see each other's deletes.
+    Pickled keys and values are stored in fixed size slots. A key can only be in the
+    `ways` slots of its set, and the least recently used of them is replaced.
+    Entries larger than a slot aren't cached.
+    '''
+    def __init__(self, max_size, ttl, slot_size=1024, ways=4, num_locks=64):
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.ways = ways
+        self.num_sets = max(1, max_size // ways)
+        self.max_size = self.num_sets * ways
+        self.memory = mmap.mmap(-1, self.max_size * slot_size)
+        # process-shared locks, each guarding every num_locks-th set
+        self.locks = [multiprocessing.Lock() for _ in range(min(num_locks, self.num_sets))]
+
+        # counted per process, like LRUCache's
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.oversized = 0
+
+    def locate(self, key):
+        key_bytes = pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+        key_hash = int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), 'little')
+        set_index = key_hash % self.num_sets
+        return key_bytes, key_hash, set_index, self.locks[set_index % len(self.locks)]
+
+    def slots(self, set_index):
+        return range(set_index * self.ways, (set_index + 1) * self.ways)
+
+    def find(self, set_index, key_hash, key_bytes):
+        for slot in self.slots(set_index):
+            offset = slot * self.slot_size
+            header = SLOT_HEADER.unpack_from(self.memory, offset)
+            key_start = offset + SLOT_HEADER.size
+            if header[3] and header[0] == key_hash and self.memory[key_start:key_start + header[3]] == key_bytes:
+                return slot, header
+        return None, None
+
+    def count(self, name):
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        key_bytes, key_hash, set_index, lock = self.locate(key)
+        now = time.monotonic()
+        with lock:
+            slot, header = self.find(set_index, key_hash, key_bytes)
+            if slot is None or header[1] <= now:
+                if slot is not None:
+                    SLOT_HEADER.pack_into(self.memory, slot * self.slot_size, 0, 0, 0, 0, 0)
+                value_bytes = None
+            else:
+                offset = slot * self.slot_size
+                SLOT_HEADER.pack_into(self.memory, offset, key_hash, header[1], now, header[3], header[4])
+                value_start = offset + SLOT_HEADER.size + header[3]
+                value_bytes = self.memory[value_start:value_start + header[4]]
+
+        if value_bytes is None:
+            self.count('misses')
+            return MISSING
+        self.count('hits')
+        return pickle.loads(value_bytes)
+
+    def set(self, key, value, ttl=None):
+        key_bytes, key_hash, set_index, lock = self.locate(key)
+        value_bytes = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if SLOT_HEADER.size + len(key_bytes) + len(value_bytes) > self.slot_size:
+            # an older value must not outlive this one
+            self.delete(key)
+            self.count('oversized')
+            return
+
+        now = time.monotonic()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with lock:
+            slot, _ = self.find(set_index, key_hash, key_bytes)
+            if slot is None:
+                # an empty or expired slot, or else the least recently used one
+                headers = [(SLOT_HEADER.unpack_from(self.memory, slot * self.slot_size), slot) for slot in self.slots(set_index)]
+                free = [slot for header, slot in headers if not header[3] or header[1] <= now]
+                if free:
+                    slot = free[0]
+                else:
+                    slot = min(headers, key=lambda item: item[0][2])[1]
+                    self.count('evictions')
+
+            offset = slot * self.slot_size
+            SLOT_HEADER.pack_into(self.memory, offset, key_hash, expires_at, now, len(key_bytes), len(value_bytes))
+            key_start = offset + SLOT_HEADER.size
+            self.memory[key_start:key_start + len(key_bytes)] = key_bytes
+            self.memory[key_start + len(key_bytes):key_start + len(key_bytes) + len(value_bytes)] = value_bytes
+
+    def delete(self, key):
+        key_bytes, key_hash, set_index, lock = self.locate(key)
+        with lock:
+            slot, _ = self.find(set_index, key_hash, key_bytes)
+            if slot is not None:
+                SLOT_HEADER.pack_into(self.memory, slot * self.slot_size, 0, 0, 0, 0, 0)
+
+    def clear(self):
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            for slot in range(self.max_size):
+                SLOT_HEADER.pack_into(self.memory, slot * self.slot_size, 0, 0, 0, 0, 0)
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+    def stats(self):
+        now = time.monotonic()
+        size = 0
+        for slot in range(self.max_size):
+            _, expires_at, _, key_length, _ = SLOT_HEADER.unpack_from(self.memory, slot * self.slot_size)
+            size += bool(key_length) and expires_at > now
+        with self.stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'oversized': self.oversized,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'shared': True
+            }
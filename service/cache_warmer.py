@@ -0,0 +1,79 @@
+import time
+import threading
+
+class CacheWarmer:
+    '''
+    Fills the caches of a new worker before it reports healthy, so its first requests
+    don't all go to DB at once. The most recently active users are loaded in batches,
+    a few queries per batch, until they are all loaded or the time budget is spent.
+    The email filter is built from all users after that: sign-ups check DB until it
+    is ready, so it doesn't hold the worker back.
+    '''
+    def __init__(self, user_service, tweet_service, config):
+        self.user_service = user_service
+        self.tweet_service = tweet_service
+        self.max_users = config.get('WARMUP_USERS', 1000)
+        self.batch_size = config.get('WARMUP_BATCH_SIZE', 100)
+        self.time_budget = config.get('WARMUP_TIME_BUDGET', 30)
+
+        # idle until started, so commands and tests are never held back by it
+        self.state = 'idle'
+        self.emails = 0
+        self.users = 0
+        self.loaded_users = 0
+        self.timelines = 0
+        self.batches = 0
+        self.elapsed = 0.0
+        self.budget_exceeded = False
+        self.failed = False
+
+    @property
+    def ready(self):
+        return self.state != 'warming'
+
+    def start(self):
+        self.state = 'warming'
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        started_at = time.monotonic()
+        try:
+            user_ids = self.tweet_service.get_active_user_ids(self.max_users) if self.max_users else []
+            self.users = len(user_ids)
+            for offset in range(0, len(user_ids), self.batch_size):
+                if time.monotonic() - started_at > self.time_budget:
+                    self.budget_exceeded = True
+                    break
+                self.warm(user_ids[offset:offset + self.batch_size])
+                self.elapsed = time.monotonic() - started_at
+        except Exception:
+            # a cold cache is slower, not broken, so the worker goes healthy anyway
+            self.failed = True
+        finally:
+            self.elapsed = time.monotonic() - started_at
+            self.state = 'done'
+
+        try:
+            self.emails = self.user_service.build_email_filter()
+        except Exception:
+            self.failed = True
+
+    def warm(self, user_ids):
+        self.user_service.get_users_by_ids(user_ids)
+        following_ids = self.user_service.get_following_ids_of_users(user_ids)
+        self.timelines += self.tweet_service.warm_timelines(following_ids)
+        self.loaded_users += len(user_ids)
+        self.batches += 1
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'emails': self.emails,
+            'users': self.users,
+            'loaded_users': self.loaded_users,
+            'timelines': self.timelines,
+            'batches': self.batches,
+            'elapsed': self.elapsed,
+            'budget_exceeded': self.budget_exceeded,
+            'failed': self.failed
+        }
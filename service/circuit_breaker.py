@@ -0,0 +1,66 @@
+import time
+import threading
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    '''
+    Stops calling a failing dependency for a while, so callers fail at once instead of
+    each waiting for their own timeout. After failure_threshold failures in a row the
+    circuit opens; once reset_timeout seconds have passed, one trial call is let through
+    (half-open) and its outcome closes or opens the circuit again.
+    '''
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        self.opens = 0
+        self.rejected = 0
+
+    def call(self, fn):
+        self.before_call()
+        try:
+            result = fn()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return
+            # open, or half-open with the trial call still running
+            self.rejected += 1
+            raise CircuitOpenError('Circuit is open')
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opens += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opens': self.opens,
+                'rejected': self.rejected
+            }
@@ -0,0 +1,35 @@
+import hashlib
+
+from array import array
+
+class CountMinSketch:
+    '''
+    Approximate counts in a fixed depth x width table: an estimate is never below
+    the true count, and above it by at most about 2/width of the total, except with
+    probability about 1/2^depth.
+    Sketches of the same shape can be added to and subtracted from each other.
+    '''
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.counts = array('q', bytes(8 * width * depth))
+
+    def positions(self, item):
+        # one position per row from two halves of one digest (double hashing)
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        for position in self.positions(item):
+            self.counts[position] += count
+
+    def estimate(self, item):
+        return min(self.counts[position] for position in self.positions(item))
+
+    def subtract(self, other):
+        counts = self.counts
+        for position, count in enumerate(other.counts):
+            if count:
+                counts[position] -= count
@@ -0,0 +1,59 @@
+
+from .cache import create_cache, MISSING
+
+class CounterService:
+    def __init__(self, counter_dao, config):
+        self.counter_dao = counter_dao
+        self.batch_size = config.get('COUNTER_RECONCILE_BATCH_SIZE', 1000)
+        # counts of popular users are read far more often than they change,
+        # caching them lets them lag behind by up to the TTL, so it's off by default
+        cache_ttl = config.get('COUNTER_CACHE_TTL', 0)
+        self.cache = create_cache(config, config.get('COUNTER_CACHE_SIZE', 10000), cache_ttl) if cache_ttl else None
+
+    def get_counts(self, user_id):
+        if self.cache is not None:
+            counts = self.cache.get(user_id)
+            if counts is not MISSING:
+                return counts
+
+        row = self.counter_dao.get_counts(user_id)
+        counts = {
+            'followers': int(row['followers']),
+            'following': int(row['following']),
+            'tweets': int(row['tweets'])
+        }
+        if self.cache is not None:
+            self.cache.set(user_id, counts)
+        return counts
+
+    def get_cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+    def reconcile(self):
+        # compare counters with the counted rows batch by batch, and rewrite those that drifted.
+        # each batch locks its counters first, so updates can't land between counting and resetting
+        repaired = 0
+        after_id = 0
+        while True:
+            user_ids = self.counter_dao.get_user_ids(after_id, self.batch_size)
+            if not user_ids:
+                return repaired
+
+            with self.counter_dao.transaction() as counter_dao:
+                counter_dao.lock_counts(user_ids)
+                stored_counts = {row['id']: row for row in counter_dao.get_stored_counts(user_ids)}
+                for actual in counter_dao.get_actual_counts(after_id, self.batch_size):
+                    if actual['id'] > user_ids[-1]:
+                        # signed up after the batch was locked
+                        break
+                    stored = stored_counts.get(actual['id'])
+                    if any((int(stored[column]) if stored else 0) != actual[column] for column in ['followers', 'following', 'tweets']):
+                        counter_dao.reset_counts({
+                            'user_id': actual['id'],
+                            'followers': actual['followers'],
+                            'following': actual['following'],
+                            'tweets': actual['tweets']
+                        })
+                        repaired += 1
+
+            after_id = user_ids[-1]
@@ -0,0 +1,93 @@
+import io
+import csv
+import json
+import zlib
+
+EXPORT_FIELDS = ['type', 'id', 'tweet', 'created_at']
+
+class ExportService:
+    '''
+    Streams a user's tweets, followings and followers as records of EXPORT_FIELDS.
+    Tweets moved to the archive come first, a month at a time, then each section
+    is read in keyset batches, so memory stays constant, and
+    'type:id' of the last received record resumes an interrupted export.
+    '''
+    def __init__(self, user_dao, tweet_dao, config, archive_service=None):
+        self.archive_service = archive_service
+        self.sections = [
+            ('tweet', tweet_dao.get_user_tweets),
+            ('following', user_dao.get_following),
+            ('follower', user_dao.get_followers)
+        ]
+        self.batch_size = config.get('EXPORT_BATCH_SIZE', 1000)
+
+    def parse_cursor(self, after):
+        if not after:
+            return self.sections[0][0], 0
+
+        record_type, _, after_id = after.partition(':')
+        if record_type not in [section[0] for section in self.sections]:
+            raise ValueError(f'Unknown record type: {record_type}')
+        return record_type, int(after_id)
+
+    def export_records(self, user_id, after=None):
+        record_type, after_id = self.parse_cursor(after)
+        started = False
+
+        for section_type, get_rows in self.sections:
+            if section_type == record_type:
+                started = True
+            elif not started:
+                continue
+            else:
+                after_id = 0
+
+            if section_type == 'tweet' and self.archive_service is not None:
+                for tweet in self.archive_service.get_user_tweets(user_id, after_id):
+                    yield {
+                        'type': section_type,
+                        'id': tweet['id'],
+                        'tweet': tweet['tweet'],
+                        'created_at': tweet['created_at']
+                    }
+                    after_id = tweet['id']
+
+            while True:
+                rows = get_rows(user_id, after_id, self.batch_size)
+                for row in rows:
+                    yield {
+                        'type': section_type,
+                        'id': row['id'],
+                        'tweet': row['tweet'] if section_type == 'tweet' else None,
+                        'created_at': row['created_at'].isoformat()
+                    }
+                if len(rows) < self.batch_size:
+                    break
+                after_id = rows[-1]['id']
+
+    def to_ndjson(self, records):
+        # ids are exact in CSV, JSON readers may need them as strings
+        for record in records:
+            yield json.dumps(dict(record, id_str=str(record['id'])), ensure_ascii=False) + '\n'
+
+    def to_csv(self, records):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        for record in records:
+            writer.writerow(record)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    def gzip(self, chunks):
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk.encode('utf-8'))
+            if compressed:
+                yield compressed
+        yield compressor.flush()
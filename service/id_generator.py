@@ -0,0 +1,45 @@
+import time
+import threading
+
+# 2020-01-01 00:00:00 UTC in milliseconds
+EPOCH = 1577836800000
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+class IdGenerator:
+    '''
+    Snowflake-style 64-bit ids: milliseconds since EPOCH, worker id and a per-millisecond sequence.
+    Ids of one worker strictly increase, and ids of all workers sort by creation time.
+    '''
+    def __init__(self, worker_id):
+        self.set_worker_id(worker_id)
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def set_worker_id(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'Worker id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+
+    def next_id(self, timestamp=None):
+        with self.lock:
+            timestamp = int(time.time() * 1000) if timestamp is None else timestamp
+            # never go back in time, e.g. when the clock is adjusted
+            timestamp = max(timestamp, self.last_timestamp)
+
+            if timestamp == self.last_timestamp:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    timestamp += 1
+            else:
+                self.sequence = 0
+            self.last_timestamp = timestamp
+
+            return ((timestamp - EPOCH) << (WORKER_ID_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+    def id_from_time(self, created_at):
+        # the smallest id that can be generated at created_at
+        return max(int(created_at.timestamp() * 1000) - EPOCH, 0) << (WORKER_ID_BITS + SEQUENCE_BITS)
@@ -0,0 +1,126 @@
+import time
+import threading
+
+from datetime import datetime, timedelta
+
+class Consumer:
+    def __init__(self, name, handler, event_types, durable):
+        self.name = name
+        self.handler = handler
+        self.event_types = set(event_types) if event_types is not None else None
+        self.durable = durable
+        self.delivered = 0
+        self.failures = 0
+
+class OutboxRelay:
+    '''
+    Reads outbox events in batches and hands them to registered consumers, in order.
+    A consumer's checkpoint moves past an event only after its handler returned, so a
+    failing or interrupted consumer gets the event again: delivery is at-least-once.
+    Each consumer reads on from its own checkpoint, so a failing one holds back only itself.
+    Durable consumers keep their checkpoint in DB and resume from it. The others keep
+    in-memory state of one process, and start from the end of the log with the process.
+    Ids are taken before commit, so a missing id may still commit after later ones:
+    checkpoints stop at it until it shows up, or until it waited OUTBOX_GAP_TIMEOUT
+    and is taken for a rolled back transaction.
+    '''
+    def __init__(self, outbox_dao, config):
+        self.outbox_dao = outbox_dao
+        self.batch_size = config.get('OUTBOX_BATCH_SIZE', 1000)
+        self.interval = config.get('OUTBOX_RELAY_INTERVAL', 0.5)
+        self.retention = config.get('OUTBOX_RETENTION_HOURS', 24)
+        self.gap_timeout = config.get('OUTBOX_GAP_TIMEOUT', 10)
+
+        self.consumers = {}
+        self.checkpoints = {}
+        # {id of the event after a gap: when the gap was first seen}
+        self.gaps = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, handler, event_types=None, durable=False):
+        self.consumers[name] = Consumer(name, handler, event_types, durable)
+
+    def load_checkpoints(self):
+        last_event_id = self.outbox_dao.get_last_event_id()
+        durable_names = [name for name, consumer in self.consumers.items() if consumer.durable]
+        stored = self.outbox_dao.get_checkpoints(durable_names) if durable_names else {}
+        # new consumers only get events from now on
+        self.checkpoints = {name: stored.get(name, last_event_id) for name in self.consumers}
+
+    def run_once(self):
+        # returns the most events a consumer moved past, 0 once none of them can go on
+        with self.lock:
+            batches = {}
+            passed = 0
+            for consumer in self.consumers.values():
+                # consumers at the same checkpoint share one read
+                after_id = self.checkpoints[consumer.name]
+                if after_id not in batches:
+                    batches[after_id] = self.outbox_dao.get_events_after(after_id, self.batch_size)
+                passed = max(passed, self.deliver(consumer, batches[after_id]))
+            min_checkpoint = min(self.checkpoints.values(), default=0)
+            self.gaps = {event_id: seen_at for event_id, seen_at in self.gaps.items() if event_id > min_checkpoint}
+            return passed
+
+    def deliver(self, consumer, events):
+        checkpoint = self.checkpoints[consumer.name]
+        passed = 0
+        try:
+            for event in events:
+                if event['id'] != checkpoint + 1 and not self.gap_timed_out(event['id']):
+                    # an earlier event may still commit, later ones wait for it
+                    break
+                if consumer.event_types is None or event['type'] in consumer.event_types:
+                    consumer.handler(event)
+                    consumer.delivered += 1
+                checkpoint = event['id']
+                passed += 1
+        except Exception:
+            # retried from this event on the next run, other consumers go on
+            consumer.failures += 1
+        finally:
+            if checkpoint != self.checkpoints[consumer.name]:
+                self.checkpoints[consumer.name] = checkpoint
+                if consumer.durable:
+                    self.outbox_dao.save_checkpoint(consumer.name, checkpoint)
+        return passed
+
+    def gap_timed_out(self, event_id):
+        seen_at = self.gaps.setdefault(event_id, time.monotonic())
+        return time.monotonic() - seen_at >= self.gap_timeout
+
+    def prune(self):
+        # events every durable consumer has passed, and old enough for every process
+        with self.lock:
+            durable_checkpoints = [self.checkpoints[name] for name, consumer in self.consumers.items() if consumer.durable]
+        max_id = min(durable_checkpoints) if durable_checkpoints else self.outbox_dao.get_last_event_id()
+        before = datetime.now() - timedelta(hours=self.retention)
+
+        deleted = 0
+        while True:
+            count = self.outbox_dao.delete_events(max_id, before, self.batch_size).rowcount
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                # keep reading while a backlog is being consumed
+                if self.run_once():
+                    continue
+            except Exception:
+                # e.g. DB is unreachable, checkpoints are kept and the next run retries
+                pass
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self.lock:
+            return {name: {
+                'checkpoint': self.checkpoints.get(name),
+                'delivered': consumer.delivered,
+                'failures': consumer.failures
+            } for name, consumer in self.consumers.items()}
@@ -0,0 +1,52 @@
+import heapq
+
+from itertools import groupby
+
+class RecommendationService:
+    '''
+    "Who to follow" by friends of friends, computed offline.
+    DB joins and counts the candidates of a chunk of users at a time,
+    and the best ones of each user replace the stored recommendations.
+    '''
+    def __init__(self, user_dao, recommendation_dao, config):
+        self.user_dao = user_dao
+        self.recommendation_dao = recommendation_dao
+        self.size = config.get('RECOMMENDATION_SIZE', 10)
+        self.chunk_size = config.get('RECOMMENDATION_CHUNK_SIZE', 100)
+
+    def recommend(self, user_ids):
+        # {user_id: [(recommended_user_id, score)]} for ascending user_ids with candidates
+        rows = self.recommendation_dao.get_candidates(user_ids[0], user_ids[-1])
+        recommendations = {}
+        for user_id, candidates in groupby(rows, key=lambda row: row['user_id']):
+            best = heapq.nlargest(self.size, candidates, key=lambda row: (row['score'], -row['recommended_user_id']))
+            recommendations[user_id] = [(row['recommended_user_id'], row['score']) for row in best]
+        return recommendations
+
+    def build(self):
+        count, after_id = 0, 0
+        while True:
+            user_ids = self.user_dao.get_user_ids(after_id, self.chunk_size)
+            if not user_ids:
+                return count
+
+            candidates = self.recommend(user_ids)
+            recommendations = []
+            for user_id, recommended in candidates.items():
+                for position, (recommended_user_id, score) in enumerate(recommended):
+                    recommendations.append({
+                        'user_id': user_id,
+                        'position': position,
+                        'recommended_user_id': recommended_user_id,
+                        'score': score
+                    })
+            # every user of the chunk is replaced, which clears users left without candidates
+            self.recommendation_dao.replace_recommendations(user_ids, recommendations)
+            count += len(user_ids)
+            after_id = user_ids[-1]
+
+    def get_recommendations(self, user_id):
+        return [{
+            'user_id': row['recommended_user_id'],
+            'score': row['score']
+        } for row in self.recommendation_dao.get_recommendations(user_id)]
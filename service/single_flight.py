@@ -0,0 +1,55 @@
+import threading
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Runs one computation per key at a time.
+    Threads asking for a key that is already being computed wait for it and share its result.
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.executions = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executions += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            shared = self.requests - self.executions
+            return {
+                'requests': self.requests,
+                'executions': self.executions,
+                'shared': shared,
+                'in_flight': len(self.calls),
+                'coalescing_ratio': shared / self.requests if self.requests else 0.0
+            }
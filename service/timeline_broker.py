@@ -0,0 +1,107 @@
+import threading
+
+class Subscription:
+    __slots__ = ('user_id', 'following_ids', 'deliver')
+
+    def __init__(self, user_id, following_ids, deliver):
+        self.user_id = user_id
+        self.following_ids = following_ids
+        self.deliver = deliver
+
+class TimelineBroker:
+    '''
+    In-process pub/sub of new tweets, keyed by the follower who should see them.
+    Each open stream subscribes with its user's followings, and a published tweet is
+    handed to the subscriptions of everyone following its author, without touching DB.
+    Tweets and follows reach it as outbox events, so every worker sees those of all workers.
+    '''
+    def __init__(self):
+        # follower id -> subscriptions, author id -> follower ids with a subscription
+        self.subscriptions = {}
+        self.watchers = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, user_id, following_ids, deliver):
+        # users see their own tweets on their timeline too
+        subscription = Subscription(user_id, set(following_ids) | {user_id}, deliver)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+            for author_id in subscription.following_ids:
+                self.watchers.setdefault(author_id, set()).add(user_id)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if not subscriptions or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+            for author_id in subscription.following_ids:
+                self.unwatch(author_id, subscription.user_id)
+
+    def follow(self, user_id, follow_id):
+        with self.lock:
+            for subscription in self.subscriptions.get(user_id, ()):
+                subscription.following_ids.add(follow_id)
+            if user_id in self.subscriptions:
+                self.watchers.setdefault(follow_id, set()).add(user_id)
+
+    def unfollow(self, user_id, unfollow_id):
+        if user_id == unfollow_id:
+            return
+        with self.lock:
+            for subscription in self.subscriptions.get(user_id, ()):
+                subscription.following_ids.discard(unfollow_id)
+            self.unwatch(unfollow_id, user_id)
+
+    def unwatch(self, author_id, user_id):
+        # a follower stays a watcher while any of their subscriptions follows the author
+        if any(author_id in subscription.following_ids for subscription in self.subscriptions.get(user_id, ())):
+            return
+        followers = self.watchers.get(author_id)
+        if followers is not None:
+            followers.discard(user_id)
+            if not followers:
+                del self.watchers[author_id]
+
+    def publish(self, entry):
+        with self.lock:
+            self.published += 1
+            subscriptions = [
+                subscription
+                for follower_id in self.watchers.get(entry['user_id'], ())
+                for subscription in self.subscriptions[follower_id]
+            ]
+            self.delivered += len(subscriptions)
+
+        for subscription in subscriptions:
+            subscription.deliver(entry)
+
+    def consume(self, event):
+        payload = event['payload']
+        if event['type'] == 'tweet_created':
+            self.publish({
+                'id': payload['id'],
+                'id_str': str(payload['id']),
+                'tweet': payload['tweet'],
+                'user_id': payload['user_id'],
+                'created_at': event['created_at']
+            })
+        elif event['type'] == 'follow':
+            self.follow(payload['user_id'], payload['follow_id'])
+        elif event['type'] == 'unfollow':
+            self.unfollow(payload['user_id'], payload['unfollow_id'])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'users': len(self.subscriptions),
+                'subscriptions': sum(len(subscriptions) for subscriptions in self.subscriptions.values()),
+                'authors': len(self.watchers),
+                'published': self.published,
+                'delivered': self.delivered
+            }
@@ -0,0 +1,125 @@
+import re
+import time
+import heapq
+import threading
+
+from datetime import datetime, timedelta
+
+from .count_min_sketch import CountMinSketch
+
+HASHTAG_PATTERN = re.compile(r'#(\w+)')
+
+class TrendService:
+    '''
+    Hashtag counts over a sliding window, kept as one Count-Min sketch per time bucket
+    and one for the whole window, so memory doesn't grow with distinct hashtags.
+    The max_hashtags hashtags counted most are trend candidates in a min-heap, and a new
+    hashtag takes the place of the lowest one once it is counted more.
+    The top list is recomputed at most once per refresh interval so /trends only slices a cached list.
+    '''
+    def __init__(self, tweet_dao, config):
+        self.tweet_dao = tweet_dao
+        self.window = config.get('TRENDS_WINDOW', 60 * 60)
+        self.bucket_size = config.get('TRENDS_BUCKET_SIZE', 60)
+        self.max_hashtags = config.get('TRENDS_MAX_HASHTAGS', 10000)
+        self.max_trends = config.get('TRENDS_MAX_SIZE', 50)
+        self.refresh_interval = config.get('TRENDS_REFRESH_INTERVAL', 10)
+        self.sketch_width = config.get('TRENDS_SKETCH_WIDTH', 4096)
+        self.sketch_depth = config.get('TRENDS_SKETCH_DEPTH', 4)
+        self.rebuild_batch_size = config.get('TRENDS_REBUILD_BATCH_SIZE', 1000)
+
+        self.buckets = {}
+        self.totals = CountMinSketch(self.sketch_width, self.sketch_depth)
+        # (count, hashtag) per candidate, counts lag behind totals until they are refreshed
+        self.heap = []
+        self.candidates = set()
+        self.top = []
+        self.top_updated_at = 0
+        self.lock = threading.Lock()
+
+    def extract_hashtags(self, tweet):
+        return {hashtag.lower() for hashtag in HASHTAG_PATTERN.findall(tweet)}
+
+    def record_tweet(self, tweet, created_at=None):
+        hashtags = self.extract_hashtags(tweet)
+        if not hashtags:
+            return
+
+        now = time.time()
+        created_at = now if created_at is None else created_at
+        bucket_id = int(created_at // self.bucket_size)
+
+        with self.lock:
+            self.expire(now)
+            if bucket_id <= self.oldest_bucket_id(now):
+                return
+
+            bucket = self.buckets.get(bucket_id)
+            if bucket is None:
+                bucket = self.buckets[bucket_id] = CountMinSketch(self.sketch_width, self.sketch_depth)
+            for hashtag in hashtags:
+                bucket.add(hashtag)
+                self.totals.add(hashtag)
+                self.admit(hashtag)
+
+    def admit(self, hashtag):
+        if hashtag in self.candidates:
+            return
+        count = self.totals.estimate(hashtag)
+        if len(self.candidates) < self.max_hashtags:
+            self.candidates.add(hashtag)
+            heapq.heappush(self.heap, (count, hashtag))
+            return
+
+        # counts only grow between expiries, so the lowest is found by refreshing it until it holds
+        while True:
+            lowest_count, lowest = self.heap[0]
+            current_count = self.totals.estimate(lowest)
+            if current_count == lowest_count:
+                break
+            heapq.heapreplace(self.heap, (current_count, lowest))
+        if count > lowest_count:
+            heapq.heapreplace(self.heap, (count, hashtag))
+            self.candidates.remove(lowest)
+            self.candidates.add(hashtag)
+
+    def consume(self, event):
+        self.record_tweet(event['payload']['tweet'], event['created_at'].timestamp())
+
+    def get_trends(self, limit):
+        now = time.time()
+        with self.lock:
+            if now - self.top_updated_at >= self.refresh_interval:
+                self.expire(now)
+                counts = [(hashtag, self.totals.estimate(hashtag)) for hashtag in self.candidates]
+                self.top = sorted(counts, key=lambda item: (-item[1], item[0]))[:self.max_trends]
+                self.top_updated_at = now
+            top = self.top
+
+        return [{'hashtag': hashtag, 'count': count} for hashtag, count in top[:limit]]
+
+    def rebuild(self):
+        since = datetime.now() - timedelta(seconds=self.window)
+        after_id = 0
+        while True:
+            rows = self.tweet_dao.get_hashtag_tweets_since(since, after_id, self.rebuild_batch_size)
+            for row in rows:
+                self.record_tweet(row['tweet'], row['created_at'].timestamp())
+            if len(rows) < self.rebuild_batch_size:
+                break
+            since, after_id = rows[-1]['created_at'], rows[-1]['id']
+
+    def oldest_bucket_id(self, now):
+        return int(now // self.bucket_size) - self.window // self.bucket_size
+
+    def expire(self, now):
+        oldest_bucket_id = self.oldest_bucket_id(now)
+        expired = [bucket_id for bucket_id in self.buckets if bucket_id <= oldest_bucket_id]
+        for bucket_id in expired:
+            self.totals.subtract(self.buckets.pop(bucket_id))
+        if expired:
+            # counts went down, candidates no longer counted are dropped
+            counts = [(self.totals.estimate(hashtag), hashtag) for hashtag in self.candidates]
+            self.heap = [(count, hashtag) for count, hashtag in counts if count > 0]
+            heapq.heapify(self.heap)
+            self.candidates = {hashtag for _, hashtag in self.heap}
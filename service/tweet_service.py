@@ -1,8 +1,67 @@
+import threading
 
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+
+from .cache import LRUCache, MISSING
+from .single_flight import SingleFlight
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+
+class TimelineUnavailable(Exception):
+    pass
+
+class StaleTimeline(list):
+    '''The last good timeline of a user, served while DB can't give a fresh one.'''
+
+class PartialTimeline(list):
+    '''The oldest tweets newer than since_id, when there are more than a page of them.'''
+
+def to_entry(tweet):
+    # 64-bit ids lose precision as JavaScript numbers, so clients can read them from id_str
+    return {'id': tweet['id'],
+            'id_str': str(tweet['id']),
+            'tweet': tweet['tweet'],
+            'user_id': tweet['user_id'],
+            'created_at': tweet['created_at']}
 
 class TweetService:
-    def __init__(self, tweet_dao):
+    def __init__(self, tweet_dao, config, id_generator):
         self.tweet_dao = tweet_dao
+        self.id_generator = id_generator
+        self.timeline_size = config.get('TIMELINE_SIZE', 100)
+        self.recent_days = config.get('TIMELINE_RECENT_DAYS', 7)
+        self.warmup_batch_size = config.get('WARMUP_TWEETS_BATCH_SIZE', 1000)
+        # identical timeline reads running at the same time share one query,
+        # and the result can be kept for a moment to absorb bursts
+        self.single_flight = SingleFlight()
+        self.micro_cache_ttl = config.get('TIMELINE_MICRO_CACHE_TTL', 0)
+        self.micro_cache = LRUCache(
+            config.get('TIMELINE_MICRO_CACHE_SIZE', 10000),
+            self.micro_cache_ttl
+        )
+        # a slow or failing DB gets each timeline query a deadline, and a breaker that
+        # stops querying it for a while, the last good first page of a timeline is served meanwhile
+        self.query_timeout = config.get('TIMELINE_QUERY_TIMEOUT', 2)
+        self.circuit_breaker = CircuitBreaker(
+            config.get('TIMELINE_BREAKER_FAILURES', 5),
+            config.get('TIMELINE_BREAKER_RESET', 10)
+        )
+        self.stale_cache = LRUCache(
+            config.get('TIMELINE_STALE_CACHE_SIZE', 1000),
+            config.get('TIMELINE_STALE_TTL', 60 * 60)
+        )
+        # first pages warmed before the worker goes healthy are served until they expire,
+        # or until one of their authors tweets or their user follows or unfollows someone
+        self.warm_cache = LRUCache(
+            config.get('WARMUP_USERS', 1000),
+            config.get('WARMUP_TIMELINE_TTL', 5 * 60)
+        )
+        # {author_id: ids of users whose warm timeline has their tweets}
+        self.warm_followers = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.stale_reads = 0
 
     def tweet_check(self, tweet):
         if len(tweet) > 300:
@@ -10,11 +69,180 @@ class TweetService:
         return 'ok'
 
     def insert_tweet(self, user_id, tweet):
-        self.tweet_dao.insert_tweet(user_id, tweet)
-
-    def get_timeline(self, user_id):
-        raw_timeline = self.tweet_dao.get_timeline(user_id).fetchall()
-        timeline = [{'tweet': tweet['tweet'],
-                    'user_id': tweet['user_id'],
-                    'created_at': tweet['created_at']} for tweet in raw_timeline]
-        return timeline
\ No newline at end of file
+        tweet_id = self.id_generator.next_id()
+        self.tweet_dao.insert_tweet(tweet_id, user_id, tweet)
+        # the author sees their own tweet right away
+        self.micro_cache.delete((user_id, None))
+        self.drop_warm_timelines(user_id)
+        return tweet_id
+
+    def drop_warm_timelines(self, author_id):
+        with self.lock:
+            user_ids = self.warm_followers.pop(author_id, ())
+        for user_id in user_ids:
+            self.warm_cache.delete(user_id)
+
+    def consume(self, event):
+        # tweets and follows of any worker reach every worker through the outbox
+        payload = event['payload']
+        if event['type'] == 'tweet_created':
+            self.drop_warm_timelines(payload['user_id'])
+        else:
+            self.warm_cache.delete(payload['user_id'])
+
+    def get_timeline(self, user_id, before_id=None, since_id=None):
+        if before_id is None and since_id is None:
+            timeline = self.warm_cache.get(user_id)
+            if timeline is not MISSING:
+                self.count_read(timeline)
+                return timeline
+
+        # only full pages are micro-cached, deltas depend on what each client holds
+        if since_id is None and self.micro_cache_ttl:
+            timeline = self.micro_cache.get((user_id, before_id))
+            if timeline is not MISSING:
+                self.count_read(timeline)
+                return timeline
+
+        timeline = self.single_flight.do(
+            (user_id, before_id, since_id),
+            lambda: self.read_timeline(user_id, before_id, since_id)
+        )
+        self.count_read(timeline)
+        return timeline
+
+    def read_timeline(self, user_id, before_id, since_id):
+        try:
+            return self.circuit_breaker.call(lambda: self.load_timeline(user_id, before_id, since_id))
+        except (CircuitOpenError, SQLAlchemyError) as e:
+            timeline = self.stale_cache.get(user_id) if before_id is None else MISSING
+            if timeline is MISSING:
+                raise TimelineUnavailable(f'Timeline of user {user_id} is unavailable') from e
+
+        self.refresh_in_background(user_id)
+        if since_id is not None:
+            newer = [entry for entry in timeline if entry['id'] > since_id]
+            # a full page newer than since_id may not reach back to it, and a gap would go unnoticed
+            if len(newer) == self.timeline_size:
+                raise TimelineUnavailable(f'Timeline of user {user_id} since {since_id} is unavailable')
+            timeline = newer
+        return StaleTimeline(timeline)
+
+    def refresh_in_background(self, user_id):
+        with self.lock:
+            if user_id in self.refreshing:
+                return
+            self.refreshing.add(user_id)
+        threading.Thread(target=self.refresh_timeline, args=(user_id,), daemon=True).start()
+
+    def refresh_timeline(self, user_id):
+        try:
+            # while the circuit is open this gives up at once, the next stale read tries again
+            self.circuit_breaker.call(lambda: self.load_timeline(user_id, None))
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.discard(user_id)
+
+    def count_read(self, timeline):
+        with self.lock:
+            self.reads += 1
+            if isinstance(timeline, StaleTimeline):
+                self.stale_reads += 1
+
+    def load_timeline(self, user_id, before_id, since_id=None):
+        if since_id is not None:
+            # polling clients only need tweets newer than the newest one they hold, the oldest
+            # of them first, so clients that fell behind catch up page by page without a gap
+            raw_timeline = self.tweet_dao.get_timeline(
+                user_id, self.timeline_size + 1, since_id + 1, before_id, self.query_timeout, oldest_first=True
+            ).fetchall()
+            timeline = [to_entry(tweet) for tweet in reversed(raw_timeline[:self.timeline_size])]
+            return PartialTimeline(timeline) if len(raw_timeline) > self.timeline_size else timeline
+        else:
+            # most timelines are filled by recent tweets, so scan the last few days first
+            recent_id = self.id_generator.id_from_time(datetime.now() - timedelta(days=self.recent_days))
+            raw_timeline = []
+            if before_id is None or recent_id < before_id:
+                raw_timeline = self.tweet_dao.get_timeline(
+                    user_id, self.timeline_size, recent_id, before_id, self.query_timeout
+                ).fetchall()
+            if len(raw_timeline) < self.timeline_size:
+                raw_timeline = self.tweet_dao.get_timeline(
+                    user_id, self.timeline_size, 0, before_id, self.query_timeout
+                ).fetchall()
+
+        timeline = [to_entry(tweet) for tweet in raw_timeline]
+        if self.micro_cache_ttl:
+            self.micro_cache.set((user_id, before_id), timeline)
+        if before_id is None:
+            self.stale_cache.set(user_id, timeline)
+        return timeline
+
+    def get_active_user_ids(self, limit):
+        recent_id = self.id_generator.id_from_time(datetime.now() - timedelta(days=self.recent_days))
+        return self.tweet_dao.get_active_user_ids(recent_id, limit)
+
+    def warm_timelines(self, following_ids):
+        '''
+        Builds the timelines of many users {user_id: following_ids} from their authors'
+        recent tweets, read newest first in batches until every timeline is full, and caches
+        them in warm_cache, which get_timeline reads first.
+        Timelines the recent tweets don't fill need a full scan, and are left to the first read.
+        '''
+        recent_id = self.id_generator.id_from_time(datetime.now() - timedelta(days=self.recent_days))
+        followers = {}
+        for user_id, author_ids in following_ids.items():
+            for author_id in set(author_ids) | {user_id}:
+                followers.setdefault(author_id, []).append(user_id)
+
+        timelines = {user_id: [] for user_id in following_ids}
+        unfilled = len(timelines)
+        before_id = None
+        while unfilled:
+            tweets = self.tweet_dao.get_tweets_of_users_since(
+                followers.keys(), recent_id, before_id, self.warmup_batch_size
+            )
+            for tweet in tweets:
+                entry = to_entry(tweet)
+                for user_id in followers[tweet['user_id']]:
+                    timeline = timelines[user_id]
+                    if len(timeline) < self.timeline_size:
+                        timeline.append(entry)
+                        if len(timeline) == self.timeline_size:
+                            unfilled -= 1
+            if len(tweets) < self.warmup_batch_size:
+                break
+            before_id = tweets[-1]['id']
+
+        warmed = 0
+        for user_id, timeline in timelines.items():
+            if len(timeline) == self.timeline_size:
+                with self.lock:
+                    for author_id in set(following_ids[user_id]) | {user_id}:
+                        self.warm_followers.setdefault(author_id, set()).add(user_id)
+                self.warm_cache.set(user_id, timeline)
+                self.stale_cache.set(user_id, timeline)
+                warmed += 1
+        return warmed
+
+    def get_timeline_stats(self):
+        with self.lock:
+            reads, stale_reads = self.reads, self.stale_reads
+        return {
+            'single_flight': self.single_flight.stats(),
+            'micro_cache': self.micro_cache.stats(),
+            'warm_cache': self.warm_cache.stats(),
+            'circuit_breaker': self.circuit_breaker.stats(),
+            'stale_cache': self.stale_cache.stats(),
+            'stale_reads': stale_reads,
+            'stale_rate': stale_reads / reads if reads else 0.0
+        }
+
+    def search(self, query, limit):
+        # search the whole query as one phrase, so boolean mode operators typed by users are ignored
+        phrase = '"' + query.replace('"', ' ').strip() + '"'
+        raw_tweets = self.tweet_dao.search_tweets(phrase, limit).fetchall()
+        tweets = [to_entry(tweet) for tweet in raw_tweets]
+        return tweets
\ No newline at end of file
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+BLOCK_SIZE = 64 * 1024
+
+class UploadService:
+    '''
+    Resumable uploads staged on local disk, one file per chunk.
+    Chunks are copied to disk block by block and can be sent again after a failure,
+    so a request holds one block in memory whatever the size of the file.
+    '''
+    def __init__(self, config):
+        self.staging_path = config.get('UPLOAD_STAGING_PATH', 'uploads')
+        # object stores need multipart parts of 5MB at least, except for the last one
+        self.chunk_size = config.get('UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+        self.max_size = config.get('PROFILE_PICTURE_MAX_SIZE', 20 * 1024 * 1024)
+        self.ttl = config.get('UPLOAD_TTL', 24 * 60 * 60)
+
+    def create_upload(self, user_id, size):
+        if not 0 < size <= self.max_size:
+            raise ValueError(f'File size must be between 1 and {self.max_size} bytes')
+
+        upload = {
+            'upload_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'chunks': -(-size // self.chunk_size),
+            'created_at': time.time()
+        }
+        os.makedirs(self.upload_path(upload['upload_id']))
+        with open(os.path.join(self.upload_path(upload['upload_id']), 'upload.json'), 'w') as f:
+            json.dump(upload, f)
+        return upload
+
+    def get_upload(self, user_id, upload_id):
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            return None
+        try:
+            with open(os.path.join(self.upload_path(upload_id), 'upload.json')) as f:
+                upload = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if upload['user_id'] != user_id or upload['created_at'] + self.ttl < time.time():
+            return None
+        return upload
+
+    def get_chunk_length(self, upload, index):
+        if not 0 <= index < upload['chunks']:
+            raise ValueError(f'Chunk index must be between 0 and {upload["chunks"] - 1}')
+        return min(upload['chunk_size'], upload['size'] - index * upload['chunk_size'])
+
+    def save_chunk(self, upload, index, stream, length):
+        expected_length = self.get_chunk_length(upload, index)
+        if length != expected_length:
+            raise ValueError(f'Chunk {index} must be {expected_length} bytes')
+
+        # a chunk only appears complete, so an interrupted one is simply sent again
+        path = self.chunk_path(upload, index)
+        with open(path + '.part', 'wb') as f:
+            remaining = length
+            while remaining:
+                block = stream.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    raise ValueError(f'Chunk {index} is incomplete')
+                f.write(block)
+                remaining -= len(block)
+        os.replace(path + '.part', path)
+
+    def get_received_chunks(self, upload):
+        return [index for index in range(upload['chunks']) if os.path.exists(self.chunk_path(upload, index))]
+
+    def get_chunk_paths(self, upload):
+        received = self.get_received_chunks(upload)
+        if len(received) < upload['chunks']:
+            raise ValueError(f'{upload["chunks"] - len(received)} chunks are missing')
+        return [self.chunk_path(upload, index) for index in received]
+
+    def delete_upload(self, upload):
+        shutil.rmtree(self.upload_path(upload['upload_id']), ignore_errors=True)
+
+    def delete_expired_uploads(self):
+        if not os.path.isdir(self.staging_path):
+            return 0
+
+        deleted = 0
+        for upload_id in os.listdir(self.staging_path):
+            try:
+                with open(os.path.join(self.upload_path(upload_id), 'upload.json')) as f:
+                    created_at = json.load(f)['created_at']
+            except (FileNotFoundError, ValueError):
+                created_at = os.path.getmtime(self.upload_path(upload_id))
+            if created_at + self.ttl < time.time():
+                shutil.rmtree(self.upload_path(upload_id), ignore_errors=True)
+                deleted += 1
+        return deleted
+
+    def upload_path(self, upload_id):
+        return os.path.join(self.staging_path, upload_id)
+
+    def chunk_path(self, upload, index):
+        return os.path.join(self.upload_path(upload['upload_id']), f'{index}.chunk')
@@ -1,8 +1,31 @@
 import os
 import jwt
 import bcrypt
+import hashlib
+import threading
+import unicodedata
 
-from datetime   import datetime, timedelta
+from datetime   import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError
+
+from .cache import create_cache, MISSING
+from .bloom_filter import BloomFilter
+
+PROFILE_PICTURE_PREFIX = 'profile_image/'
+# pictures are stored by content, so an URL always serves the same bytes
+PROFILE_PICTURE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def email_key(email):
+    # MySQL compares emails case and accent insensitively, and ignores trailing spaces,
+    # so all the spellings DB takes as one email must give one key
+    decomposed = unicodedata.normalize('NFKD', email.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).rstrip()
+
+def hash_file(fileobj, sha256=None, block_size=64 * 1024):
+    sha256 = sha256 or hashlib.sha256()
+    for block in iter(lambda: fileobj.read(block_size), b''):
+        sha256.update(block)
+    return sha256
 
 class UserService:
     def __init__(self, user_dao, config, s3_client):
@@ -10,26 +33,175 @@ class UserService:
         self.config = config
         self.s3 = s3_client
 
+        # users are cached by ('id', user_id), and emails by ('email', email) -> user_id.
+        # emails never change, so only the id entry has to be invalidated on updates.
+        # with SHARED_CACHE, forked workers share it and an invalidation reaches all of them
+        self.user_cache = create_cache(
+            config,
+            config.get('USER_CACHE_SIZE', 10000),
+            config.get('USER_CACHE_TTL', 60)
+        )
+        self.negative_ttl = config.get('USER_CACHE_NEGATIVE_TTL', 5)
+
+        # emails that are surely not registered skip DB, e.g. logins of credential stuffing.
+        # it answers only once built from all users, new users are added as they sign up
+        capacity = config.get('EMAIL_FILTER_CAPACITY', 1000000)
+        self.email_filter = BloomFilter(capacity, config.get('EMAIL_FILTER_ERROR_RATE', 0.01)) if capacity else None
+        self.email_filter_ready = False
+
+        self.bcrypt_rounds = config.get('BCRYPT_ROUNDS', 12)
+        self.rehashing_user_ids = set()
+        self.rehash_lock = threading.Lock()
+
     def encrypt_password(self, password):
         return bcrypt.hashpw(
             password.encode('utf-8'),
-            bcrypt.gensalt()
+            bcrypt.gensalt(self.bcrypt_rounds)
         )
 
+    def needs_rehash(self, hashed_password):
+        # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+        return int(hashed_password.split('$')[2]) != self.bcrypt_rounds
+
+    def rehash_password(self, user_id, password, hashed_password):
+        try:
+            self.user_dao.update_password(user_id, hashed_password, self.encrypt_password(password))
+            self.invalidate_user(user_id)
+        finally:
+            with self.rehash_lock:
+                self.rehashing_user_ids.discard(user_id)
+
+    def rehash_password_in_background(self, user_id, password, hashed_password):
+        with self.rehash_lock:
+            if user_id in self.rehashing_user_ids:
+                return
+            self.rehashing_user_ids.add(user_id)
+
+        threading.Thread(
+            target=self.rehash_password,
+            args=(user_id, password, hashed_password),
+            daemon=True
+        ).start()
+
     def create_new_user(self, new_user):
-        return self.user_dao.insert_user(new_user)
+        try:
+            insert_obj = self.user_dao.insert_user(new_user)
+        except IntegrityError:
+            # the email signed up meanwhile, a miss cached by the check before is wrong
+            self.user_cache.delete(('email', new_user['email']))
+            raise
+        # misses cached for the email or the id, e.g. when the next id was probed, are dropped
+        self.user_cache.delete(('email', new_user['email']))
+        self.user_cache.delete(('id', insert_obj.lastrowid))
+        # other workers add it from the user_created event
+        self.add_email(new_user['email'])
+        return insert_obj
+
+    def add_email(self, email):
+        if self.email_filter is not None:
+            self.email_filter.add(email_key(email))
+
+    def may_have_email(self, email):
+        return not self.email_filter_ready or email_key(email) in self.email_filter
+
+    def build_email_filter(self, batch_size=10000):
+        if self.email_filter is None:
+            return 0
+        # users signing up meanwhile are added as well, so none is missed
+        after_id = 0
+        count = 0
+        while True:
+            rows = self.user_dao.get_emails(after_id, batch_size)
+            for row in rows:
+                self.add_email(row['email'])
+            count += len(rows)
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1]['id']
+        self.email_filter_ready = True
+        return count
+
+    def consume(self, event):
+        if event['type'] == 'user_created':
+            self.add_email(event['payload']['email'])
+
+    def get_email_filter_stats(self):
+        if self.email_filter is None:
+            return None
+        return dict(self.email_filter.stats(), ready=self.email_filter_ready)
 
     def get_created_user_id(self, insert_obj):
         return insert_obj.lastrowid
 
     def get_user_by_id(self, created_user_id):
-        return self.user_dao.get_user_by_id(created_user_id)
+        user = self.user_cache.get(('id', created_user_id))
+        if user is MISSING:
+            row = self.user_dao.get_user_by_id(created_user_id)
+            user = self.cache_user(row, ('id', created_user_id))
+        return user
+
+    def get_user_by_email(self, email):
+        if not self.may_have_email(email):
+            return None
+
+        user_id = self.user_cache.get(('email', email))
+        if user_id is None:
+            return None
+        if user_id is not MISSING:
+            return self.get_user_by_id(user_id)
+
+        row = self.user_dao.get_user_by_email(email)
+        return self.cache_user(row, ('email', email))
+
+    def get_users_by_ids(self, user_ids):
+        users = {}
+        missing_ids = []
+        for user_id in set(user_ids):
+            user = self.user_cache.get(('id', user_id))
+            if user is MISSING:
+                missing_ids.append(user_id)
+            elif user is not None:
+                users[user_id] = user
+
+        if missing_ids:
+            rows = {row['id']: row for row in self.user_dao.get_users_by_ids(missing_ids)}
+            for user_id in missing_ids:
+                user = self.cache_user(rows.get(user_id), ('id', user_id))
+                if user is not None:
+                    users[user_id] = user
+
+        return users
+
+    def get_public_profiles(self, user_ids):
+        users = self.get_users_by_ids(user_ids)
+        return {user_id: {
+            'id': user['id'],
+            'name': user['name'],
+            'profile': user['profile'],
+            'profile_picture': user['profile_picture']
+        } for user_id, user in users.items()}
+
+    def cache_user(self, row, key):
+        if row is None:
+            self.user_cache.set(key, None, self.negative_ttl)
+            return None
+
+        user = dict(row)
+        self.user_cache.set(('id', user['id']), user)
+        self.user_cache.set(('email', user['email']), user['id'])
+        return user
+
+    def invalidate_user(self, user_id):
+        self.user_cache.delete(('id', user_id))
+
+    def get_cache_stats(self):
+        return self.user_cache.stats()
 
     def authorize(self, credential):
         email = credential['email']
         password = credential['password']
         
-        user = self.user_dao.get_user_by_email(email)
+        user = self.get_user_by_email(email)
         user_credential = {
             'id': user['id'],
             'hashed_password': user['hashed_password']
@@ -37,10 +209,15 @@ class UserService:
 
         user_id = user['id'] if user else False
         authorized = user_credential and bcrypt.checkpw(password.encode('utf-8'), user_credential['hashed_password'].encode('utf-8'))
+
+        # hashes made with another cost are upgraded once the password is known to be right
+        if authorized and self.needs_rehash(user_credential['hashed_password']):
+            self.rehash_password_in_background(user_id, password, user_credential['hashed_password'])
+
         return authorized, user_id
 
     def get_user_id(self, email):
-        user = self.user_dao.get_user_by_email(email)
+        user = self.get_user_by_email(email)
         user_id = user['id']
         return user_id
 
@@ -62,17 +239,117 @@ class UserService:
     def unfollow(self, user_id, unfollow_id):
         self.user_dao.delete_follow(user_id, unfollow_id)
 
+    def get_following_ids(self, user_id, batch_size=1000):
+        following_ids = []
+        while True:
+            rows = self.user_dao.get_following(user_id, following_ids[-1] if following_ids else 0, batch_size)
+            following_ids.extend(row['id'] for row in rows)
+            if len(rows) < batch_size:
+                return following_ids
+
+    def get_following_ids_of_users(self, user_ids):
+        following_ids = {user_id: [] for user_id in user_ids}
+        for row in self.user_dao.get_following_of_users(user_ids):
+            following_ids[row['user_id']].append(row['follow_user_id'])
+        return following_ids
+
     def save_profile_picture(self, profile_pic, user_id):
-        upload_path = f"{'profile_image/'}{user_id}{'.png'}"
-        self.s3.upload_fileobj(
-            profile_pic,
-            self.config['S3_BUCKET'],
-            upload_path
+        upload_path = self.get_profile_picture_path(hash_file(profile_pic).hexdigest())
+        profile_pic.seek(0)
+
+        if not self.is_profile_picture_stored(upload_path):
+            self.s3.upload_fileobj(
+                profile_pic,
+                self.config['S3_BUCKET'],
+                upload_path,
+                ExtraArgs={'CacheControl': PROFILE_PICTURE_CACHE_CONTROL}
+            )
+
+        return self.update_profile_picture(upload_path, user_id)
+
+    def save_profile_picture_chunks(self, chunk_paths, user_id):
+        sha256 = hashlib.sha256()
+        for chunk_path in chunk_paths:
+            with open(chunk_path, 'rb') as chunk:
+                hash_file(chunk, sha256)
+        upload_path = self.get_profile_picture_path(sha256.hexdigest())
+        if self.is_profile_picture_stored(upload_path):
+            return self.update_profile_picture(upload_path, user_id)
+
+        bucket = self.config['S3_BUCKET']
+        # parts are read from the staged files, so the picture is never held in memory
+        multipart = self.s3.create_multipart_upload(
+            Bucket=bucket,
+            Key=upload_path,
+            CacheControl=PROFILE_PICTURE_CACHE_CONTROL
         )
+        try:
+            parts = []
+            for part_number, chunk_path in enumerate(chunk_paths, 1):
+                with open(chunk_path, 'rb') as chunk:
+                    part = self.s3.upload_part(
+                        Bucket=bucket,
+                        Key=upload_path,
+                        UploadId=multipart['UploadId'],
+                        PartNumber=part_number,
+                        Body=chunk
+                    )
+                parts.append({'ETag': part['ETag'], 'PartNumber': part_number})
+
+            self.s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=upload_path,
+                UploadId=multipart['UploadId'],
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.s3.abort_multipart_upload(Bucket=bucket, Key=upload_path, UploadId=multipart['UploadId'])
+            raise
+
+        return self.update_profile_picture(upload_path, user_id)
+
+    def get_profile_picture_path(self, digest):
+        return f"{PROFILE_PICTURE_PREFIX}{digest}{'.png'}"
+
+    def get_profile_picture_url(self, upload_path):
+        return f"{self.config['S3_BUCKET_URL']}{upload_path}"
+
+    def is_profile_picture_stored(self, upload_path):
+        # a picture some user points to is stored and safe from garbage collection
+        image_url = self.get_profile_picture_url(upload_path)
+        return image_url in self.user_dao.get_used_profile_pictures([image_url])
+
+    def update_profile_picture(self, upload_path, user_id):
+        image_url = self.get_profile_picture_url(upload_path)
+
+        result = self.user_dao.update_profile_picture(image_url, user_id)
+        self.invalidate_user(user_id)
+        return result
+
+    def delete_unused_profile_pictures(self):
+        # recent pictures may not be saved to their user yet
+        grace = timedelta(hours=self.config.get('PROFILE_PICTURE_GC_GRACE_HOURS', 24))
+        modified_before = datetime.now(timezone.utc) - grace
+        bucket = self.config['S3_BUCKET']
 
-        image_url = f"{self.config['S3_BUCKET_URL']}{upload_path}"
+        deleted = 0
+        pages = self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=PROFILE_PICTURE_PREFIX)
+        for page in pages:
+            paths = {
+                self.get_profile_picture_url(stored['Key']): stored['Key']
+                for stored in page.get('Contents', [])
+                if stored['LastModified'] < modified_before
+            }
+            if not paths:
+                continue
 
-        return self.user_dao.update_profile_picture(image_url, user_id)
+            used = self.user_dao.get_used_profile_pictures(paths.keys())
+            unused = [{'Key': path} for image_url, path in paths.items() if image_url not in used]
+            if unused:
+                self.s3.delete_objects(Bucket=bucket, Delete={'Objects': unused, 'Quiet': True})
+                deleted += len(unused)
+        return deleted
 
     def get_profile_picture(self, user_id):
-        return self.user_dao.get_profile_picture(user_id)
\ No newline at end of file
+        user = self.get_user_by_id(user_id)
+        return user['profile_picture'] if user else None
\ No newline at end of file
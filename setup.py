@@ -2,16 +2,28 @@ import sys
 
 from flask_script import Manager
 from flask_twisted import Twisted
+from twisted.internet import reactor
 from twisted.python import log
 
 from app import create_app
+from command import create_commands
+from view.stream import create_stream_resource
+from view.timeline import create_timeline_resource
 
 if __name__ == '__main__':
     app = create_app()
     twisted = Twisted(app)
+    twisted.add_resource(b'stream', create_stream_resource(app))
+    if app.config.get('TIMELINE_NONBLOCKING', True):
+        twisted.add_resource(b'timeline', create_timeline_resource(app))
+    # only servers relay outbox events, other commands don't need them
+    twisted.on('run', lambda app: app.services.outbox_relay.start())
+    twisted.on('run', lambda app: app.services.cache_warmer.start())
+    reactor.suggestThreadPoolSize(app.config['THREAD_POOL_SIZE'])
     log.startLogging(sys.stdout)
 
     app.logger.info(f'Running the app...')
 
     manager = Manager(app)
+    create_commands(manager, app)
     manager.run()
\ No newline at end of file
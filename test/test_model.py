@@ -2,10 +2,11 @@ import bcrypt
 import time
 
 import pytest
+from datetime import datetime, timedelta
 from sqlalchemy import create_engine, text
 
 import config
-from model import UserDAO, TweetDAO
+from model import UserDAO, TweetDAO, CounterDAO, RecommendationDAO, OutboxDAO, BulkLoadDAO
 
 database = create_engine(config.test_config['DB_URL'], encoding='utf-8', max_overflow=0)
 
@@ -17,6 +18,18 @@ def user_dao():
 def tweet_dao():
     return TweetDAO(database)
 
+@pytest.fixture
+def counter_dao():
+    return CounterDAO(database)
+
+@pytest.fixture
+def recommendation_dao():
+    return RecommendationDAO(database)
+
+@pytest.fixture
+def outbox_dao():
+    return OutboxDAO(database)
+
 def setup_function():
     '''
     There is 3 users.
@@ -73,14 +86,17 @@ def setup_function():
 
     # user 2 has a tweet
     tweet = {
+        'id': 1,
         'user_id': 2,
         'tweet': 'test tweet user 2'
     }
     database.execute(text("""
         INSERT INTO tweets (
+            id,
             user_id,
             tweet
         ) VALUES (
+            :id,
             :user_id,
             :tweet
         )
@@ -107,9 +123,14 @@ def teardown_function():
     database.execute(text("TRUNCATE users"))
     database.execute(text("TRUNCATE tweets"))
     database.execute(text("TRUNCATE users_follow_list"))
+    database.execute(text("TRUNCATE users_counters"))
+    database.execute(text("TRUNCATE users_archived_tweets"))
+    database.execute(text("TRUNCATE users_recommendations"))
+    database.execute(text("TRUNCATE outbox_events"))
+    database.execute(text("TRUNCATE outbox_checkpoints"))
     database.execute(text("SET FOREIGN_KEY_CHECKS=1"))
 
-def test_insert_user(user_dao):
+def test_insert_user(user_dao, outbox_dao):
     # insert user 4
     new_user = {
         'name': 'testname04',
@@ -144,7 +165,37 @@ def test_insert_user(user_dao):
         'email': new_user['email'],
         'profile': new_user['profile']
     }
+
+    # other workers learn about the new email from the outbox
+    events = outbox_dao.get_events_after(0, 10)
+    assert [(event['type'], event['payload']) for event in events] == [
+        ('user_created', {'id': new_user_id, 'email': 'test04@gmail.com'})
+    ]
     
+def test_insert_users(user_dao):
+    # insert user 4 and 5 at once
+    new_users = [{
+        'id': user_id,
+        'name': f'testname0{user_id}',
+        'email': f'test0{user_id}@gmail.com',
+        'profile': f'test profile 0{user_id}',
+        'hashed_password': 'testpw'
+    } for user_id in [4, 5]]
+    user_dao.insert_users(new_users)
+
+    rows = database.execute(text("""
+        SELECT
+            id,
+            name
+        FROM
+            users
+        WHERE
+            id > 3
+        ORDER BY
+            id
+    """)).fetchall()
+    assert [(row['id'], row['name']) for row in rows] == [(4, 'testname04'), (5, 'testname05')]
+
 def test_get_user_by_id(user_dao):
     # query user 1
     user = {
@@ -197,6 +248,25 @@ def test_get_user_by_email(user_dao):
     # check the encrypted password matches
     assert bcrypt.checkpw('testpw01'.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def test_get_users_by_ids(user_dao):
+    # query user 1, 3 and a user that doesn't exist
+    rows = user_dao.get_users_by_ids([1, 3, 100])
+    rows_dict = sorted([{
+        'id': row['id'],
+        'name': row['name']
+    } for row in rows], key=lambda row: row['id'])
+
+    assert rows_dict == [
+        {
+            'id': 1,
+            'name': 'testname01'
+        },
+        {
+            'id': 3,
+            'name': 'testname03'
+        }
+    ]
+
 def test_insert_follow(user_dao):
     # user 1 follows user 2
     user_dao.insert_follow(1, 2)
@@ -212,6 +282,29 @@ def test_insert_follow(user_dao):
     """), {'user_id': 1}).fetchone()
     assert row['follow_user_id'] == 2
 
+def test_insert_follows(user_dao):
+    # user 1 follows user 2 and 3
+    user_dao.insert_follows([
+        {'user_id': 1, 'follow': 2},
+        {'user_id': 1, 'follow': 3}
+    ])
+
+    rows = database.execute(text("""
+        SELECT
+            follow_user_id
+        FROM
+            users_follow_list
+        WHERE
+            user_id = :user_id
+        ORDER BY
+            follow_user_id
+    """), {'user_id': 1}).fetchall()
+    assert [row['follow_user_id'] for row in rows] == [2, 3]
+
+def test_get_user_ids(user_dao):
+    assert user_dao.get_user_ids(0, 2) == [1, 2]
+    assert user_dao.get_user_ids(2, 2) == [3]
+
 def test_delete_follow(user_dao):
     # user 3 unfollows user 2
     user_dao.delete_follow(3, 2)
@@ -227,11 +320,21 @@ def test_delete_follow(user_dao):
     """), {'user_id': 3}).fetchone()
     assert row == None
 
+def test_get_following_and_followers(user_dao):
+    # user 3 follows user 2
+    following = user_dao.get_following(3, 0, 10)
+    assert [row['id'] for row in following] == [2]
+    assert user_dao.get_following(3, 2, 10) == []
+
+    followers = user_dao.get_followers(2, 0, 10)
+    assert [row['id'] for row in followers] == [3]
+    assert user_dao.get_followers(2, 3, 10) == []
+
 def test_insert_tweet(tweet_dao):
     # user 1 creates a tweet
     user_id = 1
     tweet = 'user 1 test tweet'
-    tweet_dao.insert_tweet(user_id, tweet)
+    tweet_dao.insert_tweet(2, user_id, tweet)
 
     # check DB
     row = database.execute(text("""
@@ -252,14 +355,48 @@ def test_insert_tweet(tweet_dao):
         'tweet': tweet
     }
 
+def test_insert_tweets(tweet_dao):
+    # user 1 tweets twice, with given creation times
+    created_at = datetime(2020, 5, 1, 21, 0, 0)
+    tweet_dao.insert_tweets([
+        {'id': 2, 'user_id': 1, 'tweet': 'bulk tweet 1', 'created_at': created_at},
+        {'id': 3, 'user_id': 1, 'tweet': 'bulk tweet 2', 'created_at': created_at}
+    ])
+
+    rows = database.execute(text("""
+        SELECT
+            *
+        FROM
+            tweets
+        WHERE
+            user_id = :user_id
+        ORDER BY
+            id
+    """), {'user_id': 1}).fetchall()
+    assert [(row['tweet'], row['created_at']) for row in rows] == [
+        ('bulk tweet 1', created_at),
+        ('bulk tweet 2', created_at)
+    ]
+
+def test_get_user_tweets(tweet_dao):
+    # user 2 has 3 tweets
+    tweet_dao.insert_tweet(2, 2, 'test tweet user 2 #2')
+    tweet_dao.insert_tweet(3, 2, 'test tweet user 2 #3')
+
+    tweets = tweet_dao.get_user_tweets(2, 0, 2)
+    assert [tweet['tweet'] for tweet in tweets] == ['test tweet user 2', 'test tweet user 2 #2']
+
+    tweets = tweet_dao.get_user_tweets(2, tweets[-1]['id'], 2)
+    assert [tweet['tweet'] for tweet in tweets] == ['test tweet user 2 #3']
+
 def test_get_timeline(tweet_dao):
     # user 3 creates a tweet
     user_id = 3
     tweet = 'user 3 test tweet'
-    tweet_dao.insert_tweet(user_id, tweet)
+    tweet_dao.insert_tweet(2, user_id, tweet)
 
     # load timeline: should be [user3's tweet, user2's tweet]
-    timeline = tweet_dao.get_timeline(user_id).fetchall()
+    timeline = tweet_dao.get_timeline(user_id, 10).fetchall()
     
     timeline_dict = [{
         'user_id': tweet['user_id'],
@@ -277,6 +414,61 @@ def test_get_timeline(tweet_dao):
         }
     ]
 
+def test_get_timeline_followed_users(user_dao, tweet_dao):
+    # user 3 has 2 followers, and follows user 2
+    user_dao.insert_follow(1, 3)
+    user_dao.insert_follow(2, 3)
+    tweet_dao.insert_tweet(2, 3, 'user 3 test tweet')
+
+    # every tweet once, not once per follower of its author
+    timeline = tweet_dao.get_timeline(3, 10).fetchall()
+    assert [tweet['id'] for tweet in timeline] == [2, 1]
+
+    timeline = tweet_dao.get_timeline(1, 10).fetchall()
+    assert [tweet['id'] for tweet in timeline] == [2]
+
+def test_get_timeline_by_id(tweet_dao):
+    # user 3's timeline has user 2's tweets 1 and 2
+    tweet_dao.insert_tweet(2, 2, 'test tweet user 2 #2')
+
+    timeline = tweet_dao.get_timeline(3, 10, 1).fetchall()
+    assert [tweet['id'] for tweet in timeline] == [2, 1]
+
+    # since_id is inclusive
+    timeline = tweet_dao.get_timeline(3, 10, 2).fetchall()
+    assert [tweet['id'] for tweet in timeline] == [2]
+
+    # before_id is exclusive
+    timeline = tweet_dao.get_timeline(3, 10, 0, 2).fetchall()
+    assert [tweet['id'] for tweet in timeline] == [1]
+
+def test_get_and_delete_tweets_before(tweet_dao):
+    tweet_dao.insert_tweet(2, 2, 'test tweet user 2 #2')
+
+    # in batches after the last tweet read
+    before = datetime.now() + timedelta(hours=1)
+    tweets = tweet_dao.get_tweets_before(before, datetime(1970, 1, 1), 0, 1)
+    assert [tweet['tweet'] for tweet in tweets] == ['test tweet user 2']
+    tweets = tweet_dao.get_tweets_before(before, tweets[-1]['created_at'], tweets[-1]['id'], 10)
+    assert [tweet['tweet'] for tweet in tweets] == ['test tweet user 2 #2']
+
+    # deleted tweets are still counted for their user
+    assert tweet_dao.delete_tweets_before(before, tweets[-1]['id'], 10) == 2
+    assert tweet_dao.get_tweets_before(before, datetime(1970, 1, 1), 0, 10) == []
+    assert database.execute(text("SELECT tweets FROM users_archived_tweets WHERE user_id = 2")).scalar() == 2
+
+def test_update_password(user_dao):
+    old_hashed_password = user_dao.get_user_by_id(1)['hashed_password']
+    new_hashed_password = bcrypt.hashpw(b'testpw01', bcrypt.gensalt(4))
+
+    # a stale old hash doesn't update
+    result = user_dao.update_password(1, 'stale hash', new_hashed_password)
+    assert result.rowcount == 0
+
+    result = user_dao.update_password(1, old_hashed_password, new_hashed_password)
+    assert result.rowcount == 1
+    assert user_dao.get_user_by_id(1)['hashed_password'] == new_hashed_password.decode('utf-8')
+
 def test_get_and_update_profile_picture(user_dao):
     # input
     user_id = 1
@@ -301,4 +493,185 @@ def test_get_and_update_profile_picture(user_dao):
     assert result['profile_picture'] == image_url
 
     result = user_dao.get_profile_picture(user_id)
-    assert result == image_url
\ No newline at end of file
+    assert result == image_url
+
+    # only pictures some user points to are used
+    unused_url = 'https://miniter-static.s3.ap-northeast-2.amazonaws.com/profile_image/2.png'
+    assert user_dao.get_used_profile_pictures([image_url, unused_url]) == {image_url}
+
+def test_search_tweets(tweet_dao):
+    # user 1 creates a tweet
+    tweet_dao.insert_tweet(2, 1, 'user 1 searchable tweet')
+
+    # search by a word of user 1's tweet
+    tweets = tweet_dao.search_tweets('"searchable"', 10).fetchall()
+    tweets_dict = [{
+        'user_id': tweet['user_id'],
+        'tweet': tweet['tweet']
+    } for tweet in tweets]
+    assert tweets_dict == [
+        {
+            'user_id': 1,
+            'tweet': 'user 1 searchable tweet'
+        }
+    ]
+
+    # korean
+    tweet_dao.insert_tweet(3, 1, '오늘 날씨가 좋네요')
+    tweets = tweet_dao.search_tweets('"날씨"', 10).fetchall()
+    assert [tweet['tweet'] for tweet in tweets] == ['오늘 날씨가 좋네요']
+
+    # no match
+    tweets = tweet_dao.search_tweets('"nothing matches"', 10).fetchall()
+    assert tweets == []
+
+
+def test_get_tweets_of_users_since(tweet_dao):
+    # users 1 and 3 tweet after tweet 1 of user 2
+    tweet_dao.insert_tweet(2, 1, 'tweet user 1')
+    tweet_dao.insert_tweet(3, 3, 'tweet user 3')
+
+    # newest first, in batches below the last one read
+    tweets = tweet_dao.get_tweets_of_users_since([1, 2], 0, None, 1)
+    assert [tweet['id'] for tweet in tweets] == [2]
+    tweets = tweet_dao.get_tweets_of_users_since([1, 2], 0, tweets[-1]['id'], 10)
+    assert [tweet['id'] for tweet in tweets] == [1]
+
+    # tweets older than since_id are not returned
+    tweets = tweet_dao.get_tweets_of_users_since([1, 2], 2, None, 10)
+    assert [tweet['id'] for tweet in tweets] == [2]
+
+def test_get_hashtag_tweets_since(tweet_dao):
+    # user 1 creates tweets with a hashtag
+    tweet_dao.insert_tweet(2, 1, 'hello #miniter')
+    tweet_dao.insert_tweet(3, 1, 'again #miniter')
+
+    # only tweets with a hashtag are returned, in batches after the last one read
+    since = datetime.now() - timedelta(hours=1)
+    tweets = tweet_dao.get_hashtag_tweets_since(since, 0, 1)
+    assert [tweet['tweet'] for tweet in tweets] == ['hello #miniter']
+    tweets = tweet_dao.get_hashtag_tweets_since(tweets[-1]['created_at'], tweets[-1]['id'], 10)
+    assert [tweet['tweet'] for tweet in tweets] == ['again #miniter']
+
+    # tweets older than since are not returned
+    since = datetime.now() + timedelta(hours=1)
+    tweets = tweet_dao.get_hashtag_tweets_since(since, 0, 10)
+    assert tweets == []
+
+def test_counters(user_dao, tweet_dao, counter_dao):
+    # user 1 follows user 2 and 3, user 2 tweets
+    user_dao.insert_follow(1, 2)
+    user_dao.insert_follow(1, 3)
+    tweet_dao.insert_tweet(2, 2, 'counted tweet')
+
+    counts = counter_dao.get_counts(1)
+    assert (counts['followers'], counts['following'], counts['tweets']) == (0, 2, 0)
+    counts = counter_dao.get_counts(2)
+    assert (counts['followers'], counts['following'], counts['tweets']) == (1, 0, 1)
+
+    # user 1 unfollows user 2, twice
+    user_dao.delete_follow(1, 2)
+    user_dao.delete_follow(1, 2)
+    counts = counter_dao.get_counts(1)
+    assert (counts['followers'], counts['following'], counts['tweets']) == (0, 1, 0)
+
+def test_reset_counts(counter_dao):
+    # rows inserted in setup are not counted yet
+    actual_counts = counter_dao.get_actual_counts(0, 10)
+    assert [(row['id'], row['followers'], row['following'], row['tweets']) for row in actual_counts] == [
+        (1, 0, 0, 0),
+        (2, 1, 0, 1),
+        (3, 0, 1, 0)
+    ]
+    assert counter_dao.get_stored_counts([1, 2, 3]) == []
+
+    counter_dao.reset_counts({'user_id': 2, 'followers': 1, 'following': 0, 'tweets': 1})
+    stored_counts = counter_dao.get_stored_counts([1, 2, 3])
+    assert [(row['id'], row['followers'], row['following'], row['tweets']) for row in stored_counts] == [(2, 1, 0, 1)]
+
+    # locked, counted and reset in one transaction
+    assert counter_dao.get_user_ids(1, 10) == [2, 3]
+    with counter_dao.transaction() as transaction_dao:
+        assert [row['user_id'] for row in transaction_dao.lock_counts([2, 3])] == [2]
+        transaction_dao.reset_counts({'user_id': 3, 'followers': 0, 'following': 1, 'tweets': 0})
+    stored_counts = counter_dao.get_stored_counts([3])
+    assert [(row['id'], row['followers'], row['following'], row['tweets']) for row in stored_counts] == [(3, 0, 1, 0)]
+
+def test_replace_and_get_recommendations(recommendation_dao):
+    # user 1 gets user 2 and 3
+    recommendation_dao.replace_recommendations([1], [
+        {'user_id': 1, 'position': 0, 'recommended_user_id': 3, 'score': 2},
+        {'user_id': 1, 'position': 1, 'recommended_user_id': 2, 'score': 1}
+    ])
+    rows = recommendation_dao.get_recommendations(1)
+    assert [(row['recommended_user_id'], row['score']) for row in rows] == [(3, 2), (2, 1)]
+
+    # previous recommendations are replaced
+    recommendation_dao.replace_recommendations([1], [])
+    assert recommendation_dao.get_recommendations(1) == []
+
+def test_get_candidates(user_dao, recommendation_dao):
+    # user 1 follows user 3, user 2 follows user 1
+    user_dao.insert_follow(1, 3)
+    user_dao.insert_follow(2, 1)
+
+    rows = recommendation_dao.get_candidates(1, 2)
+    assert [(row['user_id'], row['recommended_user_id'], row['score']) for row in rows] == [(1, 2, 1), (2, 3, 1)]
+    rows = recommendation_dao.get_candidates(3, 3)
+    assert [(row['user_id'], row['recommended_user_id'], row['score']) for row in rows] == [(3, 1, 1)]
+
+    # followed users and the user itself are left out
+    user_dao.insert_follow(1, 2)
+    assert recommendation_dao.get_candidates(1, 1) == []
+
+def test_outbox(user_dao, tweet_dao, outbox_dao):
+    # tweets and follows record an event in the same transaction
+    assert outbox_dao.get_last_event_id() == 0
+    tweet_dao.insert_tweet(5, 1, 'outbox tweet')
+    user_dao.insert_follow(1, 2)
+    user_dao.delete_follow(1, 2)
+    user_dao.delete_follow(1, 2)
+
+    events = outbox_dao.get_events_after(0, 10)
+    assert [(event['type'], event['payload']) for event in events] == [
+        ('tweet_created', {'id': 5, 'user_id': 1, 'tweet': 'outbox tweet'}),
+        ('follow', {'user_id': 1, 'follow_id': 2}),
+        ('unfollow', {'user_id': 1, 'unfollow_id': 2})
+    ]
+    assert outbox_dao.get_last_event_id() == events[-1]['id']
+    assert [event['id'] for event in outbox_dao.get_events_after(events[0]['id'], 1)] == [events[1]['id']]
+
+    # checkpoints are stored per consumer
+    outbox_dao.save_checkpoint('test', events[0]['id'])
+    outbox_dao.save_checkpoint('test', events[1]['id'])
+    assert outbox_dao.get_checkpoints(['test', 'other']) == {'test': events[1]['id']}
+
+    # only events up to max_id and older than before are deleted
+    outbox_dao.delete_events(events[1]['id'], datetime.now() - timedelta(hours=1), 10)
+    assert len(outbox_dao.get_events_after(0, 10)) == 3
+    outbox_dao.delete_events(events[1]['id'], datetime.now() + timedelta(hours=1), 10)
+    assert [event['id'] for event in outbox_dao.get_events_after(0, 10)] == [events[2]['id']]
+
+def test_drop_and_add_tweets_indexes():
+    def get_tweets_constraints(connection):
+        rows = connection.execute(text("""
+            SELECT INDEX_NAME AS name FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tweets'
+            UNION
+            SELECT CONSTRAINT_NAME AS name FROM information_schema.TABLE_CONSTRAINTS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tweets' AND CONSTRAINT_TYPE = 'FOREIGN KEY'
+        """)).fetchall()
+        return {row['name'] for row in rows}
+
+    with database.connect() as connection:
+        bulk_load_dao = BulkLoadDAO(connection)
+        before = get_tweets_constraints(connection)
+        assert 'tweets_user_id_fkey' in before
+
+        # the foreign key goes with its index, and both come back
+        bulk_load_dao.set_checks(False)
+        bulk_load_dao.drop_tweets_indexes()
+        assert get_tweets_constraints(connection) == {'PRIMARY'}
+        bulk_load_dao.add_tweets_indexes()
+        bulk_load_dao.set_checks(True)
+        assert get_tweets_constraints(connection) == before
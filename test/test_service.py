@@ -1,14 +1,42 @@
+import io
+import os
 import bcrypt
+import hashlib
+import gzip
+import json
 import jwt
 import time
+import threading
 
 import pytest
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
 from unittest import mock
+from datetime import datetime, timedelta, timezone
 
 import config
-from model import UserDAO, TweetDAO
-from service import UserService, TweetService
+from model import UserDAO, TweetDAO, CounterDAO, RecommendationDAO, OutboxDAO
+from model.outbox_dao import add_events
+from service import (
+    UserService,
+    TweetService,
+    TrendService,
+    ArchiveService,
+    ExportService,
+    IdGenerator,
+    CounterService,
+    RecommendationService,
+    TimelineBroker,
+    OutboxRelay,
+    UploadService,
+    TimelineUnavailable,
+    StaleTimeline,
+    PartialTimeline,
+    CacheWarmer
+)
+from service.cache import MISSING, SharedCache
+from service.bloom_filter import BloomFilter
+from service.circuit_breaker import CircuitBreaker, CircuitOpenError
 
 database = create_engine(config.test_config['DB_URL'], encoding='utf-8', max_overflow=0)
 
@@ -19,7 +47,27 @@ def user_service():
 
 @pytest.fixture
 def tweet_service():
-    return TweetService(TweetDAO(database))
+    return TweetService(TweetDAO(database), config.test_config, IdGenerator(0))
+
+@pytest.fixture
+def archive_service(tmp_path):
+    return ArchiveService(TweetDAO(database), dict(config.test_config, ARCHIVE_PATH=str(tmp_path), ARCHIVE_BATCH_SIZE=1))
+
+@pytest.fixture
+def export_service():
+    return ExportService(UserDAO(database), TweetDAO(database), dict(config.test_config, EXPORT_BATCH_SIZE=1))
+
+@pytest.fixture
+def counter_service():
+    return CounterService(CounterDAO(database), dict(config.test_config, COUNTER_RECONCILE_BATCH_SIZE=2))
+
+@pytest.fixture
+def recommendation_service():
+    return RecommendationService(UserDAO(database), RecommendationDAO(database), dict(config.test_config, RECOMMENDATION_CHUNK_SIZE=2))
+
+@pytest.fixture
+def trend_service():
+    return TrendService(TweetDAO(database), config.test_config)
 
 def setup_function():
     '''
@@ -77,14 +125,17 @@ def setup_function():
 
     # user 2 has a tweet
     tweet = {
+        'id': 1,
         'user_id': 2,
         'tweet': 'test tweet user 2'
     }
     database.execute(text("""
         INSERT INTO tweets (
+            id,
             user_id,
             tweet
         ) VALUES (
+            :id,
             :user_id,
             :tweet
         )
@@ -111,10 +162,18 @@ def teardown_function():
     database.execute(text("TRUNCATE users"))
     database.execute(text("TRUNCATE tweets"))
     database.execute(text("TRUNCATE users_follow_list"))
+    database.execute(text("TRUNCATE users_counters"))
+    database.execute(text("TRUNCATE users_archived_tweets"))
+    database.execute(text("TRUNCATE users_recommendations"))
+    database.execute(text("TRUNCATE outbox_events"))
+    database.execute(text("TRUNCATE outbox_checkpoints"))
     database.execute(text("SET FOREIGN_KEY_CHECKS=1"))
 
 def test_encrypt_password(user_service):
-    pass
+    user_service.bcrypt_rounds = 5
+    hashed_password = user_service.encrypt_password('testpw')
+    assert hashed_password.startswith(b'$2b$05$')
+    assert bcrypt.checkpw(b'testpw', hashed_password)
 
 def test_create_new_user(user_service):
     pass
@@ -125,6 +184,128 @@ def test_get_created_user_id(user_service):
 def test_get_user_by_id(user_service):
     pass
 
+def test_user_cache(user_service):
+    # the first lookup hits DB, later lookups by id or email are cached
+    user = user_service.get_user_by_id(1)
+    assert user['email'] == 'test01@gmail.com'
+    assert user_service.get_user_by_email('test01@gmail.com') == user
+    assert user_service.get_user_by_id(1) == user
+    stats = user_service.get_cache_stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 3
+
+    # unknown emails are cached as misses until the user signs up
+    assert user_service.get_user_by_email('test04@gmail.com') is None
+    database.execute(text("""
+        INSERT INTO users (name, email, profile, hashed_password)
+        VALUES ('testname04', 'test04@gmail.com', 'test profile 04', 'testpw04')
+    """))
+    assert user_service.get_user_by_email('test04@gmail.com') is None
+
+    # the id of the next user, probed before they sign up, is cached as a miss too
+    next_id = database.execute(text("SELECT MAX(id) FROM users")).scalar() + 1
+    assert user_service.get_user_by_id(next_id) is None
+    insert_obj = user_service.create_new_user({
+        'name': 'testname05',
+        'email': 'test05@gmail.com',
+        'profile': 'test profile 05',
+        'password': 'testpw05'
+    })
+    assert user_service.get_created_user_id(insert_obj) == next_id
+    assert user_service.get_user_by_id(next_id)['name'] == 'testname05'
+    assert user_service.get_user_by_email('test05@gmail.com')['name'] == 'testname05'
+
+    # updates invalidate the cached user
+    user_service.save_profile_picture(io.BytesIO(b'test image'), 1)
+    assert user_service.get_user_by_id(1)['profile_picture'] is not None
+
+def test_shared_cache():
+    cache = SharedCache(8, 60, slot_size=256, ways=2)
+    cache.set(('id', 1), {'name': 'testname01'})
+    cache.set(('email', 'test01@gmail.com'), 1)
+    cache.set(('id', 2), None, ttl=0)
+    assert cache.get(('id', 1)) == {'name': 'testname01'}
+    assert cache.get(('email', 'test01@gmail.com')) == 1
+    # expired entries and entries larger than a slot are missing
+    assert cache.get(('id', 2)) is MISSING
+    cache.set(('id', 3), 'x' * 256)
+    assert cache.get(('id', 3)) is MISSING
+
+    # processes forked after it was created share entries
+    pid = os.fork()
+    if pid == 0:
+        cache.delete(('id', 1))
+        cache.set(('id', 4), 'set by a worker')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.get(('id', 1)) is MISSING
+    assert cache.get(('id', 4)) == 'set by a worker'
+
+    # the least recently used entry of a full set is replaced
+    for user_id in range(100):
+        cache.set(('id', user_id), user_id)
+    stats = cache.stats()
+    assert stats['size'] == 8
+    assert stats['evictions'] > 0
+    assert stats['oversized'] == 1
+
+def test_bloom_filter():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(f'user{i}@example.com')
+
+    # no false negatives, about 1% false positives
+    assert all(f'user{i}@example.com' in bloom_filter for i in range(1000))
+    assert sum(f'other{i}@example.com' in bloom_filter for i in range(10000)) < 200
+    stats = bloom_filter.stats()
+    assert stats['memory_bytes'] == 1199
+    assert stats['hashes'] == 7
+
+def test_email_filter(user_service):
+    # until it's built, every email may exist
+    assert user_service.may_have_email('nobody@gmail.com')
+    assert user_service.build_email_filter(batch_size=2) == 3
+
+    # spellings DB takes as the same email are found too
+    assert user_service.may_have_email('Test01@Gmail.com ')
+    with mock.patch.object(user_service.user_dao, 'get_user_by_email') as get_user_by_email:
+        assert user_service.get_user_by_email('nobody@gmail.com') is None
+        get_user_by_email.assert_not_called()
+
+    # users signing up on this worker or another are added
+    user_service.create_new_user({
+        'name': 'testname04',
+        'email': 'test04@gmail.com',
+        'profile': 'test profile 04',
+        'password': 'testpw04'
+    })
+    user_service.consume({'type': 'user_created', 'payload': {'id': 5, 'email': 'test05@gmail.com'}})
+    assert user_service.get_user_by_email('test04@gmail.com')['name'] == 'testname04'
+    assert user_service.may_have_email('test05@gmail.com')
+
+    stats = user_service.get_email_filter_stats()
+    assert stats['ready']
+    assert stats['count'] == 5
+    assert stats['negatives'] == 1
+
+def test_get_public_profiles(user_service):
+    # user 1 is cached, user 2 and 3 are fetched together, user 100 doesn't exist
+    user_service.get_user_by_id(1)
+    result = user_service.get_public_profiles([1, 2, 3, 100])
+    assert result == {
+        user_id: {
+            'id': user_id,
+            'name': f'testname0{user_id}',
+            'profile': f'test profile 0{user_id}',
+            'profile_picture': None
+        } for user_id in [1, 2, 3]
+    }
+
+    # everything is cached now
+    misses = user_service.get_cache_stats()['misses']
+    user_service.get_public_profiles([1, 2, 3, 100])
+    assert user_service.get_cache_stats()['misses'] == misses
+
 def test_authorize(user_service):
     # case 1: use user 1's credential
     credential = {
@@ -153,6 +334,21 @@ def test_authorize(user_service):
     assert authorized == False
     assert user_id == False
 
+def test_rehash_password(user_service):
+    # users of setup are hashed with the default cost 12
+    user_service.bcrypt_rounds = 4
+    hashed_password = user_service.get_user_by_id(1)['hashed_password']
+    assert user_service.needs_rehash(hashed_password)
+
+    user_service.rehash_password(1, 'testpw01', hashed_password)
+    hashed_password = user_service.get_user_by_id(1)['hashed_password']
+    assert hashed_password.startswith('$2b$04$')
+    assert not user_service.needs_rehash(hashed_password)
+
+    # login still works
+    authorized, user_id = user_service.authorize({'email': 'test01@gmail.com', 'password': 'testpw01'})
+    assert authorized == True
+
 def test_get_user_id(user_service):
     # user 1
     email = 'test01@gmail.com'
@@ -188,11 +384,533 @@ def test_insert_tweet(tweet_service):
 def test_get_timeline(tweet_service):
     pass
 
+def test_search(tweet_service):
+    # newest first
+    tweet_service.insert_tweet(1, 'search test tweet')
+    result = tweet_service.search('test tweet', 10)
+    assert [tweet['tweet'] for tweet in result] == ['search test tweet', 'test tweet user 2']
+
+    # limit
+    result = tweet_service.search('test tweet', 1)
+    assert [tweet['tweet'] for tweet in result] == ['search test tweet']
+
+    # boolean mode operators are searched as text
+    result = tweet_service.search('+nothing -tweet"', 10)
+    assert result == []
+
+def test_extract_hashtags(trend_service):
+    result = trend_service.extract_hashtags('#Flask and #flask with #파이썬, not an email@domain')
+    assert result == {'flask', '파이썬'}
+
+def test_trends(trend_service):
+    # count hashtags of recorded tweets
+    trend_service.record_tweet('#python #flask')
+    trend_service.record_tweet('#python')
+    trend_service.record_tweet('no hashtag')
+    result = trend_service.get_trends(10)
+    assert result == [
+        {'hashtag': 'python', 'count': 2},
+        {'hashtag': 'flask', 'count': 1}
+    ]
+
+    # tweets older than the window are not counted
+    trend_service.top_updated_at = 0
+    trend_service.record_tweet('#old', time.time() - trend_service.window - trend_service.bucket_size)
+    assert trend_service.get_trends(1) == [{'hashtag': 'python', 'count': 2}]
+
+def test_trends_eviction():
+    trend_service = TrendService(TweetDAO(database), dict(config.test_config, TRENDS_MAX_HASHTAGS=2))
+    for tweet in ['#a', '#a', '#a', '#b', '#c']:
+        trend_service.record_tweet(tweet)
+    assert [trend['hashtag'] for trend in trend_service.get_trends(10)] == ['a', 'b']
+
+    # a new hashtag counted more than the lowest candidate takes its place
+    trend_service.record_tweet('#c')
+    trend_service.top_updated_at = 0
+    assert trend_service.get_trends(10) == [
+        {'hashtag': 'a', 'count': 3},
+        {'hashtag': 'c', 'count': 2}
+    ]
+
+def test_rebuild_trends(trend_service):
+    # restore counts from the tweets table
+    TweetDAO(database).insert_tweet(2, 1, 'rebuild #miniter')
+    TweetDAO(database).insert_tweet(3, 1, 'rebuild #miniter again')
+    trend_service.rebuild_batch_size = 1
+    trend_service.rebuild()
+    result = trend_service.get_trends(10)
+    assert result == [{'hashtag': 'miniter', 'count': 2}]
+
+def test_id_generator():
+    id_generator = IdGenerator(1)
+    ids = [id_generator.next_id() for _ in range(10000)]
+    assert ids == sorted(set(ids))
+
+    # ids sort by time across workers
+    other_id = IdGenerator(2).next_id(id_generator.last_timestamp + 1)
+    assert other_id > ids[-1]
+    assert id_generator.id_from_time(datetime.now() + timedelta(seconds=1)) > ids[-1]
+
+    with pytest.raises(ValueError):
+        IdGenerator(1024)
+
+def test_get_timeline_pagination(tweet_service):
+    # user 1 tweets 3 times, 2 per page
+    tweet_ids = [tweet_service.insert_tweet(1, f'page tweet {i}') for i in range(3)]
+    tweet_service.timeline_size = 2
+
+    result = tweet_service.get_timeline(1)
+    assert [tweet['id'] for tweet in result] == [tweet_ids[2], tweet_ids[1]]
+
+    result = tweet_service.get_timeline(1, result[-1]['id'])
+    assert [tweet['id'] for tweet in result] == [tweet_ids[0]]
+
+def test_get_timeline_recent_first(tweet_service):
+    # user 1 has an old tweet and a recent tweet
+    database.execute(text("""
+        INSERT INTO tweets (id, user_id, tweet, created_at)
+        VALUES (2, 1, 'old tweet', NOW() - INTERVAL 30 DAY)
+    """))
+    tweet_service.insert_tweet(1, 'recent tweet')
+
+    # recent tweets fill the timeline
+    tweet_service.timeline_size = 1
+    result = tweet_service.get_timeline(1)
+    assert [tweet['tweet'] for tweet in result] == ['recent tweet']
+
+    # older tweets are read when recent ones are not enough
+    tweet_service.timeline_size = 10
+    result = tweet_service.get_timeline(1)
+    assert [tweet['tweet'] for tweet in result] == ['recent tweet', 'old tweet']
+
+def test_get_timeline_since(tweet_service):
+    # user 3 already holds tweet 1 of user 2
+    assert tweet_service.get_timeline(3, since_id=1) == []
+
+    tweet_id = tweet_service.insert_tweet(2, 'new tweet')
+    result = tweet_service.get_timeline(3, since_id=1)
+    assert [tweet['id'] for tweet in result] == [tweet_id]
+    assert tweet_service.get_timeline(3, since_id=tweet_id) == []
+
+def test_get_timeline_since_pages(tweet_service):
+    # user 3 fell 3 tweets behind, 2 per page
+    tweet_ids = [tweet_service.insert_tweet(2, f'missed tweet {i}') for i in range(3)]
+    tweet_service.timeline_size = 2
+
+    # the oldest page comes first, so nothing between since_id and it is skipped
+    result = tweet_service.get_timeline(3, since_id=1)
+    assert isinstance(result, PartialTimeline)
+    assert [tweet['id'] for tweet in result] == [tweet_ids[1], tweet_ids[0]]
+
+    result = tweet_service.get_timeline(3, since_id=result[0]['id'])
+    assert not isinstance(result, PartialTimeline)
+    assert [tweet['id'] for tweet in result] == [tweet_ids[2]]
+
+def test_timeline_single_flight(tweet_service):
+    # 5 concurrent reads of the same timeline run one query
+    started = threading.Event()
+    release = threading.Event()
+    load_timeline = tweet_service.load_timeline
+    def slow_load_timeline(user_id, before_id, since_id=None):
+        started.set()
+        release.wait()
+        return load_timeline(user_id, before_id, since_id)
+    tweet_service.load_timeline = slow_load_timeline
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tweet_service.get_timeline(3))) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    while tweet_service.single_flight.stats()['requests'] < 5:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [[tweet['tweet'] for tweet in result] for result in results] == [['test tweet user 2']] * 5
+    stats = tweet_service.get_timeline_stats()['single_flight']
+    assert stats['executions'] == 1
+    assert stats['coalescing_ratio'] == 0.8
+
+def test_timeline_micro_cache():
+    tweet_service = TweetService(TweetDAO(database), dict(config.test_config, TIMELINE_MICRO_CACHE_TTL=60), IdGenerator(0))
+    assert len(tweet_service.get_timeline(3)) == 1
+
+    # followers may see a new tweet late, the author sees it at once
+    tweet_service.insert_tweet(2, 'cached tweet')
+    assert len(tweet_service.get_timeline(3)) == 1
+    assert len(tweet_service.get_timeline(2)) == 2
+    assert tweet_service.get_timeline_stats()['micro_cache']['hits'] == 1
+
+def test_circuit_breaker():
+    circuit_breaker = CircuitBreaker(2, 60)
+    def fail():
+        raise ValueError('failed')
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            circuit_breaker.call(fail)
+    # open: the call is not made
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.call(lambda: 'not called')
+
+    # half-open: one trial call closes it again
+    circuit_breaker.reset_timeout = 0
+    assert circuit_breaker.call(lambda: 'called') == 'called'
+    assert circuit_breaker.stats() == {'state': 'closed', 'failures': 0, 'opens': 1, 'rejected': 1}
+
+def test_timeline_stale():
+    tweet_service = TweetService(TweetDAO(database), dict(config.test_config, TIMELINE_BREAKER_FAILURES=1), IdGenerator(0))
+    timeline = tweet_service.get_timeline(3)
+    assert len(timeline) == 1
+
+    # DB fails: the last good timeline is served, and the open breaker keeps later reads off DB
+    error = OperationalError('SELECT', {}, Exception('maximum statement execution time exceeded'))
+    with mock.patch.object(tweet_service.tweet_dao, 'get_timeline', side_effect=error) as get_timeline:
+        stale = tweet_service.get_timeline(3)
+        assert isinstance(stale, StaleTimeline)
+        assert stale == timeline
+        assert tweet_service.get_timeline(3, since_id=timeline[0]['id']) == []
+        with pytest.raises(TimelineUnavailable):
+            tweet_service.get_timeline(2)
+        assert get_timeline.call_count == 1
+
+    stats = tweet_service.get_timeline_stats()
+    assert stats['circuit_breaker']['state'] == 'open'
+    assert stats['stale_reads'] == 2
+    assert stats['stale_rate'] == 2 / 3
+
+    # once DB is back, the next trial read closes the breaker
+    while tweet_service.refreshing:
+        time.sleep(0.01)
+    tweet_service.circuit_breaker.reset_timeout = 0
+    assert not isinstance(tweet_service.get_timeline(3), StaleTimeline)
+    assert tweet_service.get_timeline_stats()['circuit_breaker']['state'] == 'closed'
+
+def test_cache_warmer(user_service):
+    tweet_service = TweetService(
+        TweetDAO(database), dict(config.test_config, TIMELINE_SIZE=1, WARMUP_TWEETS_BATCH_SIZE=1), IdGenerator(0)
+    )
+    tweet_service.insert_tweet(2, 'recent tweet user 2')
+    tweet_service.insert_tweet(1, 'recent tweet user 1')
+    cache_warmer = CacheWarmer(user_service, tweet_service, dict(config.test_config, WARMUP_BATCH_SIZE=1))
+    assert cache_warmer.ready
+
+    # users 1 and 2 tweeted lately, user 3 did not
+    cache_warmer.run()
+    stats = cache_warmer.stats()
+    assert stats['state'] == 'done'
+    assert stats['emails'] == 3
+    assert stats['loaded_users'] == 2
+    assert stats['batches'] == 2
+    assert stats['timelines'] == 2
+    assert not stats['failed']
+
+    assert user_service.user_cache.get(('id', 1))['name'] == 'testname01'
+    assert user_service.user_cache.get(('id', 3)) is MISSING
+    assert [tweet['tweet'] for tweet in tweet_service.stale_cache.get(2)] == ['recent tweet user 2']
+
+    # warm timelines are read without DB, until an author tweets or the user follows someone
+    with mock.patch.object(tweet_service.tweet_dao, 'get_timeline') as get_timeline:
+        assert [tweet['tweet'] for tweet in tweet_service.get_timeline(2)] == ['recent tweet user 2']
+        assert get_timeline.call_count == 0
+    tweet_service.insert_tweet(2, 'new tweet user 2')
+    assert [tweet['tweet'] for tweet in tweet_service.get_timeline(2)] == ['new tweet user 2']
+    tweet_service.consume({'type': 'follow', 'payload': {'user_id': 1, 'follow_id': 3}})
+    assert tweet_service.warm_cache.get(1) is MISSING
+
+def test_timeline_broker():
+    timeline_broker = TimelineBroker()
+    relay = OutboxRelay(OutboxDAO(database), config.test_config)
+    relay.register('timeline_stream', timeline_broker.consume)
+    relay.load_checkpoints()
+    user_dao = UserDAO(database)
+    tweet_service = TweetService(TweetDAO(database), config.test_config, IdGenerator(0))
+
+    # user 3 follows user 2
+    received = []
+    subscription = timeline_broker.subscribe(3, [2], received.append)
+    tweet_service.insert_tweet(2, 'pushed tweet')
+    tweet_service.insert_tweet(1, 'not followed tweet')
+    tweet_service.insert_tweet(3, 'own tweet')
+    relay.run_once()
+    assert [entry['tweet'] for entry in received] == ['pushed tweet', 'own tweet']
+
+    # follows change what an open subscription gets
+    user_dao.insert_follow(3, 1)
+    user_dao.delete_follow(3, 2)
+    tweet_service.insert_tweet(1, 'newly followed tweet')
+    tweet_service.insert_tweet(2, 'unfollowed tweet')
+    relay.run_once()
+    assert [entry['tweet'] for entry in received][2:] == ['newly followed tweet']
+
+    timeline_broker.unsubscribe(subscription)
+    tweet_service.insert_tweet(1, 'closed tweet')
+    relay.run_once()
+    assert len(received) == 3
+    stats = timeline_broker.stats()
+    assert stats['subscriptions'] == 0
+    assert stats['authors'] == 0
+    assert stats['published'] == 6
+    assert stats['delivered'] == 3
+
+def test_outbox_relay(trend_service):
+    outbox_dao = OutboxDAO(database)
+    tweet_dao = TweetDAO(database)
+    tweet_dao.insert_tweet(5, 1, 'before the relay #old')
+
+    # a durable consumer fails once on the second event
+    received = []
+    def handler(event):
+        if event['payload']['id'] == 7 and 7 not in [event['payload']['id'] for event in received]:
+            received.append(event)
+            raise RuntimeError()
+        received.append(event)
+
+    relay = OutboxRelay(outbox_dao, dict(config.test_config, OUTBOX_BATCH_SIZE=2))
+    relay.register('test', handler, ['tweet_created'], durable=True)
+    relay.register('trends', trend_service.consume, ['tweet_created'])
+    relay.load_checkpoints()
+
+    # consumers start at the end of the log
+    tweet_dao.insert_tweet(6, 1, 'relayed #miniter')
+    UserDAO(database).insert_follow(1, 2)
+    tweet_dao.insert_tweet(7, 1, 'retried #miniter')
+    assert relay.run_once() == 2
+    assert [event['payload']['id'] for event in received] == [6]
+    assert relay.run_once() == 1
+    assert [event['payload']['id'] for event in received] == [6, 7]
+    assert relay.stats()['test']['failures'] == 1
+
+    # the failed event is delivered again, other consumers went on
+    assert relay.run_once() == 1
+    assert relay.run_once() == 0
+    assert [event['payload']['id'] for event in received] == [6, 7, 7]
+    assert trend_service.get_trends(10) == [{'hashtag': 'miniter', 'count': 2}]
+
+    # durable checkpoints survive the relay
+    last_event_id = outbox_dao.get_last_event_id()
+    assert outbox_dao.get_checkpoints(['test']) == {'test': last_event_id}
+    tweet_dao.insert_tweet(8, 1, 'after restart')
+    relay = OutboxRelay(outbox_dao, config.test_config)
+    relay.register('test', received.append, durable=True)
+    relay.load_checkpoints()
+    relay.run_once()
+    assert [event['payload']['id'] for event in received][-1] == 8
+    assert relay.prune() == 0
+
+def test_outbox_relay_failing_consumer():
+    tweet_dao = TweetDAO(database)
+    fixed = []
+    received = []
+    def handler(event):
+        if not fixed:
+            raise RuntimeError()
+        received.append(event)
+
+    healthy = []
+    relay = OutboxRelay(OutboxDAO(database), dict(config.test_config, OUTBOX_BATCH_SIZE=1))
+    relay.register('failing', handler, ['tweet_created'])
+    relay.register('healthy', healthy.append, ['tweet_created'])
+    relay.load_checkpoints()
+
+    # the failure outlasts a batch, the healthy consumer reads on past it
+    for tweet_id in range(5, 8):
+        tweet_dao.insert_tweet(tweet_id, 1, f'tweet {tweet_id}')
+    for _ in range(3):
+        assert relay.run_once() == 1
+    assert relay.run_once() == 0
+    assert [event['payload']['id'] for event in healthy] == [5, 6, 7]
+    assert relay.stats()['failing']['failures'] == 4
+
+    # once it works again it catches up from its own checkpoint
+    fixed.append(True)
+    for _ in range(3):
+        assert relay.run_once() == 1
+    assert relay.run_once() == 0
+    assert [event['payload']['id'] for event in received] == [5, 6, 7]
+    assert [event['payload']['id'] for event in healthy] == [5, 6, 7]
+
+def test_outbox_relay_out_of_order_commit():
+    received = []
+    relay = OutboxRelay(OutboxDAO(database), dict(config.test_config, OUTBOX_GAP_TIMEOUT=60))
+    relay.register('test', received.append)
+    relay.load_checkpoints()
+
+    # the first event commits after the second one
+    with database.connect() as connection:
+        transaction = connection.begin()
+        add_events(connection, [('test', {'n': 1})])
+        add_events(database, [('test', {'n': 2})])
+        assert relay.run_once() == 0
+        transaction.commit()
+    assert relay.run_once() == 2
+    assert [event['payload']['n'] for event in received] == [1, 2]
+
+    # the id of a rolled back event is skipped once the gap timed out
+    with database.connect() as connection:
+        transaction = connection.begin()
+        add_events(connection, [('test', {'n': 3})])
+        transaction.rollback()
+    add_events(database, [('test', {'n': 4})])
+    with mock.patch('service.outbox_relay.time.monotonic', return_value=1000):
+        assert relay.run_once() == 0
+    with mock.patch('service.outbox_relay.time.monotonic', return_value=1060):
+        assert relay.run_once() == 1
+    assert [event['payload']['n'] for event in received] == [1, 2, 4]
+    assert relay.gaps == {}
+
+def test_get_following_ids(user_service):
+    assert user_service.get_following_ids(3) == [2]
+    assert user_service.get_following_ids(3, batch_size=1) == [2]
+    assert user_service.get_following_ids(1) == []
+
+def test_archive(archive_service):
+    # user 1 has a tweet older than the hot tier
+    database.execute(text("""
+        INSERT INTO tweets (id, user_id, tweet, created_at)
+        VALUES (2, 1, 'archived tweet', NOW() - INTERVAL 400 DAY)
+    """))
+    month = database.execute(text("""
+        SELECT DATE_FORMAT(created_at, '%Y-%m') AS month FROM tweets WHERE tweet = 'archived tweet'
+    """)).fetchone()['month']
+
+    # a run failing midway, e.g. on a full disk, leaves no file behind and deletes no row
+    old_tweet = {'id': 2, 'user_id': 1, 'tweet': 'archived tweet', 'created_at': datetime.now() - timedelta(days=400)}
+    with mock.patch.object(archive_service.tweet_dao, 'get_tweets_before', side_effect=[[old_tweet], OSError()]):
+        with pytest.raises(OSError):
+            archive_service.archive(365)
+    assert os.listdir(archive_service.archive_path) == []
+    assert database.execute(text("SELECT COUNT(*) FROM tweets")).scalar() == 2
+
+    # move it to the archive
+    assert archive_service.archive(365) == 1
+    rows = database.execute(text("SELECT tweet FROM tweets")).fetchall()
+    assert [row['tweet'] for row in rows] == ['test tweet user 2']
+
+    # query the archive
+    result = list(archive_service.get_tweets(month, 1))
+    assert [tweet['tweet'] for tweet in result] == ['archived tweet']
+    assert list(archive_service.get_tweets(month, 2)) == []
+
+    # exports list archived tweets before the hot ones
+    database.execute(text("""
+        INSERT INTO tweets (id, user_id, tweet) VALUES (3, 1, 'hot tweet')
+    """))
+    export_service = ExportService(UserDAO(database), TweetDAO(database), config.test_config, archive_service)
+    result = [(record['type'], record['id']) for record in export_service.export_records(1)]
+    assert result == [('tweet', 2), ('tweet', 3)]
+    result = [(record['type'], record['id']) for record in export_service.export_records(1, 'tweet:2')]
+    assert result == [('tweet', 3)]
+
+def test_archive_by_user(archive_service):
+    # users 1 and 3 share a bucket of 2, and have old tweets in two archive runs
+    archive_service.user_buckets = 2
+    def insert_old_tweets(tweets):
+        for tweet_id, user_id in tweets:
+            database.execute(text("""
+                INSERT INTO tweets (id, user_id, tweet, created_at)
+                VALUES (:id, :user_id, 'archived tweet', NOW() - INTERVAL 400 DAY)
+            """), {'id': tweet_id, 'user_id': user_id})
+    insert_old_tweets([(4, 3), (2, 1), (3, 3)])
+    assert archive_service.archive(365) == 3
+    insert_old_tweets([(6, 1), (5, 3)])
+    assert archive_service.archive(365) == 2
+
+    # a user's tweets are read from the files of their bucket, in id order across runs
+    with mock.patch('service.archive_service.gzip.open', wraps=gzip.open) as opened:
+        assert [tweet['id'] for tweet in archive_service.get_user_tweets(1)] == [2, 6]
+    assert len(opened.call_args_list) == 2
+    assert all(call[0][0].endswith('.1-2.ndjson.gz') for call in opened.call_args_list)
+    assert [tweet['id'] for tweet in archive_service.get_user_tweets(3, 3)] == [4, 5]
+    assert list(archive_service.get_user_tweets(2)) == []
+
+def test_export_records(export_service):
+    # user 2 has a tweet and a follower, user 3 follows user 2
+    result = [(record['type'], record['id']) for record in export_service.export_records(2)]
+    assert result == [('tweet', 1), ('follower', 3)]
+
+    result = [(record['type'], record['id']) for record in export_service.export_records(3)]
+    assert result == [('following', 2)]
+
+    # resume after the tweet
+    result = [(record['type'], record['id']) for record in export_service.export_records(2, 'tweet:1')]
+    assert result == [('follower', 3)]
+
+    with pytest.raises(ValueError):
+        export_service.parse_cursor('likes:1')
+
+def test_export_formats(export_service):
+    records = list(export_service.export_records(2))
+    ndjson = ''.join(export_service.to_ndjson(records))
+    assert [json.loads(line)['type'] for line in ndjson.splitlines()] == ['tweet', 'follower']
+
+    csv = ''.join(export_service.to_csv(records))
+    assert csv.splitlines()[0] == 'type,id,tweet,created_at'
+    assert csv.splitlines()[1].startswith('tweet,1,test tweet user 2,')
+
+    assert gzip.decompress(b''.join(export_service.gzip(iter([csv])))).decode('utf-8') == csv
+
+def test_counters(user_service, tweet_service, counter_service):
+    # user 1 follows user 2 and tweets
+    user_service.follow(1, 2)
+    tweet_service.insert_tweet(1, 'counted tweet')
+
+    assert counter_service.get_counts(1) == {'followers': 0, 'following': 1, 'tweets': 1}
+    assert counter_service.get_counts(2) == {'followers': 1, 'following': 0, 'tweets': 0}
+
+    user_service.unfollow(1, 2)
+    assert counter_service.get_counts(2) == {'followers': 0, 'following': 0, 'tweets': 0}
+
+def test_counter_cache(user_service):
+    counter_service = CounterService(CounterDAO(database), dict(config.test_config, COUNTER_CACHE_TTL=60, SHARED_CACHE=True))
+    assert counter_service.get_counts(2) == {'followers': 0, 'following': 0, 'tweets': 0}
+
+    # cached counts lag behind until they expire
+    user_service.follow(1, 2)
+    assert counter_service.get_counts(2) == {'followers': 0, 'following': 0, 'tweets': 0}
+    assert counter_service.get_cache_stats()['hits'] == 1
+
+def test_reconcile_counters(counter_service):
+    # rows inserted in setup are not counted: user 2 and 3 drifted
+    assert counter_service.reconcile() == 2
+    assert counter_service.get_counts(2) == {'followers': 1, 'following': 0, 'tweets': 1}
+    assert counter_service.get_counts(3) == {'followers': 0, 'following': 1, 'tweets': 0}
+
+    # nothing to repair
+    assert counter_service.reconcile() == 0
+
+    # archived tweets are still counted
+    assert TweetDAO(database).delete_tweets_before(datetime.now() + timedelta(hours=1), 1, 10) == 1
+    assert counter_service.reconcile() == 0
+    assert counter_service.get_counts(2)['tweets'] == 1
+
+def test_recommendations(user_service, recommendation_service):
+    # user 1 follows user 3, who follows user 2
+    user_service.follow(1, 3)
+    assert recommendation_service.build() == 3
+
+    assert recommendation_service.get_recommendations(1) == [{'user_id': 2, 'score': 1}]
+    assert recommendation_service.get_recommendations(3) == []
+
+    # users left without candidates lose their recommendations
+    user_service.unfollow(1, 3)
+    recommendation_service.build()
+    assert recommendation_service.get_recommendations(1) == []
+
+    # followed users are not recommended
+    user_service.follow(1, 3)
+    user_service.follow(1, 2)
+    recommendation_service.build()
+    assert recommendation_service.get_recommendations(1) == []
+
 def test_get_and_save_profile_picture(user_service):
     # input
     user_id = 1
-    test_pic = mock.Mock()
-    image_url = f"{config.test_config['S3_BUCKET_URL']}{'profile_image/'}{user_id}{'.png'}"
+    test_pic = io.BytesIO(b'test image')
+    image_url = f"{config.test_config['S3_BUCKET_URL']}{'profile_image/'}{hashlib.sha256(b'test image').hexdigest()}{'.png'}"
 
     # get empty url
     result = user_service.get_profile_picture(user_id)
@@ -203,4 +921,108 @@ def test_get_and_save_profile_picture(user_service):
 
     # get url
     result = user_service.get_profile_picture(user_id)
-    assert result == image_url
\ No newline at end of file
+    assert result == image_url
+    user_service.s3.upload_fileobj.assert_called_once_with(
+        test_pic,
+        config.test_config['S3_BUCKET'],
+        f"{'profile_image/'}{hashlib.sha256(b'test image').hexdigest()}{'.png'}",
+        ExtraArgs={'CacheControl': 'public, max-age=31536000, immutable'}
+    )
+
+    # the same picture is stored once
+    user_service.save_profile_picture(io.BytesIO(b'test image'), 2)
+    assert user_service.get_profile_picture(2) == image_url
+    assert user_service.s3.upload_fileobj.call_count == 1
+
+def test_delete_unused_profile_pictures(user_service):
+    now = datetime.now(timezone.utc)
+    user_service.save_profile_picture(io.BytesIO(b'used image'), 1)
+    used_path = user_service.get_profile_picture(1)[len(config.test_config['S3_BUCKET_URL']):]
+    user_service.s3.get_paginator.return_value.paginate.return_value = [
+        {'Contents': [
+            {'Key': used_path, 'LastModified': now - timedelta(days=2)},
+            {'Key': 'profile_image/unused.png', 'LastModified': now - timedelta(days=2)}
+        ]},
+        {'Contents': [{'Key': 'profile_image/uploading.png', 'LastModified': now}]}
+    ]
+
+    # pictures still used or just uploaded are kept
+    assert user_service.delete_unused_profile_pictures() == 1
+    user_service.s3.delete_objects.assert_called_once_with(
+        Bucket=config.test_config['S3_BUCKET'],
+        Delete={'Objects': [{'Key': 'profile_image/unused.png'}], 'Quiet': True}
+    )
+
+def test_upload_service(tmp_path):
+    upload_service = UploadService(dict(config.test_config, UPLOAD_STAGING_PATH=str(tmp_path), UPLOAD_CHUNK_SIZE=4))
+    with pytest.raises(ValueError):
+        upload_service.create_upload(1, upload_service.max_size + 1)
+
+    # 10 bytes in chunks of 4, 4 and 2
+    upload = upload_service.create_upload(1, 10)
+    assert upload['chunks'] == 3
+    assert upload_service.get_upload(1, upload['upload_id']) == upload
+    assert upload_service.get_upload(2, upload['upload_id']) is None
+    assert upload_service.get_upload(1, '../' + upload['upload_id']) is None
+
+    # chunks of the wrong size or cut short are not kept
+    with pytest.raises(ValueError):
+        upload_service.save_chunk(upload, 2, io.BytesIO(b'mage'), 4)
+    with pytest.raises(ValueError):
+        upload_service.save_chunk(upload, 0, io.BytesIO(b'te'), 4)
+    with pytest.raises(ValueError):
+        upload_service.save_chunk(upload, 3, io.BytesIO(b'te'), 2)
+    assert upload_service.get_received_chunks(upload) == []
+
+    # chunks arrive in any order and can be sent again
+    upload_service.save_chunk(upload, 2, io.BytesIO(b'ge'), 2)
+    upload_service.save_chunk(upload, 0, io.BytesIO(b'test'), 4)
+    with pytest.raises(ValueError):
+        upload_service.get_chunk_paths(upload)
+    upload_service.save_chunk(upload, 1, io.BytesIO(b' ima'), 4)
+    upload_service.save_chunk(upload, 1, io.BytesIO(b' ima'), 4)
+    chunk_paths = upload_service.get_chunk_paths(upload)
+    assert b''.join(open(path, 'rb').read() for path in chunk_paths) == b'test image'
+
+    # expired uploads are deleted
+    assert upload_service.delete_expired_uploads() == 0
+    upload_service.ttl = -1
+    assert upload_service.get_upload(1, upload['upload_id']) is None
+    assert upload_service.delete_expired_uploads() == 1
+    assert list(tmp_path.iterdir()) == []
+
+def test_save_profile_picture_chunks(user_service, tmp_path):
+    chunk_paths = []
+    for index, data in enumerate([b'test', b' image']):
+        chunk_paths.append(str(tmp_path / f'{index}.chunk'))
+        with open(chunk_paths[-1], 'wb') as f:
+            f.write(data)
+    upload_path = f"{'profile_image/'}{hashlib.sha256(b'test image').hexdigest()}{'.png'}"
+    user_service.s3.create_multipart_upload.return_value = {'UploadId': 'upload'}
+
+    # failed uploads are aborted
+    user_service.s3.upload_part.side_effect = RuntimeError()
+    with pytest.raises(RuntimeError):
+        user_service.save_profile_picture_chunks(chunk_paths, 1)
+    user_service.s3.abort_multipart_upload.assert_called_once()
+    assert user_service.get_profile_picture(1) is None
+
+    user_service.s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag{kwargs['PartNumber']}"}
+    user_service.save_profile_picture_chunks(chunk_paths, 1)
+    user_service.s3.create_multipart_upload.assert_called_with(
+        Bucket=config.test_config['S3_BUCKET'],
+        Key=upload_path,
+        CacheControl='public, max-age=31536000, immutable'
+    )
+    user_service.s3.complete_multipart_upload.assert_called_once_with(
+        Bucket=config.test_config['S3_BUCKET'],
+        Key=upload_path,
+        UploadId='upload',
+        MultipartUpload={'Parts': [{'ETag': 'etag1', 'PartNumber': 1}, {'ETag': 'etag2', 'PartNumber': 2}]}
+    )
+    assert user_service.get_profile_picture(1) == f"{config.test_config['S3_BUCKET_URL']}{upload_path}"
+
+    # the same picture is stored once
+    user_service.save_profile_picture_chunks(chunk_paths, 2)
+    assert user_service.s3.complete_multipart_upload.call_count == 1
+    assert user_service.get_profile_picture(2) == f"{config.test_config['S3_BUCKET_URL']}{upload_path}"
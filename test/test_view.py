@@ -1,14 +1,23 @@
 import json
+import gzip
+import hashlib
 import bcrypt
 import time
 
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
 import pytest
 from unittest import mock
 import io
 
+from twisted.internet import defer, threads, task, reactor
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
 import config
 from app import create_app
+from view.timeline import TimelineResource, read_timeline
+from view.stream import TimelineEventsResource, TimelinePollResource
 
 database = create_engine(config.test_config['DB_URL'], encoding='utf-8', max_overflow=0)
 
@@ -79,14 +88,17 @@ def setup_function():
 
     # user 2 has a tweet
     tweet = {
+        'id': 1,
         'user_id': 2,
         'tweet': 'test tweet user 2'
     }
     database.execute(text("""
         INSERT INTO tweets (
+            id,
             user_id,
             tweet
         ) VALUES (
+            :id,
             :user_id,
             :tweet
         )
@@ -112,12 +124,33 @@ def teardown_function():
     database.execute(text("TRUNCATE users"))
     database.execute(text("TRUNCATE tweets"))
     database.execute(text("TRUNCATE users_follow_list"))
+    database.execute(text("TRUNCATE users_counters"))
+    database.execute(text("TRUNCATE users_archived_tweets"))
+    database.execute(text("TRUNCATE users_recommendations"))
+    database.execute(text("TRUNCATE outbox_events"))
+    database.execute(text("TRUNCATE outbox_checkpoints"))
     database.execute(text("SET FOREIGN_KEY_CHECKS=1"))
 
 def test_ping(api):
     res = api.get('/ping')
     assert b'pong' in res.data
 
+    # not healthy until the caches are warm
+    api.application.services.cache_warmer.state = 'warming'
+    res = api.get('/ping')
+    assert res.status_code == 503
+
+def test_metrics(api):
+    res = api.get('/metrics')
+    assert res.status_code == 200
+    data = json.loads(res.data.decode('utf-8'))
+    assert 'hit_rate' in data['user_cache']
+    assert 'coalescing_ratio' in data['timeline']['single_flight']
+    assert data['timeline']['circuit_breaker']['state'] == 'closed'
+    assert data['email_filter']['ready'] is False
+    assert data['timeline_stream']['subscriptions'] == 0
+    assert data['outbox']['trends']['failures'] == 0
+
 def test_login(api):
     # login user 1
     res = api.post(
@@ -131,6 +164,75 @@ def test_login(api):
     assert res.status_code == 200
     assert b'access_token' in res.data
 
+@mock.patch("app.boto3")
+def test_capture(mock_boto3, tmp_path):
+    capture_path = tmp_path / 'capture.log'
+    api = create_app(dict(config.test_config, CAPTURE_PATH=str(capture_path))).test_client()
+
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test01@gmail.com',
+            'password': 'testpw01'
+        }),
+        content_type = 'application/json'
+    )
+    assert res.status_code == 200
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+    res = api.get('/timeline?access_token=secret&before_id=5', headers = {'Authorization': access_token})
+    assert res.status_code == 200
+
+    # strings are only kept as their length, tokens as the user they belong to
+    login, timeline = [json.loads(line) for line in capture_path.read_text().splitlines()]
+    assert login['m'] == 'POST'
+    assert login['b'] == {'email': {'$str': 16}, 'password': {'$str': 8}}
+    assert login['s'] == 200
+    assert timeline['p'] == '/timeline?before_id=5'
+    assert timeline['u'] == 1
+    assert timeline['d'] > 0
+
+class CapturedRequest(DummyRequest):
+    # twisted.web.server.Request keeps the status in code
+    code = 200
+
+    def setResponseCode(self, code, message=None):
+        DummyRequest.setResponseCode(self, code, message)
+        self.code = code
+
+@mock.patch("app.boto3")
+def test_capture_timeline_resource(mock_boto3, tmp_path):
+    capture_path = tmp_path / 'capture.log'
+    app = create_app(dict(config.test_config, CAPTURE_PATH=str(capture_path)))
+    res = app.test_client().post(
+        '/login',
+        data = json.dumps({
+            'email': 'test03@gmail.com',
+            'password': 'testpw03'
+        }),
+        content_type = 'application/json'
+    )
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+
+    # timelines served by the reactor are captured like Flask requests
+    resource = TimelineResource(app, None)
+    read = defer.Deferred()
+    read.addCallback(lambda key: read_timeline(app.services, *key))
+    resource.read = lambda *key: read
+    request = CapturedRequest([])
+    request.prepath = [b'timeline']
+    request.args = {b'access_token': [b'secret'], b'before_id': [b'5']}
+    request.requestHeaders.addRawHeader('Authorization', access_token)
+    assert resource.render(request) == NOT_DONE_YET
+    read.callback((3, 5, None, False))
+    assert request.finished == 1
+
+    login, timeline = [json.loads(line) for line in capture_path.read_text().splitlines()]
+    assert timeline['m'] == 'GET'
+    assert timeline['p'] == '/timeline?before_id=5'
+    assert timeline['u'] == 3
+    assert timeline['s'] == 200
+    assert timeline['d'] >= 0
+
 def test_signup(api):
     # signup user 4
     res = api.post(
@@ -157,6 +259,33 @@ def test_signup(api):
     assert res.status_code == 200
     assert b"access_token" in res.data
 
+    # an email signs up once
+    res = api.post(
+        '/sign-up',
+        data = json.dumps({
+            'name': 'testname05',
+            'email': 'test04@gmail.com',
+            'password': 'testpw05',
+            'profile': 'test profile 05'
+        }),
+        content_type = 'application/json'
+    )
+    assert res.status_code == 409
+
+    # as well when a concurrent sign-up passed the check first
+    with mock.patch.object(api.application.services.user_service, 'get_user_by_email', return_value=None):
+        res = api.post(
+            '/sign-up',
+            data = json.dumps({
+                'name': 'testname05',
+                'email': 'test04@gmail.com',
+                'password': 'testpw05',
+                'profile': 'test profile 05'
+            }),
+            content_type = 'application/json'
+        )
+    assert res.status_code == 409
+
 def test_authorization(api):
     '''
     check if each endpoint returns 401 error
@@ -320,6 +449,236 @@ def test_timeline(api):
     assert tweets['timeline'][1]['tweet'] == 'test tweet #1'
 
 
+def test_timeline_authors(api):
+    # user 3 follows user 2
+    res = api.get('/timeline/3?embed=authors')
+    assert res.status_code == 200
+    tweets = json.loads(res.data.decode('utf-8'))
+    assert tweets['timeline'][0]['author'] == {
+        'id': 2,
+        'name': 'testname02',
+        'profile': 'test profile 02',
+        'profile_picture': None
+    }
+
+    # authors are embedded only when asked
+    res = api.get('/timeline/3')
+    tweets = json.loads(res.data.decode('utf-8'))
+    assert 'author' not in tweets['timeline'][0]
+
+def test_timeline_since(api):
+    # user 3 holds tweet 1, nothing is newer
+    res = api.get('/timeline/3?since_id=1')
+    assert res.status_code == 204
+    assert res.data == b''
+
+    res = api.get('/timeline/3?since_id=0')
+    assert res.status_code == 200
+    tweets = json.loads(res.data.decode('utf-8'))
+    assert [tweet['id'] for tweet in tweets['timeline']] == [1]
+    assert tweets['has_more'] is False
+    # ids are also sent as strings, which are accepted as cursors up to 2^63 - 1
+    assert tweets['timeline'][0]['id_str'] == '1'
+    res = api.get('/timeline/3?before_id=9223372036854775807')
+    assert res.status_code == 200
+
+    res = api.get('/timeline/3?since_id=1e3')
+    assert res.status_code == 400
+    res = api.get('/timeline/3?before_id=9223372036854775808')
+    assert res.status_code == 400
+
+def test_timeline_stale(api):
+    res = api.get('/timeline/3')
+    assert res.status_code == 200
+    assert 'stale' not in json.loads(res.data.decode('utf-8'))
+
+    # DB fails: the last good timeline is marked stale, other users get 503
+    tweet_dao = api.application.services.tweet_service.tweet_dao
+    error = OperationalError('SELECT', {}, Exception('maximum statement execution time exceeded'))
+    with mock.patch.object(tweet_dao, 'get_timeline', side_effect=error):
+        res = api.get('/timeline/3')
+        assert res.status_code == 200
+        tweets = json.loads(res.data.decode('utf-8'))
+        assert tweets['stale'] is True
+        assert [tweet['id'] for tweet in tweets['timeline']] == [1]
+
+        res = api.get('/timeline/2')
+        assert res.status_code == 503
+
+    res = api.get('/metrics')
+    data = json.loads(res.data.decode('utf-8'))
+    assert data['timeline']['stale_reads'] == 1
+
+def test_timeline_resource(api):
+    app = api.application
+    resource = TimelineResource(app, None)
+    reads = []
+
+    def read(*key):
+        reads.append(defer.Deferred())
+        reads[-1].addCallback(lambda _: read_timeline(app.services, *key))
+        return reads[-1]
+    resource.read = read
+
+    # identical requests in flight wait for one read
+    requests = [DummyRequest([b'3']) for _ in range(2)]
+    for request in requests:
+        assert resource.render(request) == NOT_DONE_YET
+    assert len(reads) == 1
+    reads[0].callback(None)
+    for request in requests:
+        assert request.finished == 1
+        assert request.responseCode == 200
+        tweets = json.loads(b''.join(request.written).decode('utf-8'))
+        assert [tweet['id'] for tweet in tweets['timeline']] == [1]
+
+    request = DummyRequest([b'3'])
+    request.args = {b'since_id': [b'1']}
+    resource.render(request)
+    reads[-1].callback(None)
+    assert request.responseCode == 204
+    assert request.written == []
+
+    # browsers get CORS headers as from the Flask app, and their preflight is answered
+    request = DummyRequest([b'3'])
+    request.requestHeaders.addRawHeader('Origin', 'https://miniter.example')
+    resource.render(request)
+    reads[-1].callback(None)
+    assert request.responseHeaders.getRawHeaders('Access-Control-Allow-Origin') == ['https://miniter.example']
+
+    request = DummyRequest([])
+    request.method = b'OPTIONS'
+    request.requestHeaders.addRawHeader('Origin', 'https://miniter.example')
+    request.requestHeaders.addRawHeader('Access-Control-Request-Method', 'GET')
+    request.requestHeaders.addRawHeader('Access-Control-Request-Headers', 'Authorization')
+    assert resource.render(request) == b''
+    assert request.responseHeaders.getRawHeaders('Access-Control-Allow-Origin') == ['https://miniter.example']
+    assert request.responseHeaders.getRawHeaders('Access-Control-Allow-Headers') == ['Authorization']
+    assert 'GET' in request.responseHeaders.getRawHeaders('Access-Control-Allow-Methods')[0]
+
+    # own timeline needs a token
+    request = DummyRequest([])
+    assert resource.render(request) == b''
+    assert request.responseCode == 401
+
+    request = DummyRequest([b'3', b'x'])
+    resource.render(request)
+    assert request.responseCode == 404
+
+    request = DummyRequest([b'3'])
+    request.args = {b'before_id': [b'x']}
+    resource.render(request)
+    assert request.responseCode == 400
+
+    # past max pending reads, new ones are turned down
+    resource.max_pending = 1
+    resource.render(DummyRequest([b'2']))
+    request = DummyRequest([b'3'])
+    assert resource.render(request) == b'Too many timeline reads in progress'
+    assert request.responseCode == 503
+
+def stream_request(access_token, args={}, headers={}):
+    request = DummyRequest([])
+    request.args = {name.encode('utf-8'): [value.encode('utf-8')] for name, value in args.items()}
+    for name, value in dict(headers, Authorization=access_token).items():
+        request.requestHeaders.addRawHeader(name, value)
+    return request
+
+def pushed_entry(tweet_id):
+    return {'id': tweet_id, 'id_str': str(tweet_id), 'user_id': 2, 'tweet': 'pushed tweet'}
+
+@pytest.fixture
+def inline_reactor():
+    # subscriptions open and pushed tweets arrive at once, timers run on a fake clock
+    clock = task.Clock()
+    with mock.patch.object(threads, 'deferToThread', defer.maybeDeferred), \
+            mock.patch.object(reactor, 'callFromThread', lambda f, *args: f(*args)), \
+            mock.patch.object(reactor, 'callLater', clock.callLater):
+        yield clock
+
+def test_stream_events(api, inline_reactor):
+    app = api.application
+    resource = TimelineEventsResource(app)
+    access_token = app.services.user_service.generate_access_token(3)
+    tweet_service = app.services.tweet_service
+
+    # user 3 reconnects after tweet 1 and missed 3 tweets, 2 pages of 1 are replayed
+    tweet_ids = [tweet_service.insert_tweet(2, f'missed tweet {i}') for i in range(3)]
+    tweet_service.timeline_size = 1
+    resource.backlog_pages = 2
+    request = stream_request(access_token, headers={'Last-Event-ID': '1'})
+    with mock.patch.object(resource, 'start_heartbeat'):
+        assert resource.render(request) == NOT_DONE_YET
+    app.services.timeline_broker.publish(pushed_entry(tweet_ids[-1] + 1))
+
+    events = b''.join(request.written).decode('utf-8').split('\n\n')
+    assert events[0] == 'retry: 3000'
+    assert [event.split('\n')[0] for event in events[1:-1]] == [
+        f'id: {tweet_ids[0]}',
+        f'id: {tweet_ids[1]}',
+        'event: gap',
+        f'id: {tweet_ids[-1] + 1}'
+    ]
+    # the rest is read from /timeline from the gap on
+    assert json.loads(events[3].split('data: ')[1]) == {'since_id': str(tweet_ids[1])}
+
+    # a closed stream unsubscribes
+    request.finish()
+    assert resource.connections == set()
+    assert app.services.timeline_broker.stats()['subscriptions'] == 0
+
+    request = stream_request(access_token, headers={'Last-Event-ID': 'x'})
+    assert resource.render(request) == b'Invalid tweet id: x'
+    assert request.responseCode == 400
+
+    request = DummyRequest([])
+    assert resource.render(request) == b''
+    assert request.responseCode == 401
+
+    # EventSource preflights are answered too
+    request = DummyRequest([])
+    request.method = b'OPTIONS'
+    request.requestHeaders.addRawHeader('Origin', 'https://miniter.example')
+    request.requestHeaders.addRawHeader('Access-Control-Request-Method', 'GET')
+    assert resource.render(request) == b''
+    assert request.responseHeaders.getRawHeaders('Access-Control-Allow-Origin') == ['https://miniter.example']
+
+def test_stream_poll(api, inline_reactor):
+    app = api.application
+    resource = TimelinePollResource(app)
+    access_token = app.services.user_service.generate_access_token(3)
+    tweet_service = app.services.tweet_service
+
+    # up to date: answered when a newer tweet is pushed
+    request = stream_request(access_token, {'since_id': '1'})
+    assert resource.render(request) == NOT_DONE_YET
+    assert request.finished == 0
+    app.services.timeline_broker.publish(pushed_entry(2))
+    assert request.finished == 1
+    body = json.loads(b''.join(request.written).decode('utf-8'))
+    assert body == {'user_id': 3, 'timeline': [pushed_entry(2)], 'has_more': False}
+    assert app.services.timeline_broker.stats()['subscriptions'] == 0
+
+    # nothing newer before the timeout
+    request = stream_request(access_token, {'since_id': '1', 'timeout': '5'})
+    resource.render(request)
+    inline_reactor.advance(5)
+    assert request.finished == 1
+    assert request.responseCode == 204
+
+    # more than a page behind: the oldest page at once
+    tweet_ids = [tweet_service.insert_tweet(2, f'missed tweet {i}') for i in range(2)]
+    tweet_service.timeline_size = 1
+    request = stream_request(access_token, {'since_id': '1'})
+    resource.render(request)
+    body = json.loads(b''.join(request.written).decode('utf-8'))
+    assert [tweet['id'] for tweet in body['timeline']] == [tweet_ids[0]]
+    assert body['has_more'] is True
+
+    request = stream_request(access_token)
+    assert resource.render(request) == b'since_id is required.'
+    assert request.responseCode == 400
+
 def test_follow(api):
     # login user 1
     res = api.post(
@@ -454,10 +813,226 @@ def test_upload_profile_picture(api):
     assert res.status_code == 200
 
     # get image url
-    image_url = f"{config.test_config['S3_BUCKET_URL']}{'profile_image/'}{user_id}{'.png'}"
+    image_url = f"{config.test_config['S3_BUCKET_URL']}{'profile_image/'}{hashlib.sha256(b'test image').hexdigest()}{'.png'}"
     res = api.get(f"/profile-picture/{user_id}")
     data = json.loads(res.data.decode('utf-8'))
     assert res.status_code == 200
     assert data['image_url'] == image_url
 
+def test_upload_profile_picture_chunks(api, tmp_path):
+    upload_service = api.application.services.upload_service
+    upload_service.staging_path = str(tmp_path)
+    upload_service.chunk_size = 4
+
+    # login user 1
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test01@gmail.com',
+            'password': 'testpw01'
+        }),
+        content_type = 'application/json'
+    )
+    login_info = json.loads(res.data.decode('utf-8'))
+    headers = {'Authorization': login_info['access_token']}
+
+    # too large files are refused before any chunk is sent
+    res = api.post(
+        '/profile-picture/uploads',
+        data = json.dumps({'size': upload_service.max_size + 1}),
+        content_type = 'application/json',
+        headers = headers
+    )
+    assert res.status_code == 413
+
+    for size in [0, -1, True, '10', None]:
+        res = api.post(
+            '/profile-picture/uploads',
+            data = json.dumps({'size': size}),
+            content_type = 'application/json',
+            headers = headers
+        )
+        assert res.status_code == 400
+
+    res = api.post(
+        '/profile-picture/uploads',
+        data = json.dumps({'size': 10}),
+        content_type = 'application/json',
+        headers = headers
+    )
+    assert res.status_code == 201
+    upload = json.loads(res.data.decode('utf-8'))
+    assert upload['chunks'] == 3
+    upload_url = f"/profile-picture/uploads/{upload['upload_id']}"
+
+    # chunks larger than the chunk size are refused
+    res = api.put(f'{upload_url}/chunks/0', data = b'test ', headers = headers)
+    assert res.status_code == 413
+
+    res = api.put(f'{upload_url}/chunks/0', data = b'test', headers = headers)
+    assert res.status_code == 204
+
+    # the upload can't complete until every chunk is received
+    res = api.post(f'{upload_url}/complete', headers = headers)
+    assert res.status_code == 409
+
+    # a resumed upload sends the missing chunks
+    res = api.get(upload_url, headers = headers)
+    assert json.loads(res.data.decode('utf-8'))['received'] == [0]
+    api.put(f'{upload_url}/chunks/1', data = b' ima', headers = headers)
+    api.put(f'{upload_url}/chunks/2', data = b'ge', headers = headers)
+
+    res = api.post(f'{upload_url}/complete', headers = headers)
+    assert res.status_code == 200
+    image_url = f"{config.test_config['S3_BUCKET_URL']}{'profile_image/'}{hashlib.sha256(b'test image').hexdigest()}{'.png'}"
+    assert json.loads(res.data.decode('utf-8'))['image_url'] == image_url
+    assert list(tmp_path.iterdir()) == []
+
+    # completed uploads are gone
+    res = api.get(upload_url, headers = headers)
+    assert res.status_code == 404
+
+def test_search(api):
+    # user 2's tweet
+    res = api.get('/search?q=user 2')
+    assert res.status_code == 200
+    data = json.loads(res.data.decode('utf-8'))
+    assert data['query'] == 'user 2'
+    assert data['tweets'][0]['user_id'] == 2
+    assert data['tweets'][0]['tweet'] == 'test tweet user 2'
+
+    # missing query
+    res = api.get('/search')
+    assert res.status_code == 400
+
+def test_trends(api):
+    # login user 1
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test01@gmail.com',
+            'password': 'testpw01'
+        }),
+        content_type = 'application/json'
+    )
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+
+    # tweet with a hashtag
+    res = api.post(
+        '/tweet',
+        data = json.dumps({'tweet': 'trend test #miniter'}),
+        content_type = 'application/json',
+        headers = {'Authorization': access_token}
+    )
+    assert res.status_code == 200
+
+    # trends are fed by the outbox relay
+    api.application.services.outbox_relay.run_once()
+    res = api.get('/trends')
+    assert res.status_code == 200
+    data = json.loads(res.data.decode('utf-8'))
+    assert data['trends'] == [{'hashtag': 'miniter', 'count': 1}]
+
+def test_export(api):
+    # login user 3
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test03@gmail.com',
+            'password': 'testpw03'
+        }),
+        content_type = 'application/json'
+    )
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+
+    # user 3 follows user 2
+    res = api.get('/users/3/export', headers = {'Authorization': access_token})
+    assert res.status_code == 200
+    records = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+    assert [(record['type'], record['id']) for record in records] == [('following', 2)]
+
+    # gzip
+    res = api.get('/users/3/export?format=csv', headers = {'Authorization': access_token, 'Accept-Encoding': 'gzip'})
+    assert res.status_code == 200
+    assert res.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(res.data).decode('utf-8').splitlines()[1].startswith('following,2,')
+
+    # other users can't be exported
+    res = api.get('/users/2/export', headers = {'Authorization': access_token})
+    assert res.status_code == 403
+
+def test_recommendations(api):
+    # user 1 follows user 3, who follows user 2
+    database.execute(text("INSERT INTO users_follow_list (user_id, follow_user_id) VALUES (1, 3)"))
+    app = api.application
+    app.services.recommendation_service.build()
+
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test01@gmail.com',
+            'password': 'testpw01'
+        }),
+        content_type = 'application/json'
+    )
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+
+    res = api.get('/recommendations', headers = {'Authorization': access_token})
+    assert res.status_code == 200
+    data = json.loads(res.data.decode('utf-8'))
+    assert [(user['id'], user['name'], user['score']) for user in data['recommendations']] == [(2, 'testname02', 1)]
+
+def test_user_profile(api):
+    # login user 1
+    res = api.post(
+        '/login',
+        data = json.dumps({
+            'email': 'test01@gmail.com',
+            'password': 'testpw01'
+        }),
+        content_type = 'application/json'
+    )
+    access_token = json.loads(res.data.decode('utf-8'))['access_token']
+
+    # follow user 2
+    res = api.post(
+        '/follow',
+        data = json.dumps({'follow': 2}),
+        content_type = 'application/json',
+        headers = {'Authorization': access_token}
+    )
+
+    res = api.get('/users/2')
+    assert res.status_code == 200
+    assert json.loads(res.data.decode('utf-8')) == {
+        'id': 2,
+        'name': 'testname02',
+        'profile': 'test profile 02',
+        'profile_picture': None,
+        'followers': 1,
+        'following': 0,
+        'tweets': 0
+    }
+
+    res = api.get('/users/100')
+    assert res.status_code == 404
+
+def test_users(api):
+    # users come in the requested order, unknown and repeated ids are skipped
+    res = api.get('/users?ids=3,1,100,3')
+    assert res.status_code == 200
+    users = json.loads(res.data.decode('utf-8'))['users']
+    assert [user['id'] for user in users] == [3, 1]
+    assert users[0] == {
+        'id': 3,
+        'name': 'testname03',
+        'profile': 'test profile 03',
+        'profile_picture': None
+    }
 
+    res = api.get('/users?ids=1,a')
+    assert res.status_code == 400
+    res = api.get('/users')
+    assert res.status_code == 400
+    res = api.get('/users?ids=' + ','.join(str(user_id) for user_id in range(1, 102)))
+    assert res.status_code == 400
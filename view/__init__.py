@@ -4,8 +4,11 @@ from functools import wraps
 from flask import jsonify, request, current_app, Response, g, send_file
 from flask.json import JSONEncoder
 from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 
+from .timeline import read_timeline, parse_tweet_id
+
 class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -40,18 +43,48 @@ def create_endpoints(app, services):
 
     user_service = services.user_service
     tweet_service = services.tweet_service
+    trend_service = services.trend_service
+    export_service = services.export_service
+    counter_service = services.counter_service
+    timeline_broker = services.timeline_broker
+    outbox_relay = services.outbox_relay
+    upload_service = services.upload_service
+    cache_warmer = services.cache_warmer
+    recommendation_service = services.recommendation_service
 
     # {'ping'}
     @app.route("/ping", methods=["GET"])
     def ping():
+        # load balancers hold traffic back until the caches are warm
+        if not cache_warmer.ready:
+            return "warming up", 503
         return "pong"
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return jsonify({
+            'user_cache': user_service.get_cache_stats(),
+            'counter_cache': counter_service.get_cache_stats(),
+            'email_filter': user_service.get_email_filter_stats(),
+            'timeline': tweet_service.get_timeline_stats(),
+            'timeline_stream': timeline_broker.stats(),
+            'outbox': outbox_relay.stats(),
+            'warmup': cache_warmer.stats()
+        })
     
     # {name, email, password, profile}
     @app.route("/sign-up", methods=["POST"])
     def sign_up():
         new_user = request.json
+        # the email filter answers most new emails without DB
+        if user_service.get_user_by_email(new_user['email']) is not None:
+            return 'Email is already registered', 409
         new_user['password'] = user_service.encrypt_password(new_user['password'])
-        insert_obj = user_service.create_new_user(new_user)
+        try:
+            insert_obj = user_service.create_new_user(new_user)
+        except IntegrityError:
+            # the same email signing up concurrently passed the check too
+            return 'Email is already registered', 409
         created_user_id = user_service.get_created_user_id(insert_obj)
         created_user = user_service.get_user_by_id(created_user_id)
 
@@ -115,24 +148,118 @@ def create_endpoints(app, services):
         user_service.unfollow(user_id, unfollow_id)
         return '', 200
 
+    # servers answer these from view.timeline, off the WSGI thread pool
+    def timeline_response(user_id):
+        # cursors are the id_str of a tweet
+        try:
+            before_id = parse_tweet_id(request.args.get('before_id'))
+            since_id = parse_tweet_id(request.args.get('since_id'))
+        except ValueError as e:
+            return str(e), 400
+
+        status, body = read_timeline(
+            services,
+            user_id,
+            before_id,
+            since_id,
+            'authors' in request.args.get('embed', '').split(',')
+        )
+        return (jsonify(body) if isinstance(body, dict) else body), status
+
     @app.route('/timeline/<int:user_id>', methods=['GET'])
     def timeline(user_id):
-        timeline = tweet_service.get_timeline(user_id)
-        return jsonify({
-            'user_id': user_id,
-            'timeline': timeline
-        })
+        return timeline_response(user_id)
 
     @app.route("/timeline", methods=["GET"])
     @login_required
     def user_timeline():
+        return timeline_response(g.user_id)
+
+    @app.route("/search", methods=["GET"])
+    def search():
+        query = request.args.get('q', '').strip()
+        limit = request.args.get('limit', 20, type=int)
+
+        if not query:
+            return 'Query is missing', 400
+
+        tweets = tweet_service.search(query, min(max(limit, 1), 100))
+        return jsonify({
+            'query': query,
+            'tweets': tweets
+        })
+
+    @app.route("/trends", methods=["GET"])
+    def trends():
+        limit = request.args.get('limit', 10, type=int)
+        return jsonify({'trends': trend_service.get_trends(max(limit, 1))})
+
+    @app.route('/users', methods=['GET'])
+    def users():
+        try:
+            user_ids = [int(user_id) for user_id in request.args.get('ids', '').split(',') if user_id]
+        except ValueError:
+            return 'Invalid ids', 400
+
+        max_ids = app.config.get('USERS_MAX_IDS', 100)
+        if not user_ids or len(user_ids) > max_ids:
+            return f'1 to {max_ids} ids are required', 400
+
+        # cached users are served from memory, the others are read with one query
+        profiles = user_service.get_public_profiles(user_ids)
+        return jsonify({
+            'users': [profiles[user_id] for user_id in dict.fromkeys(user_ids) if user_id in profiles]
+        })
+
+    @app.route('/users/<int:user_id>', methods=['GET'])
+    def user_profile(user_id):
+        profiles = user_service.get_public_profiles([user_id])
+        if user_id not in profiles:
+            return '', 404
+
+        return jsonify(dict(profiles[user_id], **counter_service.get_counts(user_id)))
+
+    @app.route('/recommendations', methods=['GET'])
+    @login_required
+    def recommendations():
         user_id = g.user_id
-        timeline = tweet_service.get_timeline(user_id)
+        recommended = recommendation_service.get_recommendations(user_id)
+        profiles = user_service.get_public_profiles([user['user_id'] for user in recommended])
         return jsonify({
             'user_id': user_id,
-            'timeline': timeline
+            'recommendations': [dict(profiles[user['user_id']], score=user['score'])
+                for user in recommended if user['user_id'] in profiles]
         })
 
+    @app.route('/users/<int:user_id>/export', methods=['GET'])
+    @login_required
+    def export_user(user_id):
+        if user_id != g.user_id:
+            return '', 403
+
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ['ndjson', 'csv']:
+            return 'Unknown format', 400
+
+        after = request.args.get('after')
+        try:
+            export_service.parse_cursor(after)
+        except ValueError:
+            return 'Invalid cursor', 400
+
+        records = export_service.export_records(user_id, after)
+        if export_format == 'csv':
+            body, mimetype = export_service.to_csv(records), 'text/csv'
+        else:
+            body, mimetype = export_service.to_ndjson(records), 'application/x-ndjson'
+
+        headers = {'Content-Disposition': f'attachment; filename=miniter-{user_id}.{export_format}'}
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = export_service.gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        return Response(body, mimetype=mimetype, headers=headers)
+
     # {profile_pic, filename}
     @app.route('/profile-picture', methods=['POST'])
     @login_required
@@ -152,6 +279,79 @@ def create_endpoints(app, services):
 
         return '', 200
 
+    # {size}
+    @app.route('/profile-picture/uploads', methods=['POST'])
+    @login_required
+    def create_profile_picture_upload():
+        size = (request.json or {}).get('size')
+        # JSON true is an int to isinstance
+        if type(size) is not int or size <= 0:
+            return 'File size must be a positive number of bytes', 400
+
+        try:
+            upload = upload_service.create_upload(g.user_id, size)
+        except ValueError as e:
+            # only too large sizes are left
+            return str(e), 413
+
+        return jsonify({
+            'upload_id': upload['upload_id'],
+            'chunk_size': upload['chunk_size'],
+            'chunks': upload['chunks']
+        }), 201
+
+    @app.route('/profile-picture/uploads/<upload_id>', methods=['GET'])
+    @login_required
+    def get_profile_picture_upload(upload_id):
+        upload = upload_service.get_upload(g.user_id, upload_id)
+        if upload is None:
+            return '', 404
+
+        # resumed uploads only send the chunks that are not received yet
+        return jsonify({
+            'upload_id': upload_id,
+            'chunks': upload['chunks'],
+            'received': upload_service.get_received_chunks(upload)
+        })
+
+    @app.route('/profile-picture/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+    @login_required
+    def put_profile_picture_chunk(upload_id, index):
+        upload = upload_service.get_upload(g.user_id, upload_id)
+        if upload is None:
+            return '', 404
+
+        # checked before the body is read
+        if request.content_length is None:
+            return 'Content-Length is required', 411
+        if request.content_length > upload['chunk_size']:
+            return f"Chunks must be {upload['chunk_size']} bytes at most", 413
+
+        try:
+            upload_service.save_chunk(upload, index, request.stream, request.content_length)
+        except ValueError as e:
+            return str(e), 400
+
+        return '', 204
+
+    @app.route('/profile-picture/uploads/<upload_id>/complete', methods=['POST'])
+    @login_required
+    def complete_profile_picture_upload(upload_id):
+        user_id = g.user_id
+        upload = upload_service.get_upload(user_id, upload_id)
+        if upload is None:
+            return '', 404
+
+        try:
+            chunk_paths = upload_service.get_chunk_paths(upload)
+        except ValueError as e:
+            return str(e), 409
+
+        user_service.save_profile_picture_chunks(chunk_paths, user_id)
+        upload_service.delete_upload(upload)
+
+        return jsonify({'image_url': user_service.get_profile_picture(user_id)})
+
     @app.route('/profile-picture/<int:user_id>', methods=['GET'])
     def get_profile_picture(user_id):
         profile_picture = user_service.get_profile_picture(user_id)
@@ -0,0 +1,131 @@
+import io
+import json
+import time
+import random
+import threading
+import jwt
+
+from urllib.parse import parse_qsl, urlencode
+from werkzeug.wsgi import ClosingIterator
+
+def body_shape(value):
+    # strings only keep their length, so emails, passwords and tweets never reach the log
+    if isinstance(value, dict):
+        return {key: body_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [body_shape(item) for item in value]
+    if isinstance(value, str):
+        return {'$str': len(value)}
+    return value
+
+def filter_query(query):
+    return urlencode([(key, value) for key, value in query if key != 'access_token'])
+
+class TrafficCapture:
+    '''
+    WSGI middleware appending one compact JSON line per request to a capture log:
+    start time, method, path, caller, JSON body shape, status and duration.
+    Requests served by Twisted resources outside the WSGI app are recorded the same way.
+    Replaying the log with the replay_traffic command gives load shaped like production.
+    '''
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.sample_rate = config.get('CAPTURE_SAMPLE_RATE', 1.0)
+        self.max_body_size = config.get('CAPTURE_MAX_BODY_SIZE', 64 * 1024)
+        # line buffered, so each record is a single append even with several workers
+        self.log = open(config['CAPTURE_PATH'], 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not self.sampled():
+            return self.wsgi_app(environ, start_response)
+
+        record = {
+            't': round(time.time(), 3),
+            'm': environ['REQUEST_METHOD'],
+            'p': self.get_path(environ)
+        }
+        access_token = environ.get('HTTP_AUTHORIZATION')
+        if access_token is not None:
+            record['u'] = self.get_user_id(access_token)
+        body = self.read_json_body(environ)
+        if body is not None:
+            record['b'] = body
+
+        started_at = time.monotonic()
+        def capture_start_response(status, headers, exc_info=None):
+            record['s'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        # timed until the body is sent, streamed responses included
+        return ClosingIterator(
+            self.wsgi_app(environ, capture_start_response),
+            lambda: self.write(record, started_at)
+        )
+
+    def capture_resource_request(self, request):
+        if not self.sampled():
+            return
+
+        path = '/' + b'/'.join(request.prepath + request.postpath).decode('utf-8', 'replace')
+        query = filter_query(
+            (key.decode('utf-8', 'replace'), value.decode('utf-8', 'replace'))
+            for key, values in request.args.items() for value in values
+        )
+        record = {
+            't': round(time.time(), 3),
+            'm': request.method.decode('ascii'),
+            'p': path + '?' + query if query else path
+        }
+        # event streams may send the token as a query argument
+        access_token = request.getHeader('Authorization')
+        if access_token is None and b'access_token' in request.args:
+            access_token = request.args[b'access_token'][0].decode('utf-8', 'replace')
+        if access_token is not None:
+            record['u'] = self.get_user_id(access_token)
+
+        started_at = time.monotonic()
+        def write_record(_):
+            # also when the client went away, e.g. a closed event stream
+            record['s'] = request.code
+            self.write(record, started_at)
+        request.notifyFinish().addBoth(write_record)
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def write(self, record, started_at):
+        record['d'] = round(time.monotonic() - started_at, 4)
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.log.write(line)
+
+    def get_path(self, environ):
+        path = environ.get('PATH_INFO', '')
+        query = filter_query(parse_qsl(environ.get('QUERY_STRING', '')))
+        return path + '?' + query if query else path
+
+    def get_user_id(self, access_token):
+        # only recorded, never trusted, so the signature isn't checked
+        try:
+            return jwt.decode(access_token, options={'verify_signature': False}).get('user_id')
+        except jwt.InvalidTokenError:
+            return None
+
+    def read_json_body(self, environ):
+        if not environ.get('CONTENT_TYPE', '').startswith('application/json'):
+            return None
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None
+        if not 0 < length <= self.max_body_size:
+            return None
+
+        # read once, and handed to the app again
+        data = environ['wsgi.input'].read(length)
+        environ['wsgi.input'] = io.BytesIO(data)
+        try:
+            return body_shape(json.loads(data))
+        except ValueError:
+            return None
@@ -0,0 +1,257 @@
+import json
+import jwt
+
+from abc import ABC, abstractmethod
+from twisted.internet import threads
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from service import PartialTimeline
+from .timeline import AppResource, parse_tweet_id
+
+# the reactor is imported where it is used, since pre-forked workers install their own
+
+def create_stream_resource(app):
+    '''
+    /stream/timeline pushes new timeline tweets as Server-Sent Events,
+    /stream/poll?since_id= answers as soon as there is a newer tweet (long-poll).
+    They are Twisted resources rather than Flask views, so an idle connection costs
+    a socket and a broker subscription instead of a thread of the WSGI pool.
+    '''
+    resource = Resource()
+    resource.putChild(b'timeline', TimelineEventsResource(app))
+    resource.putChild(b'poll', TimelinePollResource(app))
+    return resource
+
+def get_arg(request, name):
+    values = request.args.get(name.encode('utf-8'))
+    return values[0].decode('utf-8') if values else None
+
+def get_int_arg(request, name):
+    try:
+        return int(get_arg(request, name))
+    except (TypeError, ValueError):
+        return None
+
+class TimelinePushResource(AppResource):
+    isLeaf = True
+
+    def __init__(self, app):
+        AppResource.__init__(self, app)
+        self.config = app.config
+        self.json_encoder = app.json_encoder
+        self.user_service = app.services.user_service
+        self.tweet_service = app.services.tweet_service
+        self.timeline_broker = app.services.timeline_broker
+
+    def authenticate(self, request):
+        # EventSource can't set headers, so the token may also come as a query argument
+        access_token = request.getHeader('Authorization') or get_arg(request, 'access_token')
+        if access_token is None:
+            return None
+        try:
+            payload = jwt.decode(access_token, self.config['JWT_SECRET_KEY'], 'HS256')
+        except jwt.InvalidTokenError:
+            return None
+        return payload['user_id']
+
+    def open(self, request, connection, since_id):
+        from twisted.internet import reactor
+
+        def deliver(entry):
+            # called from the thread that inserted the tweet
+            reactor.callFromThread(connection.receive, entry)
+
+        def subscribe():
+            subscription = self.timeline_broker.subscribe(
+                connection.user_id,
+                self.user_service.get_following_ids(connection.user_id),
+                deliver
+            )
+            backlog, has_more = [], False
+            if since_id is not None:
+                backlog, has_more = self.read_backlog(connection.user_id, since_id)
+            return subscription, backlog, has_more
+
+        request.notifyFinish().addBoth(lambda _: connection.close())
+        # subscribing reads DB, which must not block the reactor
+        threads.deferToThread(subscribe).addCallbacks(connection.start, connection.fail)
+
+    def read_backlog(self, user_id, since_id):
+        # newest first, up to backlog_pages pages after since_id, and whether more are left
+        backlog = []
+        for _ in range(self.backlog_pages):
+            page = self.tweet_service.get_timeline(user_id, since_id=since_id)
+            backlog = page + backlog
+            if not isinstance(page, PartialTimeline):
+                return backlog, False
+            since_id = page[0]['id']
+        return backlog, True
+
+    def encode(self, value):
+        return json.dumps(value, cls=self.json_encoder)
+
+class TimelineConnection(ABC):
+    def __init__(self, resource, request, user_id):
+        self.resource = resource
+        self.request = request
+        self.user_id = user_id
+        self.subscription = None
+        # tweets pushed while the subscription is being opened
+        self.pending = []
+        self.closed = False
+
+    def receive(self, entry):
+        if self.closed:
+            return
+        if self.pending is not None:
+            self.pending.append(entry)
+        else:
+            self.send([entry])
+
+    def start(self, result):
+        self.subscription, backlog, has_more = result
+        if self.closed:
+            self.resource.timeline_broker.unsubscribe(self.subscription)
+            return
+
+        # tweets published while the backlog was read may be in both
+        backlog_ids = {entry['id'] for entry in backlog}
+        pending = [entry for entry in self.pending if entry['id'] not in backlog_ids]
+        self.pending = None
+        if has_more:
+            # tweets between the backlog and the pushed ones are left out
+            self.send(list(reversed(backlog)), has_more=True)
+            self.send(pending)
+        else:
+            self.send(list(reversed(backlog)) + pending)
+
+    @abstractmethod
+    def send(self, entries, has_more=False):
+        # entries come oldest first, has_more when tweets after them are left out
+        pass
+
+    def fail(self, failure):
+        log.err(failure, 'Failed to open a timeline stream')
+        if not self.closed:
+            self.request.setResponseCode(500)
+            self.request.finish()
+
+    def close(self):
+        self.closed = True
+        if self.subscription is not None:
+            self.resource.timeline_broker.unsubscribe(self.subscription)
+
+class TimelineEventsResource(TimelinePushResource):
+    def __init__(self, app):
+        TimelinePushResource.__init__(self, app)
+        self.heartbeat_interval = app.config.get('TIMELINE_STREAM_HEARTBEAT', 15)
+        self.backlog_pages = app.config.get('TIMELINE_STREAM_BACKLOG_PAGES', 10)
+        self.connections = set()
+        self.heartbeat = None
+
+    def render_GET(self, request):
+        user_id = self.authenticate(request)
+        if user_id is None:
+            request.setResponseCode(401)
+            return b''
+
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        # reconnecting EventSources send the id of the last event they got
+        try:
+            since_id = parse_tweet_id(request.getHeader('Last-Event-ID') or get_arg(request, 'since_id'))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e).encode('utf-8')
+
+        connection = EventConnection(self, request, user_id)
+        self.connections.add(connection)
+        self.start_heartbeat()
+        self.open(request, connection, since_id)
+        return NOT_DONE_YET
+
+    def start_heartbeat(self):
+        # one timer for all connections keeps proxies from closing idle streams
+        if self.heartbeat is None:
+            from twisted.internet.task import LoopingCall
+            self.heartbeat = LoopingCall(self.send_heartbeat)
+            self.heartbeat.start(self.heartbeat_interval, now=False)
+
+    def send_heartbeat(self):
+        for connection in list(self.connections):
+            if connection.subscription is not None:
+                connection.request.write(b': heartbeat\n\n')
+
+class EventConnection(TimelineConnection):
+    def start(self, result):
+        if not self.closed:
+            self.request.write(b'retry: 3000\n\n')
+        TimelineConnection.start(self, result)
+
+    def send(self, entries, has_more=False):
+        for entry in entries:
+            event = f'id: {entry["id"]}\ndata: {self.resource.encode(entry)}\n\n'
+            self.request.write(event.encode('utf-8'))
+        if has_more and entries:
+            # clients fill the gap from /timeline with this since_id
+            gap = self.resource.encode({'since_id': entries[-1]['id_str']})
+            self.request.write(f'event: gap\ndata: {gap}\n\n'.encode('utf-8'))
+
+    def close(self):
+        TimelineConnection.close(self)
+        self.resource.connections.discard(self)
+
+class TimelinePollResource(TimelinePushResource):
+    def __init__(self, app):
+        TimelinePushResource.__init__(self, app)
+        self.max_timeout = app.config.get('TIMELINE_POLL_TIMEOUT', 30)
+        # one page per answer, the client polls again for the rest
+        self.backlog_pages = 1
+
+    def render_GET(self, request):
+        user_id = self.authenticate(request)
+        if user_id is None:
+            request.setResponseCode(401)
+            return b''
+
+        try:
+            since_id = parse_tweet_id(get_arg(request, 'since_id'))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e).encode('utf-8')
+        if since_id is None:
+            request.setResponseCode(400)
+            return b'since_id is required.'
+        timeout = min(get_int_arg(request, 'timeout') or self.max_timeout, self.max_timeout)
+
+        from twisted.internet import reactor
+        connection = PollConnection(self, request, user_id)
+        connection.timer = reactor.callLater(timeout, connection.timeout)
+        self.open(request, connection, since_id)
+        return NOT_DONE_YET
+
+class PollConnection(TimelineConnection):
+    timer = None
+
+    def send(self, entries, has_more=False):
+        if self.closed or self.request.finished or not entries:
+            return
+        self.request.setHeader('Content-Type', 'application/json')
+        self.request.write(self.resource.encode({
+            'user_id': self.user_id,
+            'timeline': list(reversed(entries)),
+            'has_more': has_more
+        }).encode('utf-8'))
+        self.request.finish()
+
+    def timeout(self):
+        if not self.closed:
+            self.request.setResponseCode(204)
+            self.request.finish()
+
+    def close(self):
+        TimelineConnection.close(self)
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
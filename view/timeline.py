@@ -0,0 +1,187 @@
+import json
+import jwt
+
+from flask_cors.core import get_cors_options, get_cors_headers
+from twisted.internet import threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from werkzeug.datastructures import Headers
+
+from service import TimelineUnavailable, StaleTimeline, PartialTimeline
+
+# the reactor is imported where it is used, since pre-forked workers install their own
+
+def parse_tweet_id(value):
+    '''
+    A tweet id cursor as clients send it back, the digits of id_str.
+    None when it is missing, ValueError when it isn't a tweet id.
+    '''
+    if not value:
+        return None
+    if not (value.isascii() and value.isdigit()) or int(value) >= 1 << 63:
+        raise ValueError(f'Invalid tweet id: {value}')
+    return int(value)
+
+def set_cors_headers(request, cors_options):
+    # the headers CORS(app) adds to Flask responses, for resources Flask never sees
+    headers = Headers([
+        (name.decode('latin-1'), value.decode('latin-1'))
+        for name, values in request.requestHeaders.getAllRawHeaders()
+        for value in values
+    ])
+    for name, value in get_cors_headers(cors_options, headers, request.method.decode('ascii')).items(multi=True):
+        request.setHeader(name, value)
+
+class AppResource(Resource):
+    '''
+    A Twisted resource that answers CORS like the Flask app, with its CORS_* settings,
+    including the preflight a browser sends before a request with an Authorization header.
+    Its requests go to the app's traffic capture too, when there is one.
+    '''
+    def __init__(self, app):
+        Resource.__init__(self)
+        self.cors_options = get_cors_options(app)
+        self.traffic_capture = app.traffic_capture
+
+    def render(self, request):
+        if self.traffic_capture is not None:
+            self.traffic_capture.capture_resource_request(request)
+        set_cors_headers(request, self.cors_options)
+        return Resource.render(self, request)
+
+    def render_OPTIONS(self, request):
+        return b''
+
+def read_timeline(services, user_id, before_id, since_id, embed_authors):
+    '''
+    Reads a timeline response as (status, body), for both the Flask route and the Twisted resource.
+    '''
+    try:
+        timeline = services.tweet_service.get_timeline(user_id, before_id, since_id)
+    except TimelineUnavailable:
+        return 503, 'Timeline is temporarily unavailable'
+    # polling clients that are up to date get an empty response
+    if since_id is not None and not timeline:
+        return 204, ''
+
+    entries = timeline
+    if embed_authors:
+        authors = services.user_service.get_public_profiles({entry['user_id'] for entry in timeline})
+        entries = [dict(entry, author=authors.get(entry['user_id'])) for entry in timeline]
+
+    body = {
+        'user_id': user_id,
+        'timeline': entries
+    }
+    if since_id is not None:
+        # more tweets are left after these, to be read with the newest of them as since_id
+        body['has_more'] = isinstance(timeline, PartialTimeline)
+    if isinstance(timeline, StaleTimeline):
+        body['stale'] = True
+    return 200, body
+
+def create_timeline_resource(app):
+    '''
+    /timeline and /timeline/<user_id> served by the reactor instead of the WSGI app.
+    A request waiting for DB is a Deferred rather than a blocked thread of the WSGI pool,
+    identical reads in flight share one read, and reads run on their own thread pool no
+    larger than their share of DB connections, so a timeline burst queues in memory
+    instead of starving other routes or waiting on the connection pool.
+    '''
+    from twisted.internet import reactor
+
+    thread_pool = ThreadPool(1, app.config['TIMELINE_THREAD_POOL_SIZE'], 'timeline')
+    reactor.callWhenRunning(thread_pool.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', thread_pool.stop)
+    return TimelineResource(app, thread_pool)
+
+def get_id_arg(request, name):
+    values = request.args.get(name.encode('utf-8'))
+    return parse_tweet_id(values[0].decode('utf-8', 'replace') if values else None)
+
+class TimelineResource(AppResource):
+    isLeaf = True
+
+    def __init__(self, app, thread_pool):
+        AppResource.__init__(self, app)
+        self.config = app.config
+        self.json_encoder = app.json_encoder
+        self.services = app.services
+        self.thread_pool = thread_pool
+        self.max_pending = app.config.get('TIMELINE_MAX_PENDING', 10000)
+        # (user_id, before_id, since_id, embed_authors) -> requests waiting for that read
+        self.pending = {}
+
+    def render_GET(self, request):
+        if request.postpath in ([], [b'']):
+            user_id = self.authenticate(request)
+            if user_id is None:
+                request.setResponseCode(401)
+                return b''
+        elif len(request.postpath) == 1 and request.postpath[0].isdigit():
+            user_id = int(request.postpath[0])
+        else:
+            request.setResponseCode(404)
+            return b''
+
+        try:
+            before_id, since_id = get_id_arg(request, 'before_id'), get_id_arg(request, 'since_id')
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e).encode('utf-8')
+        embed = request.args.get(b'embed', [b''])[0].decode('utf-8', 'replace').split(',')
+        key = (user_id, before_id, since_id, 'authors' in embed)
+        waiting = self.pending.get(key)
+        if waiting is None:
+            if len(self.pending) >= self.max_pending:
+                request.setResponseCode(503)
+                return b'Too many timeline reads in progress'
+            waiting = self.pending[key] = []
+            self.read(*key).addBoth(self.respond, key)
+
+        waiting.append(request)
+        request.notifyFinish().addErrback(self.forget, waiting, request)
+        return NOT_DONE_YET
+
+    def read(self, user_id, before_id, since_id, embed_authors):
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(
+            reactor, self.thread_pool, read_timeline, self.services, user_id, before_id, since_id, embed_authors
+        )
+
+    def forget(self, failure, waiting, request):
+        if request in waiting:
+            waiting.remove(request)
+
+    def authenticate(self, request):
+        access_token = request.getHeader('Authorization')
+        if access_token is None:
+            return None
+        try:
+            payload = jwt.decode(access_token, self.config['JWT_SECRET_KEY'], 'HS256')
+        except jwt.InvalidTokenError:
+            return None
+        return payload['user_id']
+
+    def respond(self, result, key):
+        waiting = self.pending.pop(key)
+        if isinstance(result, tuple):
+            status, body = result
+        else:
+            log.err(result, 'Failed to read a timeline')
+            status, body = 500, ''
+
+        content_type = 'text/html; charset=utf-8'
+        if isinstance(body, dict):
+            body = json.dumps(body, cls=self.json_encoder)
+            content_type = 'application/json'
+        data = body.encode('utf-8')
+        # clients that went away meanwhile were removed from waiting
+        for request in waiting:
+            request.setResponseCode(status)
+            if data:
+                request.setHeader('Content-Type', content_type)
+                request.write(data)
+            request.finish()